@@ -0,0 +1,105 @@
+import os
+import sys
+import time
+from collections import namedtuple
+import torch
+from torch.utils.data import DataLoader, IterableDataset
+
+EvalResult = namedtuple("eval_result",
+                        ["loss",
+                         "num_samples",
+                         "samples_per_sec",
+                         "peak_memory_mb",
+                        ])
+
+def resident_memory_mb() -> float:
+    """
+    Current resident set size of the process in MB. Read from /proc on linux, from psutil where it is installed
+    otherwise. Without either (eg. macOS without psutil), falls back to the max resident set size of the process,
+    which never resets, so it also covers whatever ran before the evaluation.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, IndexError, ValueError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 2**20
+    except ImportError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return float("nan")
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports KB, macOS reports bytes
+    return max_rss / 2**20 if sys.platform == "darwin" else max_rss / 2**10
+
+
+def peak_memory_mb(device, cpu_peak: float) -> float:
+    """
+    Peak memory of an evaluation in MB. Allocated tensor memory since the last reset of the peak stats on cuda,
+    the largest resident set size sampled during the evaluation otherwise. Both cover only the evaluation, not
+    the training that ran before it in the same process.
+    """
+    if torch.device(device).type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    return cpu_peak
+
+
+class EvalEngine:
+    def __init__(self, model, device, batch_size: int = 4096):
+        """
+        Runs a model for evaluation and scoring under torch.inference_mode, so no autograd graph is built and no
+        activations are kept around.
+
+        :param model: The model to evaluate
+        :param device: "cuda" or "cpu"
+        :param batch_size: Evaluation batch size. Independent of (and usually much larger than) the training one
+        """
+        self.model = model
+        self.device = device
+        self.batch_size = batch_size
+
+    def evaluate(self, dataset, step) -> EvalResult:
+        """
+        Stream a dataset through the model and accumulate the loss on device.
+        :param dataset: A torch Dataset, or an IterableDataset that yields whole batches
+        :param step: function (model, inputs, labels) -> mean loss over the batch. Moves the batch to the device itself
+        :return: EvalResult with the mean loss per sample, sample count, samples/sec and peak memory in MB
+        """
+        if isinstance(dataset, IterableDataset):
+            loader = DataLoader(dataset, batch_size=None)
+        else:
+            loader = DataLoader(dataset, batch_size=self.batch_size, shuffle=False)
+        self.model.eval()
+        if torch.device(self.device).type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+        total_loss = torch.zeros((), device=self.device, dtype=torch.float64)
+        num_samples = 0
+        start = time.perf_counter()
+        # ru_maxrss never resets, so the cpu peak is sampled after every batch instead
+        sample_rss = torch.device(self.device).type != "cuda"
+        cpu_peak = resident_memory_mb() if sample_rss else float("nan")
+        with torch.inference_mode():
+            for inputs, labels in loader:
+                total_loss += step(self.model, inputs, labels).double() * len(inputs)
+                num_samples += len(inputs)
+                if sample_rss:
+                    cpu_peak = max(cpu_peak, resident_memory_mb())
+            loss = total_loss.item() / max(num_samples, 1)
+        elapsed = time.perf_counter() - start
+        return EvalResult(loss=loss, num_samples=num_samples, samples_per_sec=num_samples / elapsed,
+                          peak_memory_mb=peak_memory_mb(self.device, cpu_peak))
+
+    def predict(self, inputs):
+        """
+        Run the ensemble on a tensor of inputs in chunks of the evaluation batch size
+        :param inputs: Tensor of inputs, batch first
+        :return: Tensor of head outputs of shape (num_heads, B, ...)
+        """
+        self.model.eval()
+        with torch.inference_mode():
+            outputs = [self.model(chunk.to(self.device), as_tensor=True) for chunk in torch.split(inputs, self.batch_size)]
+            return torch.cat(outputs, dim=1)
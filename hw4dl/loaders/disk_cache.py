@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import shutil
+
+import numpy as np
+
+from hw4dl import ROOT_DIR
+from hw4dl.loaders.shared_cache import cache_key
+
+DISK_CACHE_DIR = os.path.join(ROOT_DIR, "cache", "datasets")
+DISK_CACHE_MAX_BYTES = 2 ** 30
+META_FILE = "meta.json"
+
+
+class DiskDatasetCache:
+    """
+    Content addressed on-disk cache of generated dataset arrays.
+
+    Every entry is a directory named after the hash of the dataset parameters, holding one .npy file per array and a
+    meta.json with the parameters and size. Hits are returned memory-mapped. The modification time of meta.json
+    marks the last use, and the least recently used entries are evicted once the cache grows past max_bytes.
+    """
+
+    def __init__(self, root:str=DISK_CACHE_DIR, max_bytes:int=DISK_CACHE_MAX_BYTES):
+        """
+        :param root: directory holding the cache entries
+        :param max_bytes: total size of the entries to keep
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def _entries(self)->list:
+        """
+        (last use, size, path) of every complete entry
+        """
+        entries = []
+        for name in os.listdir(self.root):
+            if ".tmp-" in name:
+                continue
+            meta_path = os.path.join(self.root, name, META_FILE)
+            try:
+                with open(meta_path, "r") as f:
+                    nbytes = json.load(f)["nbytes"]
+                entries.append((os.path.getmtime(meta_path), nbytes, os.path.join(self.root, name)))
+            except (OSError, ValueError, KeyError):
+                # partially written or removed by another process meanwhile
+                continue
+        return entries
+
+    def evict(self, keep:str=None):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes
+        :param keep: path of an entry to never evict, eg. the one just written
+        """
+        entries = sorted(self._entries())
+        total = sum(nbytes for _, nbytes, _ in entries)
+        for _, nbytes, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= nbytes
+
+    def get(self, params:dict, build)->dict:
+        """
+        Look the dataset up, building and storing it on a miss
+        :param params: json serialisable parameters that define the dataset, including its seed
+        :param build: function () -> dict of name -> np.ndarray, called on a miss
+        :return: dict of name -> array, read-only memory-mapped on a hit
+        """
+        entry = os.path.join(self.root, cache_key(params))
+        meta_path = os.path.join(entry, META_FILE)
+        if os.path.exists(meta_path):
+            try:
+                with open(meta_path, "r") as f:
+                    names = json.load(f)["names"]
+                arrays = {name: np.load(os.path.join(entry, f"{name}.npy"), mmap_mode="r") for name in names}
+                # mark as recently used
+                os.utime(meta_path)
+                return arrays
+            except (OSError, ValueError, KeyError):
+                # evicted or corrupted, rebuild it
+                pass
+
+        arrays = build()
+        # write to a private directory and rename it into place, so readers never see a partial entry
+        tmp = f"{entry}.tmp-{os.getpid()}"
+        os.makedirs(tmp, exist_ok=True)
+        nbytes = 0
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, f"{name}.npy"), np.ascontiguousarray(array))
+            nbytes += np.asarray(array).nbytes
+        with open(os.path.join(tmp, META_FILE), "w") as f:
+            json.dump(dict(params=params, names=list(arrays), nbytes=nbytes, created=time.time()), f, default=repr)
+        shutil.rmtree(entry, ignore_errors=True)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict(keep=entry)
+        return arrays
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
@@ -1,12 +1,127 @@
 import os
+import json
 
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, BatchSampler, RandomSampler, SequentialSampler
 import torch
 import skimage.io as io
 import pandas as pd
 from torchvision import transforms
 import numpy as np
 from PIL import Image
+from tqdm import tqdm
+from hw4dl.loaders.shared_cache import SharedDatasetCache
+
+# files of the packed Map2Loc format, stored next to description.csv
+PACKED_IMAGES = "images.bin"
+PACKED_LABELS = "labels.bin"
+PACKED_META = "meta.json"
+
+
+class PackedMap2LocWriter:
+    """
+    Appends samples to a packed Map2Loc dataset: one contiguous image array, one contiguous label array and a
+    small json header describing their shapes and dtypes.
+    """
+
+    def __init__(self, out_dir, image_shape, label_shape, image_dtype=np.uint8, label_dtype=np.float64, resume=False):
+        """
+        :param out_dir: directory to write images.bin, labels.bin and meta.json to. Existing packed files are replaced
+         unless resume is set.
+        :param image_shape: shape of one image
+        :param label_shape: shape of one label, () for scalar labels
+        :param image_dtype: dtype images are stored as
+        :param label_dtype: dtype labels are stored as
+        :param resume: append to the packed dataset already in out_dir instead of replacing it
+        """
+        self.out_dir = out_dir
+        self.meta = dict(num_samples=0,
+                         image_shape=list(image_shape), image_dtype=np.dtype(image_dtype).str,
+                         label_shape=list(label_shape), label_dtype=np.dtype(label_dtype).str)
+        mode = "wb"
+        if resume and os.path.exists(os.path.join(out_dir, PACKED_META)):
+            with open(os.path.join(out_dir, PACKED_META), "r") as f:
+                existing = json.load(f)
+            assert {k: v for k, v in existing.items() if k != "num_samples"} == \
+                   {k: v for k, v in self.meta.items() if k != "num_samples"}, "existing packed dataset has another layout"
+            self.meta["num_samples"] = existing["num_samples"]
+            mode = "r+b"
+        os.makedirs(out_dir, exist_ok=True)
+        self.image_file = open(os.path.join(out_dir, PACKED_IMAGES), mode)
+        self.label_file = open(os.path.join(out_dir, PACKED_LABELS), mode)
+        # drop anything written after the last header, eg. by an interrupted run
+        for f, shape, dtype in [(self.image_file, image_shape, image_dtype), (self.label_file, label_shape, label_dtype)]:
+            f.seek(self.meta["num_samples"] * int(np.prod(shape)) * np.dtype(dtype).itemsize)
+            f.truncate()
+
+    def append(self, images, labels):
+        """
+        Append a batch of samples
+        :param images: array of shape (batch, *image_shape)
+        :param labels: array of shape (batch, *label_shape)
+        """
+        images = np.ascontiguousarray(images, dtype=self.meta["image_dtype"])
+        labels = np.ascontiguousarray(labels, dtype=self.meta["label_dtype"])
+        assert images.shape[1:] == tuple(self.meta["image_shape"]), "image shape does not match the packed dataset"
+        assert labels.shape[1:] == tuple(self.meta["label_shape"]), "label shape does not match the packed dataset"
+        assert len(images) == len(labels), "need one label per image"
+        images.tofile(self.image_file)
+        labels.tofile(self.label_file)
+        self.meta["num_samples"] += len(images)
+
+    def close(self):
+        """
+        Flush the arrays and write the header
+        """
+        self.image_file.close()
+        self.label_file.close()
+        with open(os.path.join(self.out_dir, PACKED_META), "w") as f:
+            json.dump(self.meta, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_packed_map2loc(packed_dir):
+    """
+    Open a packed Map2Loc dataset read-only with np.memmap
+    :param packed_dir: directory containing images.bin, labels.bin and meta.json
+    :return: images memmap, labels memmap and the header dict
+    """
+    with open(os.path.join(packed_dir, PACKED_META), "r") as f:
+        meta = json.load(f)
+    n = meta["num_samples"]
+    images = np.memmap(os.path.join(packed_dir, PACKED_IMAGES), dtype=meta["image_dtype"], mode="r",
+                       shape=(n, *meta["image_shape"]))
+    labels = np.memmap(os.path.join(packed_dir, PACKED_LABELS), dtype=meta["label_dtype"], mode="r",
+                       shape=(n, *meta["label_shape"]))
+    return images, labels, meta
+
+
+def pack_map2loc(root_dir, csv_file='description.csv', out_dir=None, chunk_size=4096):
+    """
+    Convert a Map2Loc dataset from the per-file layout (one image .npy and one _label.npy per sample) to the packed
+    format. Every file is read exactly once.
+    :param root_dir: root directory of the per-file dataset
+    :param csv_file: csv file containing file paths and metadata for the dataset
+    :param out_dir: directory to write the packed dataset to. Defaults to root_dir
+    :param chunk_size: number of samples buffered in memory before they are appended
+    """
+    out_dir = root_dir if out_dir is None else out_dir
+    files = pd.read_csv(os.path.join(root_dir, csv_file)).iloc[:, 0].tolist()
+    first_image = np.load(os.path.join(root_dir, files[0]))
+    first_label = np.load(os.path.join(root_dir, files[0]).split(".npy")[0] + "_label.npy")
+    with PackedMap2LocWriter(out_dir, first_image.shape, np.shape(first_label), first_image.dtype,
+                             np.asarray(first_label).dtype) as writer:
+        for start in tqdm(range(0, len(files), chunk_size)):
+            images, labels = [], []
+            for file in files[start:start + chunk_size]:
+                img_name = os.path.join(root_dir, file)
+                images.append(np.load(img_name))
+                labels.append(np.load(img_name.split(".npy")[0] + "_label.npy"))
+            writer.append(np.stack(images), np.stack(labels))
 
 
 class Map2Loc(Dataset):
@@ -14,15 +129,35 @@ class Map2Loc(Dataset):
     Dataset for map2loc task
     """
 
-    def __init__(self, root_dir, csv_file):
+    def __init__(self, root_dir, csv_file, packed=False, shared=False):
         """
         Creates a Map2Loc Dataloader from a pregenerated dataset
         :param root_dir: root directory containing the Map2Loc dataset.
         :param csv_file: csv file containing file paths and metadata for the dataset.
+        :param packed: serve samples from the packed format in root_dir (see pack_map2loc) instead of per-sample
+         files. Indexing then also accepts a list of indices and returns the whole batch.
+        :param shared: load the whole dataset once into a shared memory cache that concurrent jobs attach to, instead
+         of reading the files in every process. Indexing is the same as for packed datasets.
         """
 
         self.root_dir = root_dir
-        self.df = pd.read_csv(os.path.join(self.root_dir, csv_file))
+        self.csv_file = csv_file
+        self.packed = packed
+        self.shared = shared
+        if self.shared:
+            index_file = os.path.join(self.root_dir, PACKED_META if packed else csv_file)
+            self.cache = SharedDatasetCache(dict(kind="Map2Loc", root_dir=os.path.realpath(self.root_dir),
+                                                 csv_file=csv_file, packed=packed,
+                                                 mtime=os.path.getmtime(index_file)))
+            self.images, self.labels = self._open_arrays()
+            self.num_samples = len(self.images)
+        elif self.packed:
+            # opened lazily so that DataLoader workers map the files themselves instead of receiving a copy
+            self.images, self.labels = None, None
+            with open(os.path.join(self.root_dir, PACKED_META), "r") as f:
+                self.num_samples = json.load(f)["num_samples"]
+        else:
+            self.df = pd.read_csv(os.path.join(self.root_dir, csv_file))
         self.transform = transforms.ToTensor()
         self.gaps = [(2, 4, 2, 4), (7, 12, 7, 12)]
         self.shape = (15,15)
@@ -36,10 +171,43 @@ class Map2Loc(Dataset):
         self.polyf = polyf
         self.varf = varf
 
+    def _load_arrays(self):
+        if self.packed:
+            images, labels, _ = open_packed_map2loc(self.root_dir)
+            return dict(images=np.array(images), labels=np.array(labels))
+        files = pd.read_csv(os.path.join(self.root_dir, self.csv_file)).iloc[:, 0].tolist()
+        images, labels = [], []
+        for file in tqdm(files):
+            img_name = os.path.join(self.root_dir, file)
+            images.append(np.load(img_name))
+            labels.append(np.load(img_name.split(".npy")[0] + "_label.npy"))
+        return dict(images=np.stack(images), labels=np.stack(labels))
+
+    def _open_arrays(self):
+        if self.shared:
+            arrays = self.cache.attach(self._load_arrays)
+            return arrays["images"], arrays["labels"]
+        images, labels, _ = open_packed_map2loc(self.root_dir)
+        return images, labels
+
+    def _get_packed(self, idx):
+        if self.images is None:
+            self.images, self.labels = self._open_arrays()
+        image = torch.from_numpy(np.array(self.images[idx]))
+        target = torch.from_numpy(np.array(self.labels[idx]))
+        # same scaling as transforms.ToTensor on uint8 images
+        image = image.unsqueeze(-3).type(torch.float32)
+        if self.images.dtype == np.uint8:
+            image = image / 255
+        return image, target
+
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
 
+        if self.packed or self.shared:
+            return self._get_packed(idx)
+
         img_name = os.path.join(self.root_dir, self.df.iloc[idx, 0])
         image = np.load(img_name)
 
@@ -50,10 +218,30 @@ class Map2Loc(Dataset):
 
         return image, target
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.packed or self.shared:
+            state["images"], state["labels"] = None, None
+        return state
+
     def __len__(self):
+        if self.packed or self.shared:
+            return self.num_samples
         return len(self.df)
 
 
+def make_map2loc_loader(dataset, batch_size, shuffle=True):
+    """
+    DataLoader for a Map2Loc dataset (or a Subset of one). Packed and shared datasets are fetched a whole batch at a
+    time with a batch sampler, per-file datasets use the default per-sample fetching.
+    """
+    base = dataset.dataset if isinstance(dataset, torch.utils.data.Subset) else dataset
+    if not (getattr(base, "packed", False) or getattr(base, "shared", False)):
+        return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle)
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size=batch_size, drop_last=False), batch_size=None)
+
+
 if __name__ == '__main__':
     # create dataloader
     Data = Map2Loc(root_dir='../datasets/map2loc_prototype', csv_file='description.csv')
@@ -68,4 +256,4 @@ if __name__ == '__main__':
 
     plt.imshow(transforms.ToPILImage()(batch[0][4]))
 
-    plt.show()
\ No newline at end of file
+    plt.show()
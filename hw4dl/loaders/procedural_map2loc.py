@@ -0,0 +1,100 @@
+import math
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, DataLoader, get_worker_info
+
+from hw4dl.tools.create_map2loc import sample_map2loc_chunk
+
+# same map, gaps and image size as the pregenerated Map2Loc datasets
+MAP2LOC_GAPS = [(2, 4, 2, 4), (7, 12, 7, 12)]
+MAP2LOC_SHAPE = (15, 15)
+
+
+def map2loc_polyf(x, y):
+    return x ** 2 + y ** 2
+
+
+def map2loc_varf(x, y):
+    return 0.5 * x + 0.5 * y + 1
+
+
+class ProceduralMap2Loc(IterableDataset):
+    """
+    Map2Loc samples generated on the fly instead of read from disk
+    """
+
+    def __init__(self, task, samples, batch_size, seed=1111, use_gaps=True, patch_size=2):
+        """
+        Creates a Map2Loc dataset that renders every batch when it is requested. Yields whole (images, labels) batches
+        in the layout of Map2Loc, so it is meant to be wrapped in DataLoader(dataset, batch_size=None), see
+        make_procedural_loader.
+
+        Batch b of epoch e is drawn from its own rng seeded with (seed, e, b), and DataLoader workers take every
+        num_workers-th batch, so the data only depends on the seed and the epoch, never on the number of workers.
+        :param task: "pixel" or "patch"
+        :param samples: number of samples per epoch
+        :param batch_size: number of samples per yielded batch
+        :param seed: base seed of the random streams
+        :param use_gaps: reject locations in the gaps like the training set. Test sets are generated without them
+        :param patch_size: size of the patch for the patch task
+        """
+        self.task = task
+        self.samples = samples
+        self.batch_size = batch_size
+        self.seed = seed
+        self.use_gaps = use_gaps
+        self.patch_size = patch_size
+        self.epoch = 0
+        # attributes shared with Map2Loc, used for scoring
+        self.gaps = MAP2LOC_GAPS
+        self.shape = MAP2LOC_SHAPE
+        self.polyf = map2loc_polyf
+        self.varf = map2loc_varf
+
+    def set_epoch(self, epoch):
+        """
+        Move to the random streams of another epoch. Datasets that never call this serve the same samples every
+        epoch, which is what validation and test sets want.
+        """
+        self.epoch = epoch
+
+    def _get_batch(self, batch_idx):
+        rng = np.random.default_rng([self.seed, self.epoch, batch_idx])
+        n = min(self.batch_size, self.samples - batch_idx * self.batch_size)
+        gaps = self.gaps if self.use_gaps else []
+        images, labels = [], []
+        while n > 0:
+            # draw a few spare candidates so that one round is usually enough after rejection
+            image, z, _, _ = sample_map2loc_chunk(rng, self.polyf, self.varf, 2 * n, gaps, self.shape, self.patch_size,
+                                                  self.task, limit=n)
+            images.append(image)
+            labels.append(z)
+            n -= len(image)
+        image = torch.from_numpy(np.concatenate(images))
+        target = torch.from_numpy(np.concatenate(labels))
+        # same scaling as transforms.ToTensor on uint8 images
+        image = image.unsqueeze(-3).type(torch.float32) / 255
+        return image, target
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        for batch_idx in range(worker_id, len(self), num_workers):
+            yield self._get_batch(batch_idx)
+
+    def __len__(self):
+        return math.ceil(self.samples / self.batch_size)
+
+
+def make_procedural_loader(dataset, num_workers=0):
+    """
+    DataLoader for a ProceduralMap2Loc dataset, which already yields whole batches
+    """
+    return DataLoader(dataset, batch_size=None, num_workers=num_workers)
+
+
+if __name__ == '__main__':
+    data = ProceduralMap2Loc(task="patch", samples=100, batch_size=10)
+    images, labels = next(iter(make_procedural_loader(data)))
+    print(images.shape, labels.shape)
@@ -0,0 +1,143 @@
+import os
+import json
+import atexit
+import fcntl
+import shutil
+import hashlib
+import tempfile
+from collections import Counter
+
+import numpy as np
+
+# tmpfs, so the cached arrays live in RAM and np.load(mmap_mode="r") maps them without a copy
+SHM_ROOT = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+COMPLETE_FILE = "complete.json"
+
+# attachments of this process per cache directory; the process holds one ref file while this is above zero
+_attached = Counter()
+
+
+def cache_key(params:dict)->str:
+    """
+    Stable hash of the parameters that define a dataset
+    """
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=repr).encode()).hexdigest()[:16]
+
+
+def _pid_alive(pid:int)->bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedDatasetCache:
+    """
+    Arrays of a dataset materialized once in shared memory and attached by every process that asks for the same
+    parameters.
+
+    Every attached process holds a ref file named after its pid. The last process to release the cache (or the first
+    one to find only refs of dead processes) removes it, together with its lock file.
+    """
+
+    def __init__(self, params:dict, root:str=SHM_ROOT):
+        """
+        :param params: json serialisable parameters that define the dataset, including its seed
+        :param root: directory to keep the cache in, a tmpfs such as /dev/shm by default
+        """
+        self.params = params
+        self.key = cache_key(params)
+        self.cache_dir = os.path.join(root, f"hw4dl_cache_{self.key}")
+        self.lock_path = os.path.join(root, f"hw4dl_cache_{self.key}.lock")
+        self.attached = False
+
+    def _lock(self):
+        while True:
+            lock = open(self.lock_path, "a")
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # the last process to release the cache unlinks the lock file, a lock taken on it is stale
+            try:
+                if os.fstat(lock.fileno()).st_ino == os.stat(self.lock_path).st_ino:
+                    return lock
+            except FileNotFoundError:
+                pass
+            lock.close()
+
+    def _live_refs(self)->list:
+        refs_dir = os.path.join(self.cache_dir, "refs")
+        refs = []
+        for ref in os.listdir(refs_dir):
+            if _pid_alive(int(ref)):
+                refs.append(ref)
+            else:
+                os.remove(os.path.join(refs_dir, ref))
+        return refs
+
+    def _materialize(self, build):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.makedirs(os.path.join(self.cache_dir, "refs"))
+        arrays = build()
+        for name, array in arrays.items():
+            np.save(os.path.join(self.cache_dir, f"{name}.npy"), np.ascontiguousarray(array))
+        with open(os.path.join(self.cache_dir, COMPLETE_FILE), "w") as f:
+            json.dump(dict(params=self.params, names=list(arrays)), f, default=repr)
+
+    def attach(self, build)->dict:
+        """
+        Attach to the cached arrays, building them first if no process has yet
+        :param build: function () -> dict of name -> np.ndarray, only called by the process that creates the cache
+        :return: dict of name -> read-only np.memmap over the shared arrays
+        """
+        with self._lock():
+            complete = os.path.join(self.cache_dir, COMPLETE_FILE)
+            if not os.path.exists(complete) or (not self._live_refs() and _attached[self.cache_dir] == 0):
+                # nothing cached, or left over by processes that died without releasing it
+                self._materialize(build)
+            if not self.attached:
+                if _attached[self.cache_dir] == 0:
+                    open(os.path.join(self.cache_dir, "refs", str(os.getpid())), "w").close()
+                    atexit.register(self._release_process)
+                _attached[self.cache_dir] += 1
+                self.attached = True
+            with open(complete, "r") as f:
+                names = json.load(f)["names"]
+            return {name: np.load(os.path.join(self.cache_dir, f"{name}.npy"), mmap_mode="r") for name in names}
+
+    def release(self):
+        """
+        Drop this attachment. Arrays already attached stay valid, the memory is freed once they are unmapped.
+        """
+        if not self.attached:
+            return
+        self.attached = False
+        _attached[self.cache_dir] -= 1
+        if _attached[self.cache_dir] == 0:
+            self._release_process()
+
+    def _release_process(self):
+        if not os.path.isdir(self.cache_dir):
+            # already removed, eg. released before the atexit hook runs; taking the lock would recreate its file
+            return
+        with self._lock():
+            ref = os.path.join(self.cache_dir, "refs", str(os.getpid()))
+            if os.path.exists(ref):
+                os.remove(ref)
+            if os.path.isdir(self.cache_dir) and not self._live_refs():
+                shutil.rmtree(self.cache_dir, ignore_errors=True)
+                # still holding the lock, so no other process is between taking it and using the cache
+                os.remove(self.lock_path)
+
+    def __getstate__(self):
+        # every process holds its own ref, a copy sent to another process starts detached
+        state = self.__dict__.copy()
+        state["attached"] = False
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
@@ -1,9 +1,12 @@
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, IterableDataset
 import torch
+import math
 
 import numpy as np
 import matplotlib.pyplot as plt
 import warnings
+from hw4dl.loaders.shared_cache import SharedDatasetCache
+from hw4dl.loaders.disk_cache import DiskDatasetCache
 
 def construct_intervals(use_gaps:bool, gaps:list, lower:float, upper:float)->list:
     # convert gaps to valid intervals
@@ -25,7 +28,8 @@ class PolyData(Dataset):
     Dataset for toy regression problem
     """
 
-    def __init__(self, polyf, varf, gaps, lower=-1, upper=1, size=1000, seed=1111, scramble:bool=False, num_heads:int=1):
+    def __init__(self, polyf, varf, gaps, lower=-1, upper=1, size=1000, seed=1111, scramble:bool=False, num_heads:int=1,
+                 exact_stream:bool=False, shared_key:str=None, disk_key:str=None):
 
         """
         Construct dataset attricutes and construct dataset
@@ -50,6 +54,15 @@ class PolyData(Dataset):
             whether to scramble the dataset -> changes output shape to (size, num_heads, 2)
         num_heads : int
             number of heads to use for multihead model -> only used if scramble is True
+        exact_stream : bool
+            draw samples one at a time with sample_xy. Slow, but reproduces the sample stream of datasets built
+            before construction was vectorized for a given seed
+        shared_key : str
+            name of polyf and varf, eg. the polyf_type. If given, the dataset is built once into a shared memory cache
+            keyed by it and the other parameters, and every process that asks for the same dataset attaches to it
+        disk_key : str
+            name of polyf and varf, like shared_key. If given, the dataset is memoized in the on-disk DiskDatasetCache
+            and memory-mapped from there when it was generated before
         """
 
         # functions for variance and polynomial
@@ -68,6 +81,7 @@ class PolyData(Dataset):
 
         self.scramble = scramble
         self.num_heads = num_heads
+        self.exact_stream = exact_stream
 
         # make sure gaps are in function range
         if len(self.gaps) == 0:
@@ -76,7 +90,18 @@ class PolyData(Dataset):
             self.use_gaps = True
             assert gaps[0][0] >= lower and gaps[-1][1] <= upper, "Gap intervals must with within ['lower', 'upper']."
 
-        self.x, self.y = self._construct_dataset()
+        self.cache = None
+        params = dict(kind="PolyData", polyf=shared_key or disk_key, gaps=self.gaps, lower=lower, upper=upper,
+                      size=size, seed=seed, scramble=scramble, num_heads=num_heads, exact_stream=exact_stream)
+        build = self._construct_arrays
+        if disk_key is not None:
+            build = lambda: DiskDatasetCache().get(params, self._construct_arrays)
+        if shared_key is not None:
+            self.cache = SharedDatasetCache(params)
+            arrays = self.cache.attach(build)
+        else:
+            arrays = build()
+        self.x, self.y = arrays["x"], arrays["y"]
 
     def sample_xy(self, total_interval_size, intervals): 
       if self.use_gaps:
@@ -102,9 +127,50 @@ class PolyData(Dataset):
       
       return x,y
        
+    def _construct_arrays(self):
+        x_list, y_list = self._construct_dataset()
+        return dict(x=x_list, y=y_list)
+
     def _construct_dataset(self):
         """
-        Randomly construct the polynormial dataset, taking into account the gap intervals and variance function
+        Randomly construct the polynormial dataset, taking into account the gap intervals and variance function.
+        All interval bins, x values and noise are drawn for the whole dataset at once.
+
+        Returns
+        -------
+        x_list : array-like
+            list of x values
+        y_list : array-like
+            list of y values
+        """
+        if self.exact_stream:
+            return self._construct_dataset_exact()
+
+        shape = (self.size, self.num_heads) if self.scramble else (self.size,)
+        intervals = construct_intervals(self.use_gaps, self.gaps, self.lower, self.upper)
+        lows = np.array([i[0] for i in intervals], dtype=np.float64)
+        highs = np.array([i[1] for i in intervals], dtype=np.float64)
+
+        # sample intervals according to their relative size to ensure [lower, upper] is uniform
+        if self.use_gaps:
+            bins = self.rng.choice(len(intervals), size=shape, p=(highs - lows) / np.sum(highs - lows))
+        else:
+            bins = np.zeros(shape, dtype=np.int64)
+        x_list = self.rng.uniform(low=lows[bins], high=highs[bins])
+
+        # check variance
+        var_x = self.varf(x_list)
+        if np.any(var_x < 0):
+            raise ValueError('variance function is negative in provided polynomial interval')
+
+        # get poly out
+        y_list = self.polyf(x_list) + self.rng.normal(loc=0, scale=np.sqrt(var_x))
+
+        return x_list, y_list
+
+    def _construct_dataset_exact(self):
+        """
+        Construct the dataset one sample at a time with sample_xy, in the original sample order
 
         Returns
         -------
@@ -145,6 +211,46 @@ class PolyData(Dataset):
         return self.size
 
 
+class TensorBatches(IterableDataset):
+    """
+    Batches of a PolyData dataset served from preconverted tensors
+    """
+
+    def __init__(self, dataset, batch_size, shuffle=True, device="cpu"):
+        """
+        Converts the whole dataset to float32 tensors once, so every batch is a single index gather instead of one
+        __getitem__ call per sample plus collation. Yields (x, y) batches in the layout a DataLoader over the dataset
+        would: (batch,) or (batch, num_heads) in scramble mode.
+
+        Parameters
+        ----------
+        dataset : PolyData
+            dataset to serve
+        batch_size : int
+            number of samples per batch
+        shuffle : bool
+            draw a new permutation every epoch from the global torch rng, like DataLoader(shuffle=True)
+        device : str or torch.device
+            device the tensors are kept on, so batches need no host to device copy
+        """
+        self.x = torch.as_tensor(np.asarray(dataset.x, dtype=np.float32), device=device)
+        self.y = torch.as_tensor(np.asarray(dataset.y, dtype=np.float32), device=device)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(len(self.x)).to(self.x.device)
+            for start in range(0, len(self.x), self.batch_size):
+                idx = order[start:start + self.batch_size]
+                yield self.x[idx], self.y[idx]
+        else:
+            yield from zip(torch.split(self.x, self.batch_size), torch.split(self.y, self.batch_size))
+
+    def __len__(self):
+        return math.ceil(len(self.x) / self.batch_size)
+
+
 if __name__ == '__main__':
 
     # TEST
@@ -2,7 +2,7 @@ import argparse
 from hw4dl.train import train
 import torch
 
-def parse_options():
+def make_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--device_type', type=str, default="cuda", help="type of device to run on; one of [mps, gpu]")
     parser.add_argument('--polyf_type', type=str, default="cubic", help='polynomial fn for instantiating dataset; supports [cubic]')
@@ -10,13 +10,20 @@ def parse_options():
     parser.add_argument('--val_size', type=int, default=2000, help='Val dataset size')
     parser.add_argument('--test_size', type=int, default=2000, help='Test dataset size')
     parser.add_argument('--batch_size', type=int, default=512, help='Dataset batch size')
+    parser.add_argument('--eval_batch_size', type=int, default=4096, help='Batch size for validation and test')
     parser.add_argument('--model_type', type=str, default="shared", help="Type of model; one of [shared, single]")
     parser.add_argument('--split_idx', type=int, default=0, help="index of layer to split the backbone for a separated network. Eg 2 would split after hidden2")
     parser.add_argument('--num_heads', type=int, default=5, help="number of prediction heads for a separated network")
     parser.add_argument('--scramble_batches', type=bool, default=False, help="scramble batches for a separated network")
     parser.add_argument('--lr', type=float, default=1e-3, help="learning rate")
     parser.add_argument('--n_epochs', type=int, default=15, help="number of epochs")
-    return parser.parse_args()
+    parser.add_argument('--shared_cache', action='store_true', help="build the datasets once in shared memory for concurrent jobs")
+    parser.add_argument('--disk_cache', action='store_true', help="memoize the generated datasets on disk (see loaders/disk_cache.py)")
+    return parser
+
+
+def parse_options(argv=None):
+    return make_parser().parse_args(argv)
 
 
 if __name__ == '__main__':
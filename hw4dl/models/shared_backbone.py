@@ -1,14 +1,102 @@
 import torch
 import torch.nn as nn
 
+class StackedHeads(nn.Module):
+  def __init__(self, layer_shapes:tuple, num_heads:int, heads:nn.ModuleList=None):
+    """
+    Holds the weights of every head as stacked (num_heads, out, in) parameters so that each layer of all heads
+    is evaluated with a single batched matmul.
+
+    The state dict is written and read in the per-head nn.Sequential layout ({i}.{2k}.weight), so checkpoints
+    are interchangeable with the nn.ModuleList of heads.
+
+    @param layer_shapes: tuple of layer shapes of one head eg. (split_input, hidden, output)
+    @param num_heads: number of heads to stack
+    @param heads: optional per-head nn.Sequential modules to take the weights from. Freshly initialised if None
+    """
+    super().__init__()
+    self.layer_shapes = layer_shapes
+    self.num_heads = num_heads
+    self.weights = nn.ParameterList()
+    self.biases = nn.ParameterList()
+    for j in range(len(layer_shapes)-1):
+      if heads is None:
+        # initialise every head like nn.Linear would
+        linears = [nn.Linear(layer_shapes[j], layer_shapes[j+1]) for _ in range(num_heads)]
+      else:
+        linears = [head[2*j] for head in heads]
+      self.weights.append(nn.Parameter(torch.stack([l.weight.detach() for l in linears])))
+      self.biases.append(nn.Parameter(torch.stack([l.bias.detach() for l in linears])))
+    self._register_state_dict_hook(StackedHeads._to_per_head_state_dict)
+    self._register_load_state_dict_pre_hook(StackedHeads._from_per_head_state_dict, with_module=True)
+
+  @classmethod
+  def from_heads(cls, heads:nn.ModuleList, layer_shapes:tuple):
+    """
+    Build stacked heads from a list of per-head nn.Sequential modules
+    """
+    return cls(layer_shapes, len(heads), heads=heads)
+
+  def to_heads(self)->nn.ModuleList:
+    """
+    Convert the stacked parameters back into a list of per-head nn.Sequential modules
+    """
+    heads = []
+    for i in range(self.num_heads):
+      head_i = []
+      for j in range(len(self.layer_shapes)-1):
+        head_i.append(nn.Linear(self.layer_shapes[j], self.layer_shapes[j+1]))
+        if j != len(self.layer_shapes)-2:
+          head_i.append(nn.ReLU())
+      heads.append(nn.Sequential(*head_i))
+    heads = nn.ModuleList(heads).to(self.weights[0].device)
+    heads.load_state_dict(self.state_dict())
+    return heads
+
+  @staticmethod
+  def _to_per_head_state_dict(module, state_dict, prefix, local_metadata):
+    weights = [state_dict.pop(f"{prefix}weights.{j}") for j in range(len(module.weights))]
+    biases = [state_dict.pop(f"{prefix}biases.{j}") for j in range(len(module.biases))]
+    for i in range(module.num_heads):
+      for j, (weight, bias) in enumerate(zip(weights, biases)):
+        state_dict[f"{prefix}{i}.{2*j}.weight"] = weight[i]
+        state_dict[f"{prefix}{i}.{2*j}.bias"] = bias[i]
+    return state_dict
+
+  @staticmethod
+  def _from_per_head_state_dict(module, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+    for j in range(len(module.weights)):
+      weight_keys = [f"{prefix}{i}.{2*j}.weight" for i in range(module.num_heads)]
+      bias_keys = [f"{prefix}{i}.{2*j}.bias" for i in range(module.num_heads)]
+      if all(k in state_dict for k in weight_keys + bias_keys):
+        state_dict[f"{prefix}weights.{j}"] = torch.stack([state_dict.pop(k) for k in weight_keys])
+        state_dict[f"{prefix}biases.{j}"] = torch.stack([state_dict.pop(k) for k in bias_keys])
+
+  def forward(self, x):
+    """
+    @param x: input tensor of shape (num_heads, batch_size, input_shape)
+
+    @return: output tensor of shape (num_heads, batch_size, output_shape)
+    """
+    for j, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+      x = torch.baddbmm(bias.unsqueeze(1), x, weight.transpose(1, 2))
+      if j != len(self.weights)-1:
+        x = torch.relu(x)
+    return x
+
+
 class VariableBackbone(nn.Module):
-  def __init__(self, layer_shapes:tuple, split_idx:int, num_heads:int, scramble_batches:bool=False):
+  # class level default so models pickled before stacked heads existed still load
+  stacked_heads = False
+
+  def __init__(self, layer_shapes:tuple, split_idx:int, num_heads:int, scramble_batches:bool=False, stacked_heads:bool=False):
     """
-    Create a NN with variable amount of shared backbone 
+    Create a NN with variable amount of shared backbone
 
-    @param layer_shapes: tuple of layer shapes eg. (input, hidden1, hidden2, output) 
+    @param layer_shapes: tuple of layer shapes eg. (input, hidden1, hidden2, output)
     @param split_idx: index of layer to split the backbone. Eg 2 would split after hidden2
     @param num_heads: number of heads to create
+    @param stacked_heads: hold the heads as StackedHeads and evaluate them with one batched matmul per layer
 
     """
     super().__init__()
@@ -16,13 +104,14 @@ class VariableBackbone(nn.Module):
     self.split_idx = split_idx
     self.num_heads = num_heads
     self.scramble_batches = scramble_batches
+    self.stacked_heads = False
     assert self.split_idx < len(self.layer_shapes)-1, "Split index must be less than the number of layers"
     if self.scramble_batches:
       assert self.split_idx == 0, "scramble batches only supported for split_idx=0"
     shared_backbone = []
     for i in range(self.split_idx):
       shared_backbone.append(nn.Linear(layer_shapes[i], layer_shapes[i+1]))
-                             
+
       if i != len(self.layer_shapes)-2:
         shared_backbone.append(nn.ReLU())
     self.shared_backbone = nn.Sequential(*shared_backbone)
@@ -36,15 +125,54 @@ class VariableBackbone(nn.Module):
           head_i.append(nn.ReLU())
       heads.append(nn.Sequential(*head_i))
     self.heads = nn.ModuleList(heads)
+    if stacked_heads:
+      self.stack_heads()
 
-  def forward(self, x):
+  def stack_heads(self):
+    """
+    Switch to the stacked heads execution mode. The state dict layout is unchanged.
+    """
+    if not self.stacked_heads:
+      self.heads = StackedHeads.from_heads(self.heads, self.layer_shapes[self.split_idx:])
+      self.stacked_heads = True
+    return self
+
+  def unstack_heads(self):
+    """
+    Switch back to running one nn.Sequential per head
+    """
+    if self.stacked_heads:
+      self.heads = self.heads.to_heads()
+      self.stacked_heads = False
+    return self
+
+  def forward(self, x, as_tensor:bool=False):
     """
     @param x: input tensor.
       If not scramble batches: shape (batch_size, input_shape)
-      If scramble batches: shape (batch_size, input_shape, num_heads) 
+      If scramble batches: shape (batch_size, input_shape, num_heads)
+    @param as_tensor: return a single (num_heads, batch_size, output_shape) tensor instead of a list
 
-    @return: list of output tensors. 
+    @return: list of output tensors.
     """
+    if self.stacked_heads:
+      if self.scramble_batches:
+        x = x.permute(2, 0, 1)
+      else:
+        x = self.shared_backbone(x)
+        x = x.unsqueeze(0).expand(self.num_heads, -1, -1)
+      outputs = self.heads(x)
+      return outputs if as_tensor else list(outputs.unbind(0))
+
+    if as_tensor:
+      # write the heads straight into one preallocated tensor instead of stacking a list
+      outputs = x.new_empty((self.num_heads, x.shape[0], self.layer_shapes[-1]))
+      if not self.scramble_batches:
+        x = self.shared_backbone(x)
+      for i, head in enumerate(self.heads):
+        outputs[i] = head(x[:, :, i] if self.scramble_batches else x)
+      return outputs
+
     outputs = []
     if self.scramble_batches:
       for i in range(self.num_heads):
@@ -57,10 +185,9 @@ class VariableBackbone(nn.Module):
 
     return outputs
 
-
 if __name__ == "__main__":
   layer_shapes = [10, 20, 30, 40]
   split_idx = 2
   num_heads = 3
   model = VariableBackbone(layer_shapes, split_idx, num_heads)
-  print(model) 
\ No newline at end of file
+  print(model)
@@ -1,10 +1,165 @@
+import copy
 import torch
 import torch.nn as nn
 import pdb
 import numpy as np
+
+
+class StackedLinear(nn.Module):
+    def __init__(self, in_features: int, out_features: int, num_heads: int):
+        """
+        Linear layer of every head held as stacked (num_heads, out, in) weights.
+
+        Takes either the shared input (batch, in), which is broadcast to all heads, or a per-head input
+        (num_heads, batch, in) and returns (num_heads, batch, out).
+        """
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.num_heads = num_heads
+        self.weight = nn.Parameter(torch.empty(num_heads, out_features, in_features))
+        self.bias = nn.Parameter(torch.empty(num_heads, out_features))
+
+    def forward(self, x):
+        return torch.matmul(x, self.weight.transpose(1, 2)) + self.bias.unsqueeze(1)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, num_heads={self.num_heads}"
+
+
+class HeadFlatten(nn.Module):
+    def __init__(self, num_heads: int):
+        """
+        Flatten a fused (batch, num_heads * c, h, w) feature map to per-head vectors (num_heads, batch, c * h * w).
+        """
+        super().__init__()
+        self.num_heads = num_heads
+
+    def forward(self, x):
+        return x.reshape(x.shape[0], self.num_heads, -1).transpose(0, 1)
+
+
+class FusedHeads(nn.Module):
+    def __init__(self, heads: nn.ModuleList):
+        """
+        Fuse the per-head nn.Sequential modules of a VariableCNNBackbone into a single network.
+
+        Head convolutions become one Conv2d with groups=num_heads holding the channels of every head side by side,
+        and head linear layers become one StackedLinear. The first head convolution sees the shared features, so it
+        runs as a plain Conv2d with num_heads times the output channels, which is the same as replicating the input
+        along channels and grouping it without materialising the copy. Layers keep their index from the per-head
+        nn.Sequential and the state dict uses the per-head layout, so checkpoints load in either form.
+
+        @param heads: per-head nn.Sequential modules with identical structure
+        """
+        super().__init__()
+        self.num_heads = len(heads)
+        layers = []
+        # whether the features carry a head dimension yet, and whether it is still in the fused channels
+        heads_dim = False
+        fused_channels = False
+        for m, template in enumerate(heads[0]):
+            if isinstance(template, nn.Conv2d):
+                fused = nn.Conv2d(template.in_channels * (self.num_heads if heads_dim else 1),
+                                  template.out_channels * self.num_heads,
+                                  kernel_size=template.kernel_size, stride=template.stride, padding=template.padding,
+                                  groups=self.num_heads if heads_dim else 1)
+                fused.weight = nn.Parameter(torch.cat([head[m].weight.detach() for head in heads]))
+                fused.bias = nn.Parameter(torch.cat([head[m].bias.detach() for head in heads]))
+                heads_dim = True
+                fused_channels = True
+            elif isinstance(template, nn.Linear):
+                fused = StackedLinear(template.in_features, template.out_features, self.num_heads)
+                fused.weight = nn.Parameter(torch.stack([head[m].weight.detach() for head in heads]))
+                fused.bias = nn.Parameter(torch.stack([head[m].bias.detach() for head in heads]))
+                heads_dim = True
+            elif isinstance(template, nn.Flatten) and heads_dim:
+                fused = HeadFlatten(self.num_heads)
+                fused_channels = False
+            else:
+                fused = copy.deepcopy(template)
+            layers.append(fused)
+        self.layers = nn.ModuleList(layers)
+        self.heads_dim = heads_dim
+        self.fused_channels = fused_channels
+        self._register_state_dict_hook(FusedHeads._to_per_head_state_dict)
+        self._register_load_state_dict_pre_hook(FusedHeads._from_per_head_state_dict, with_module=True)
+
+    def to_heads(self) -> nn.ModuleList:
+        """
+        Convert the fused network back into a list of per-head nn.Sequential modules
+        """
+        heads = []
+        for i in range(self.num_heads):
+            head_i = []
+            for layer in self.layers:
+                if isinstance(layer, nn.Conv2d):
+                    head_i.append(nn.Conv2d(layer.in_channels // layer.groups, layer.out_channels // self.num_heads,
+                                            kernel_size=layer.kernel_size, stride=layer.stride, padding=layer.padding))
+                elif isinstance(layer, StackedLinear):
+                    head_i.append(nn.Linear(layer.in_features, layer.out_features))
+                elif isinstance(layer, HeadFlatten):
+                    head_i.append(nn.Flatten())
+                else:
+                    head_i.append(copy.deepcopy(layer))
+            heads.append(nn.Sequential(*head_i))
+        heads = nn.ModuleList(heads)
+        parameter = next(self.parameters(), None)
+        if parameter is not None:
+            heads.to(parameter.device)
+        heads.load_state_dict(self.state_dict())
+        return heads
+
+    @staticmethod
+    def _per_head_keys(module, prefix):
+        """
+        Yield (fused key, layer, per-head keys) for every parameter of the fused layers
+        """
+        for m, layer in enumerate(module.layers):
+            if isinstance(layer, (nn.Conv2d, StackedLinear)):
+                for name in ("weight", "bias"):
+                    yield (f"{prefix}layers.{m}.{name}", layer,
+                           [f"{prefix}{i}.{m}.{name}" for i in range(module.num_heads)])
+
+    @staticmethod
+    def _to_per_head_state_dict(module, state_dict, prefix, local_metadata):
+        for key, layer, head_keys in FusedHeads._per_head_keys(module, prefix):
+            value = state_dict.pop(key)
+            if isinstance(layer, nn.Conv2d):
+                value = value.chunk(module.num_heads)
+            for i, head_key in enumerate(head_keys):
+                state_dict[head_key] = value[i]
+        return state_dict
+
+    @staticmethod
+    def _from_per_head_state_dict(module, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                                  error_msgs):
+        for key, layer, head_keys in FusedHeads._per_head_keys(module, prefix):
+            if all(k in state_dict for k in head_keys):
+                values = [state_dict.pop(k) for k in head_keys]
+                state_dict[key] = torch.cat(values) if isinstance(layer, nn.Conv2d) else torch.stack(values)
+
+    def forward(self, x):
+        """
+        @param x: output of the shared backbone, shape (batch_size, ...)
+
+        @return: output tensor of shape (num_heads, batch_size, ...)
+        """
+        for layer in self.layers:
+            x = layer(x)
+        if not self.heads_dim:
+            return x.unsqueeze(0).expand(self.num_heads, *x.shape)
+        if self.fused_channels:
+            return x.reshape(x.shape[0], self.num_heads, -1, *x.shape[2:]).transpose(0, 1)
+        return x
+
+
 class VariableCNNBackbone(nn.Module):
+    # class level default so models pickled before fused heads existed still load
+    fused_heads = False
+
     def __init__(self, layer_shapes: tuple, split_idx: int, num_heads: int, kernel_size: int=3, pool_size=2, input_size=(50,50),
-                 task="patch"):
+                 task="patch", fused_heads: bool=False):
         """
         Create a NN with variable amount of shared backbone
 
@@ -18,6 +173,7 @@ class VariableCNNBackbone(nn.Module):
         @param kernel_size: kernel dimension for convolutional layers
         @param pool_size: kernel dimension for MaxPool layers
         @input_size
+        @param fused_heads: run all heads as one network of grouped convolutions and stacked linears (see FusedHeads)
 
         """
         super().__init__()
@@ -28,6 +184,7 @@ class VariableCNNBackbone(nn.Module):
         self.kernel_size = kernel_size
         self.pool_size = pool_size
         self.task = task
+        self.fused_heads = False
         assert self.split_idx <= len(self.layer_shapes), "Split index must be less than the number of layers"
         shared_backbone = []
 
@@ -101,9 +258,53 @@ class VariableCNNBackbone(nn.Module):
 
             heads.append(nn.Sequential(*head_i))
         self.heads = nn.ModuleList(heads)
+        if fused_heads:
+            self.fuse_heads()
 
-    def forward(self, x):
+    def fuse_heads(self):
+        """
+        Switch to the fused heads execution mode. The state dict layout is unchanged.
+        """
+        if not self.fused_heads:
+            self.heads = FusedHeads(self.heads)
+            self.fused_heads = True
+        return self
+
+    def unfuse_heads(self):
+        """
+        Switch back to running one nn.Sequential per head
+        """
+        if self.fused_heads:
+            self.heads = self.heads.to_heads()
+            self.fused_heads = False
+        return self
+
+    def forward(self, x, as_tensor: bool=False):
+        """
+        @param x: input tensor of shape (batch_size, 1, input_size[0], input_size[1])
+        @param as_tensor: return a single (num_heads, batch_size, ...) tensor instead of a list
+
+        @return: list of output tensors.
+        """
         x = self.shared_backbone(x)
+        if self.fused_heads:
+            outputs = self.heads(x)
+            if self.task == "patch":
+                outputs = outputs.reshape(self.num_heads, -1, 2, 3, 3)
+            return outputs if as_tensor else list(outputs.unbind(0))
+
+        if as_tensor:
+            # write the heads straight into one preallocated tensor and reshape patches once at the end
+            outputs = None
+            for i, head in enumerate(self.heads):
+                output = head(x)
+                if outputs is None:
+                    outputs = output.new_empty((self.num_heads, *output.shape))
+                outputs[i] = output
+            if self.task == "patch":
+                outputs = outputs.view(self.num_heads, -1, 2, 3, 3)
+            return outputs
+
         outputs = []
         for head in self.heads:
             if self.task == "patch":
@@ -113,7 +314,6 @@ class VariableCNNBackbone(nn.Module):
 
         return outputs
 
-
 if __name__ == "__main__":
     layer_shapes = (16, -1, 32, -1, 64, 128, 'fc512', 'fc18')
     num_heads = 5
@@ -0,0 +1,95 @@
+import time
+import torch
+import pandas as pd
+from hw4dl.models.shared_backbone import VariableBackbone
+from hw4dl.models.shared_cnn import VariableCNNBackbone
+from hw4dl.train import TOY_LAYER_SHAPES
+from hw4dl.train_cnn import TOY_LAYER_SHAPES as CNN_LAYER_SHAPES
+
+def time_forward(model, inputs, n_iters:int=200, n_warmup:int=20)->float:
+  """
+  Time the forward pass of a model
+  :param model: The model to time
+  :param inputs: The input batch
+  :param n_iters: Number of timed forward passes
+  :param n_warmup: Number of untimed forward passes run first
+  :return: Samples per second
+  """
+  with torch.no_grad():
+    for _ in range(n_warmup):
+      model(inputs)
+    if inputs.is_cuda:
+      torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(n_iters):
+      model(inputs)
+    if inputs.is_cuda:
+      torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+  return n_iters * inputs.shape[0] / elapsed
+
+def benchmark_heads(split_indexes, num_heads:int=5, batch_size:int=512, n_iters:int=200, device:str="cpu")->pd.DataFrame:
+  """
+  Compare the throughput of the per-head and stacked heads execution modes of VariableBackbone
+  :param split_indexes: The split indexes to benchmark
+  :param num_heads: Number of heads
+  :param batch_size: Batch size of the forward pass
+  :param n_iters: Number of timed forward passes per model
+  :param device: The device to run the models on
+  :return: A dataframe with the samples/sec of both modes for every split index
+  """
+  results = dict(split_idx=[], per_head=[], stacked=[], speedup=[])
+  inputs = torch.randn(batch_size, TOY_LAYER_SHAPES[0], device=device)
+  for split_idx in split_indexes:
+    model = VariableBackbone(TOY_LAYER_SHAPES, split_idx, num_heads).to(device)
+    model.eval()
+    per_head = time_forward(model, inputs, n_iters)
+    stacked = time_forward(model.stack_heads(), inputs, n_iters)
+    results["split_idx"].append(split_idx)
+    results["per_head"].append(per_head)
+    results["stacked"].append(stacked)
+    results["speedup"].append(stacked / per_head)
+  return pd.DataFrame(results)
+
+def benchmark_cnn_heads(split_indexes, task:str="pixel", num_heads:int=5, batch_size:int=1, n_iters:int=200, device:str="cpu")->pd.DataFrame:
+  """
+  Compare the throughput of the per-head and fused heads execution modes of VariableCNNBackbone
+  :param split_indexes: The split indexes to benchmark
+  :param task: "pixel" or "patch"
+  :param num_heads: Number of heads
+  :param batch_size: Batch size of the forward pass
+  :param n_iters: Number of timed forward passes per model
+  :param device: The device to run the models on
+  :return: A dataframe with the samples/sec of both modes for every split index
+  """
+  results = dict(split_idx=[], per_head=[], fused=[], speedup=[])
+  inputs = torch.randn(batch_size, 1, 15, 15, device=device)
+  for split_idx in split_indexes:
+    model = VariableCNNBackbone(CNN_LAYER_SHAPES[task], split_idx, num_heads, input_size=(15, 15), task=task).to(device)
+    model.eval()
+    per_head = time_forward(model, inputs, n_iters)
+    fused = time_forward(model.fuse_heads(), inputs, n_iters)
+    results["split_idx"].append(split_idx)
+    results["per_head"].append(per_head)
+    results["fused"].append(fused)
+    results["speedup"].append(fused / per_head)
+  return pd.DataFrame(results)
+
+if __name__ == "__main__":
+  import argparse
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--model_type", type=str, default="fc", help="one of [fc, cnn]")
+  parser.add_argument("--task", type=str, default="pixel", help="cnn task; one of [pixel, patch]")
+  parser.add_argument("--split_indexes", type=int, nargs="+", default=[0, 1, 2, 3, 4, 5])
+  parser.add_argument("--num_heads", type=int, default=5)
+  parser.add_argument("--batch_size", type=int, default=None, help="defaults to 512 for fc and 1 for cnn")
+  parser.add_argument("--n_iters", type=int, default=200)
+  parser.add_argument("--device_type", type=str, default="cpu")
+  args = parser.parse_args()
+  if args.model_type == "cnn":
+    batch_size = args.batch_size if args.batch_size is not None else 1
+    df = benchmark_cnn_heads(args.split_indexes, args.task, args.num_heads, batch_size, args.n_iters, args.device_type)
+  else:
+    batch_size = args.batch_size if args.batch_size is not None else 512
+    df = benchmark_heads(args.split_indexes, args.num_heads, batch_size, args.n_iters, args.device_type)
+  print(df.to_string(index=False))
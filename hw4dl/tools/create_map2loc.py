@@ -6,6 +6,7 @@ from tqdm import tqdm
 import sys
 from PIL import Image
 import pdb
+from hw4dl.loaders.map2loc_loader import PackedMap2LocWriter
 ROOT_DIR = "/data/vision/phillipi/perception/hw4dl_final_project"
 
 def create_map2loc(polyf, varf, dir, gaps=[], x_bounds=(-1, 1), y_bounds=(-1, 1), samples=1000, seed=1111,
@@ -133,8 +134,168 @@ def create_map2loc(polyf, varf, dir, gaps=[], x_bounds=(-1, 1), y_bounds=(-1, 1)
     df.to_csv(os.path.join(dir, 'description.csv'), index=False)
 
 
+def gap_reject_mask(x, y, gaps, patch_size=2, task="patch"):
+    """
+    Vectorized version of the gap rejection test in create_map2loc.
+
+    Parameters
+    ----------
+    x, y : np.ndarray
+        integer candidate locations
+    gaps : List[Tuple]
+        list of (x_lower, x_upper, y_lower, y_upper) gaps
+    patch_size : int
+        If task=="patch" denotes the size of the patch in each image
+    task : str
+        "pixel" or "patch"
+
+    Returns
+    -------
+    reject : np.ndarray
+        boolean mask, True for candidates create_map2loc would reject
+    """
+    reject = np.zeros(np.shape(x), dtype=bool)
+    for gap in gaps:
+        if task == "patch":
+            reject |= ((x >= gap[1]) | (x + patch_size + 1 <= gap[0])) & ((y >= gap[3]) | (y + patch_size + 1 <= gap[2]))
+        else:
+            reject |= (x >= gap[0]) & (x <= gap[1]) & (y >= gap[2]) & (y <= gap[3])
+    return reject
+
+
+def sample_map2loc_chunk(rng, polyf, varf, num_candidates, gaps=[], shape=(10, 10), patch_size=2, task="patch",
+                         limit=None):
+    """
+    Draw num_candidates locations, drop the ones create_map2loc would reject and render the rest.
+
+    Parameters
+    ----------
+    rng : np.random.Generator
+        generator the locations and the noise are drawn from
+    polyf, varf, gaps, shape, patch_size, task
+        see create_map2loc
+    num_candidates : int
+        number of candidate locations to draw. Fewer samples are returned when some land in the gaps
+    limit : int
+        keep at most this many of the accepted locations
+
+    Returns
+    -------
+    images : np.ndarray
+        uint8 array of shape (n, *shape) with the pixel/patch set to 255
+    z : np.ndarray
+        labels of shape (n,) for "pixel" or (n, patch_size + 1, patch_size + 1) for "patch"
+    x, y : np.ndarray
+        locations of the accepted samples
+    """
+    # sample candidate locations and reject the ones in the gaps
+    if task == "patch":
+        x = rng.integers(low=0, high=shape[0] - patch_size, size=num_candidates)
+        y = rng.integers(low=0, high=shape[1] - patch_size, size=num_candidates)
+    else:
+        x = rng.integers(low=0, high=shape[0], size=num_candidates)
+        y = rng.integers(low=0, high=shape[1], size=num_candidates)
+    keep = ~gap_reject_mask(x, y, gaps, patch_size, task)
+    x, y = x[keep][:limit], y[keep][:limit]
+    n = len(x)
+
+    images = np.zeros((n, *shape), dtype=np.uint8)
+    if task == "patch":
+        # label[k, i, j] is the height at (x + j, y + i), like the meshgrid in create_map2loc
+        offsets = np.arange(patch_size + 1)
+        x_inpt = (2 * (x[:, None, None] + offsets[None, None, :])) / shape[0] - 1
+        y_inpt = (2 * (y[:, None, None] + offsets[None, :, None])) / shape[1] - 1
+        rows = x[:, None, None] + offsets[None, :, None]
+        cols = y[:, None, None] + offsets[None, None, :]
+        images[np.arange(n)[:, None, None], rows, cols] = 255
+    else:
+        x_inpt = (2 * x) / shape[0] - 1
+        y_inpt = (2 * y) / shape[1] - 1
+        images[np.arange(n), x, y] = 255
+
+    # get height on map with appropriate variance added
+    var = varf(x_inpt, y_inpt)
+    if np.any(var < 0):
+        raise ValueError('variance function is negative in provided polynomial interval')
+    z = polyf(x_inpt, y_inpt) + rng.normal(loc=0, scale=np.sqrt(var))
+    return images, z, x, y
+
+
+def create_map2loc_packed(polyf, varf, dir, gaps=[], x_bounds=(-1, 1), y_bounds=(-1, 1), samples=1000, seed=1111,
+                          shape=(10, 10), patch_size=2, task="patch", chunk_size=65536, resume=False):
+    """
+    Batched version of create_map2loc that writes the packed format read by Map2Loc(..., packed=True).
+
+    Candidate locations are drawn chunk_size at a time, the gaps are applied as an array mask and the accepted
+    samples are streamed into images.bin/labels.bin. description.csv is written once at the end. Sampling semantics
+    match create_map2loc, but the random stream is consumed in a different order, so a seed gives a different dataset.
+
+    Parameters
+    ----------
+    polyf, varf, dir, gaps, x_bounds, y_bounds, samples, seed, shape, patch_size, task
+        see create_map2loc
+    chunk_size : int
+        number of candidate locations drawn per batch
+    resume : bool
+        append to the packed dataset already in dir instead of replacing it. The seed should differ from the one
+        used to create it.
+    """
+
+    # make sure gaps are in the bounds of the function
+    if len(gaps) > 0:
+        assert all(gaps[i][0] >= 0 and gaps[i][1] <= shape[1] for i in
+                   range(len(gaps))), "gaps in the x direction leave the function domain"
+        assert all(gaps[i][2] >= 0 and gaps[i][3] <= shape[1] for i in
+                   range(len(gaps))), "gaps in the y direction leave the function domain"
+        assert all(
+            gaps[i][1] > gaps[i][0] and gaps[i][3] > gaps[i][2] for i in range(len(gaps))), "invalid gap dimension"
+
+    # instantiate rng
+    rng = np.random.default_rng(seed)
+
+    label_shape = (patch_size + 1, patch_size + 1) if task == "patch" else ()
+    xs, ys, zs = [], [], []
+    gen_count = 0
+
+    with PackedMap2LocWriter(dir, shape, label_shape, np.uint8, np.float64, resume=resume) as writer, \
+            tqdm(total=samples) as pbar:
+        start_index = writer.meta["num_samples"]
+        while gen_count < samples:
+            images, z, x, y = sample_map2loc_chunk(rng, polyf, varf, chunk_size, gaps, shape, patch_size, task,
+                                                   limit=samples - gen_count)
+            n = len(x)
+            if n == 0:
+                continue
+
+            writer.append(images, z)
+            xs.append(x)
+            ys.append(y)
+            if task != "patch":
+                zs.append(z)
+
+            # update count and progress bar
+            gen_count += n
+            pbar.update(n)
+
+    # write the description table once
+    description = {'Index': np.arange(start_index, start_index + gen_count), 'X': np.concatenate(xs),
+                   'Y': np.concatenate(ys)}
+    if task != "patch":
+        description['Z'] = np.concatenate(zs)
+    df = pd.DataFrame(description)
+    csv_path = os.path.join(dir, 'description.csv')
+    df.to_csv(csv_path, index=False, mode='a' if resume and os.path.exists(csv_path) else 'w',
+              header=not (resume and os.path.exists(csv_path)))
+
+
+
 if __name__ == '__main__':
-    task = "pixel"
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--task', type=str, default="pixel", help="one of [pixel, patch]")
+    parser.add_argument('--packed', action='store_true', help="write the packed format with create_map2loc_packed")
+    args = parser.parse_args()
+    task = args.task
     dir = os.path.join(ROOT_DIR, f'hw4dl/datasets/map2loc_{task}/')
     testdir = os.path.join(ROOT_DIR, f'hw4dl/datasets/map2loc_{task}_test/')
 
@@ -144,8 +305,9 @@ if __name__ == '__main__':
     def varf(x, y):
         return 0.5 * x + 0.5 * y + 1
 
-    create_map2loc(polyf, varf, dir, gaps=[(2, 4, 2, 4), (7, 12, 7, 12)], samples=10000, shape=(15,15), patch_size=2, task=task)
-    create_map2loc(polyf, varf, testdir, gaps=[], samples=5000, shape=(15,15), patch_size=2, task=task)
+    create = create_map2loc_packed if args.packed else create_map2loc
+    create(polyf, varf, dir, gaps=[(2, 4, 2, 4), (7, 12, 7, 12)], samples=10000, shape=(15,15), patch_size=2, task=task)
+    create(polyf, varf, testdir, gaps=[], samples=5000, shape=(15,15), patch_size=2, task=task)
 
     df = pd.read_csv(os.path.join(dir, 'description.csv'))
     x = df['X'].to_numpy()
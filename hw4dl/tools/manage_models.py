@@ -28,7 +28,8 @@ def load_model(base_filepath:str):
   with open(json_path, "r") as f:
     config = json.load(f)
 
-  model = torch.load(pt_path)
+  # whole pickled modules, not just weights (the default since torch 2.6)
+  model = torch.load(pt_path, weights_only=False)
   return model, config
     
 def get_most_recent_model():
@@ -0,0 +1,10 @@
+from hw4dl.loaders.map2loc_loader import pack_map2loc
+
+if __name__ == "__main__":
+  import argparse
+  parser = argparse.ArgumentParser(description="Convert a per-file Map2Loc dataset to the packed memory-mapped format")
+  parser.add_argument("root_dir", type=str, help="directory with description.csv and the per-sample .npy files")
+  parser.add_argument("--csv_file", type=str, default="description.csv")
+  parser.add_argument("--out_dir", type=str, default=None, help="defaults to root_dir")
+  args = parser.parse_args()
+  pack_map2loc(args.root_dir, args.csv_file, args.out_dir)
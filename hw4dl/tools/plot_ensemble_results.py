@@ -3,7 +3,7 @@ import torch.nn as nn
 from hw4dl.loaders.toy_loader import PolyData
 import numpy as np 
 from hw4dl.tools.manage_models import load_model, get_most_recent_model
-from hw4dl.train import make_polyf, make_sigma_positive
+from hw4dl.train import make_polyf, reduce_ensemble
 from torch.utils.data import DataLoader
 import torch
 import os
@@ -38,15 +38,12 @@ def plot_network_performance(model:nn.Module,
   model.to(device)
   model.eval()
   model.scramble_batches = False
-  outputs = model(torch_input)
-  values = torch.stack(outputs).squeeze(-1)
+  values = model(torch_input, as_tensor=True).squeeze(-1)
   # plot network predictions
   for i in range(values.shape[0]):
     ax.plot(samples, values[i,:,0].detach().cpu().numpy(), alpha=0.5, label="_Network Prediction")
   # reduce to mean and variance
-  means = values[:,:,0].mean(dim=0)
-  sigma = make_sigma_positive(values[:,:,1]).mean(dim=0)
-  epistemic_sigma = torch.std(values[:,:,0], dim=0)
+  means, sigma, epistemic_sigma = reduce_ensemble(values)
   means = means.detach().cpu().numpy()
   sigma = sigma.detach().cpu().numpy()
   epistemic_sigma = epistemic_sigma.detach().cpu().numpy()
@@ -104,17 +101,13 @@ def plot_cnn_performance(model, test_loader, savedir,device, split_id):
     inputs[x, y] = 1
     all_inputs.append(torch.tensor(inputs))
   inputs = torch.stack(all_inputs).unsqueeze(1).type(torch.float32).to(device)
-  outputs = model(inputs)
-  values = torch.stack(outputs).squeeze(-1)
-  means = values[:, :, 0].mean(dim=0)
+  values = model(inputs, as_tensor=True).squeeze(-1)
+  means, sigma, epistemic_sigma = reduce_ensemble(values, mixture=True)
   means_arr = means.detach().cpu().numpy()
   axes[2].imshow(means_arr.reshape((15, 15)))
   axes[2].set_title("Predicted function")
 
-  sigma = torch.sqrt(
-    torch.mean(make_sigma_positive(values[:, :, 1]) + torch.square(values[:, :, 0]), dim=0) - torch.square(means))
   sigma = sigma.detach().cpu().numpy()
-  epistemic_sigma = torch.std(values[:, :, 0], dim=0)
   epistemic_sigma = epistemic_sigma.detach().cpu().numpy()
 
   axes[3].imshow(np.square(sigma).reshape((15, 15)))
@@ -137,7 +130,7 @@ if __name__ == "__main__":
   most_recent_model = get_most_recent_model()
   model, config = load_model(most_recent_model)
   polyf, varf, gaps = make_polyf(config["polyf_type"])
-  train_dataset = PolyData(polyf, varf, gaps, size=config["train_size"], seed=1111)
+  train_dataset = PolyData(polyf, varf, gaps, size=config["train_size"], seed=1111, disk_key=config["polyf_type"])
   # val_dataset = PolyData(polyf, varf, gaps, size=args.val_size, seed=2222)
   # test_dataset = PolyData(polyf, varf, gaps, size=args.test_size, seed=3333)
 
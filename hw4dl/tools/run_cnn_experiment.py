@@ -5,18 +5,23 @@ import datetime
 import sys
 from hw4dl import ROOT_DIR
 from hw4dl.main import parse_options
-from hw4dl.train_cnn import train
+from hw4dl.train_cnn import train, PROCEDURAL_SIZES
 from hw4dl.loaders.map2loc_loader import Map2Loc
+from hw4dl.loaders.procedural_map2loc import ProceduralMap2Loc
 from hw4dl.tools.manage_models import load_model
 from hw4dl.tools.score_ensemble import score_cnn_performance
 from hw4dl.tools.plot_ensemble_results import plot_cnn_performance
 import json
 import pandas as pd
+import argparse
+import matplotlib.pyplot as plt
 
 ExpConfig = namedtuple("exp_config",
                         ["name",
                          "split_indexes",
                          "task",
+                         "packed",
+                         "procedural",
                          "seed",
                          "device",
                         ])
@@ -48,59 +53,86 @@ def run_experiment(exp_config:ExpConfig):
     set_all_seeds(exp_config.seed)
     print("here2")
     # train network
-    args = argparse.Namespace(
-    device_type="cuda",
-    batch_size=16,
-    model_type='single',
-    split_idx=split_idx,
-    num_heads=5,
-    lr=1e-3,
-    n_epochs=15,
-    task=exp_config.task,
-    scramble_batches=False,
-    )
-    args.split_idx = split_idx
-    args.device_type =  exp_config.device
+    args = make_train_args(exp_config, split_idx)
     split_idx_dir= os.path.join(base_exp_path, f"split_{split_idx}")
-    os.makedirs(split_idx_dir)
 
-    train(args=args, device=torch.device(args.device_type), save_path=split_idx_dir)
-
-    model_filename = None
-    for file in os.listdir(split_idx_dir):
-      if file.endswith(".pt"):
-        model_filename = os.path.basename(file)[:-3]
-    model, config = load_model(os.path.join(split_idx_dir, model_filename))
-
-    # evaluate network performance
-    test_dataset = Map2Loc(root_dir=f'/data/vision/phillipi/perception/hw4dl_final_project/hw4dl/datasets/map2loc_{args.task}_test', csv_file='description.csv')
-    mean_mse, sigma_mse, per_correct, epi_score = score_cnn_performance(model, test_dataset, 0.01, args.device_type)
+    scores = train_and_score(args, split_idx_dir, base_exp_path)
     results["split_idx"].append(split_idx)
-    results["mean_mse"].append(mean_mse)
-    results["sigma_mse"].append(sigma_mse)
-    results["per_correct"].append(per_correct)
-    results["epi_score"].append(epi_score)
-    # print out performance
-
-    # create plot
-    plot_cnn_performance(model, test_dataset, base_exp_path, args.device_type, split_idx)
-    # fig.savefig(os.path.join(base_exp_path, f"{split_idx:03d}_performance.png"))
+    for key, value in scores.items():
+      results[key].append(value)
 
     # save results
     results_df = pd.DataFrame(results)
     results_df.to_csv(os.path.join(base_exp_path, "results.csv"), index=False)
 
+def make_train_args(exp_config:ExpConfig, split_idx:int)->argparse.Namespace:
+  """
+  Training options of one split of a CNN experiment
+  """
+  args = argparse.Namespace(
+  device_type="cuda",
+  batch_size=16,
+  eval_batch_size=4096,
+  model_type='single',
+  split_idx=split_idx,
+  num_heads=5,
+  lr=1e-3,
+  n_epochs=15,
+  task=exp_config.task,
+  scramble_batches=False,
+  packed=exp_config.packed,
+  procedural=exp_config.procedural,
+  shared_cache=False,
+  num_workers=0,
+  seed=exp_config.seed,
+  )
+  args.device_type =  exp_config.device
+  return args
+
+def train_and_score(args, split_idx_dir:str, plot_dir:str)->dict:
+  """
+  Train one network, then score and plot it on the test set
+  :param args: Training options, as returned by make_train_args
+  :param split_idx_dir: Directory to create and save the model to
+  :param plot_dir: Directory to save the performance plot to
+  :return: dict with mean_mse, sigma_mse, per_correct and epi_score
+  """
+  os.makedirs(split_idx_dir)
+
+  train(args=args, device=torch.device(args.device_type), save_path=split_idx_dir)
+
+  model_filename = None
+  for file in os.listdir(split_idx_dir):
+    if file.endswith(".pt"):
+      model_filename = os.path.basename(file)[:-3]
+  model, config = load_model(os.path.join(split_idx_dir, model_filename))
+
+  # evaluate network performance
+  if args.procedural:
+    test_dataset = ProceduralMap2Loc(args.task, PROCEDURAL_SIZES["test"], args.eval_batch_size, seed=args.seed + 2, use_gaps=False)
+  else:
+    test_dataset = Map2Loc(root_dir=f'/data/vision/phillipi/perception/hw4dl_final_project/hw4dl/datasets/map2loc_{args.task}_test', csv_file='description.csv', packed=args.packed)
+  mean_mse, sigma_mse, per_correct, epi_score = score_cnn_performance(model, test_dataset, 0.01, args.device_type)
+  # print out performance
+
+  # create plot
+  plot_cnn_performance(model, test_dataset, plot_dir, args.device_type, args.split_idx)
+  plt.close("all")
+  # fig.savefig(os.path.join(base_exp_path, f"{split_idx:03d}_performance.png"))
+  return dict(mean_mse=mean_mse, sigma_mse=sigma_mse, per_correct=per_correct, epi_score=epi_score)
+
 if __name__ == "__main__":
-  import argparse
   parser = argparse.ArgumentParser()
   parser.add_argument("--name", type=str, default="fc_experiment")
   parser.add_argument("--split_indexes", type=int, nargs="+", default=[0, 1, 2, 3])
   parser.add_argument("--seed", type=int, default=1111)
   parser.add_argument("--task", type=str, default="pixel")
   parser.add_argument("--device_type", type=str, default="cpu")
+  parser.add_argument("--packed", action="store_true", help="read the datasets from the packed format (see tools/pack_map2loc.py)")
+  parser.add_argument("--procedural", action="store_true", help="generate the datasets on the fly instead of reading them from disk")
   args = parser.parse_args()
-  exp_config = ExpConfig(name=args.name, split_indexes=args.split_indexes, seed=args.seed, task=args.task,device=args.device_type)
-  run_experiment(exp_config, exp_config)
+  exp_config = ExpConfig(name=args.name, split_indexes=args.split_indexes, seed=args.seed, task=args.task, packed=args.packed, procedural=args.procedural, device=args.device_type)
+  run_experiment(exp_config)
 
   """
   
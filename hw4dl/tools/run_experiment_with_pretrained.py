@@ -74,7 +74,7 @@ def run_experiment(exp_config:ExpConfig):
     # evaluate network performance
 
     polyf, varf, gaps = make_polyf(config["polyf_type"])
-    train_dataset = PolyData(polyf, varf, gaps, size=config["train_size"], seed=1111)
+    train_dataset = PolyData(polyf, varf, gaps, size=config["train_size"], seed=1111, disk_key=config["polyf_type"])
     mean_mse, sigma_mse, per_correct, epi_score = score_network_performance(model, train_dataset, 0.1)
     results["split_idx"].append(split_idx)
     results["mean_mse"].append(mean_mse)
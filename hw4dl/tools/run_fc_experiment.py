@@ -11,6 +11,7 @@ from hw4dl.tools.score_ensemble import score_network_performance
 from hw4dl.tools.plot_ensemble_results import plot_network_performance
 import json
 import pandas as pd 
+import matplotlib.pyplot as plt
 
 ExpConfig = namedtuple("exp_config", 
                         ["name",
@@ -57,34 +58,45 @@ def run_experiment(exp_config:ExpConfig):
     args.device_type =  exp_config.device
     args.scrambe_batches = True
     split_idx_dir= os.path.join(base_exp_path, f"split_{split_idx}")
-    os.makedirs(split_idx_dir)
 
-    train(args=args, device=torch.device(args.device_type), save_path=split_idx_dir)
-
-    model_filename = None 
-    for file in os.listdir(split_idx_dir):
-      if file.endswith(".pt"):
-        model_filename = os.path.basename(file)[:-3]
-    model, config = load_model(os.path.join(split_idx_dir, model_filename))
-    # evaluate network performance
-    polyf, varf, gaps = make_polyf(config["polyf_type"])
-    train_dataset = PolyData(polyf, varf, gaps, size=config["train_size"], seed=1111)
-    mean_mse, sigma_mse, per_correct, epi_score = score_network_performance(model, train_dataset, 0.01)
+    scores = train_and_score(args, split_idx_dir, os.path.join(base_exp_path, f"{split_idx:03d}_performance.png"))
     results["split_idx"].append(split_idx)
-    results["mean_mse"].append(mean_mse)
-    results["sigma_mse"].append(sigma_mse)
-    results["per_correct"].append(per_correct)
-    results["epi_score"].append(epi_score)
-    # print out performance 
-
-    # create plot
-    fig, ax, samples, epi_sigma = plot_network_performance(model, train_dataset)
-    fig.savefig(os.path.join(base_exp_path, f"{split_idx:03d}_performance.png"))
+    for key, value in scores.items():
+      results[key].append(value)
 
     # save results
     results_df = pd.DataFrame(results)
     results_df.to_csv(os.path.join(base_exp_path, "results.csv"), index=False)
 
+def train_and_score(args, split_idx_dir:str, plot_path:str)->dict:
+  """
+  Train one network, then score and plot it on the training distribution
+  :param args: Training options, as returned by parse_options
+  :param split_idx_dir: Directory to create and save the model to
+  :param plot_path: Path to save the performance plot to
+  :return: dict with mean_mse, sigma_mse, per_correct and epi_score
+  """
+  os.makedirs(split_idx_dir)
+
+  train(args=args, device=torch.device(args.device_type), save_path=split_idx_dir)
+
+  model_filename = None 
+  for file in os.listdir(split_idx_dir):
+    if file.endswith(".pt"):
+      model_filename = os.path.basename(file)[:-3]
+  model, config = load_model(os.path.join(split_idx_dir, model_filename))
+  # evaluate network performance
+  polyf, varf, gaps = make_polyf(config["polyf_type"])
+  train_dataset = PolyData(polyf, varf, gaps, size=config["train_size"], seed=1111, disk_key=config["polyf_type"])
+  mean_mse, sigma_mse, per_correct, epi_score = score_network_performance(model, train_dataset, 0.01)
+  # print out performance 
+
+  # create plot
+  fig, ax, samples, epi_sigma = plot_network_performance(model, train_dataset)
+  fig.savefig(plot_path)
+  plt.close(fig)
+  return dict(mean_mse=mean_mse, sigma_mse=sigma_mse, per_correct=per_correct, epi_score=epi_score)
+
 if __name__ == "__main__":
   import argparse
   parser = argparse.ArgumentParser()
@@ -0,0 +1,144 @@
+from collections import namedtuple
+import os, torch
+import copy
+import datetime
+import itertools
+import json
+import time
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+from hw4dl import ROOT_DIR
+from hw4dl.main import parse_options
+from hw4dl.tools import run_fc_experiment, run_cnn_experiment
+from hw4dl.tools.run_fc_experiment import set_all_seeds
+
+# the type name matches the module attribute so that jobs pickle to spawned workers
+SweepJob = namedtuple("SweepJob",
+                      ["split_idx",
+                       "seed",
+                       "num_heads",
+                       "lr",
+                      ])
+
+def make_grid(split_indexes, seeds, num_heads, lrs)->list:
+  """
+  Every combination of the sweep parameters, in a fixed order
+  """
+  return [SweepJob(*job) for job in itertools.product(split_indexes, seeds, num_heads, lrs)]
+
+def job_name(job:SweepJob)->str:
+  return f"split_{job.split_idx}_seed_{job.seed}_heads_{job.num_heads}_lr_{job.lr:g}"
+
+def _init_worker(num_threads:int):
+  # tiny networks gain nothing from more threads, but oversubscribing the cores costs a lot
+  torch.set_num_threads(num_threads)
+  torch.set_num_interop_threads(1)
+
+def run_job(kind:str, base_args, job:SweepJob, exp_dir:str)->dict:
+  """
+  Train and score one network of the sweep. Runs in a worker process
+  :param kind: "fc" or "cnn"
+  :param base_args: Training options shared by all jobs
+  :param job: The grid point to train
+  :param exp_dir: The sweep experiment directory
+  :return: The results row of the job
+  """
+  args = copy.copy(base_args)
+  args.split_idx, args.seed, args.num_heads, args.lr = job.split_idx, job.seed, job.num_heads, job.lr
+  # every job is seeded from its own grid point, so results do not depend on the scheduling
+  set_all_seeds(job.seed)
+  job_dir = os.path.join(exp_dir, job_name(job))
+  start = time.perf_counter()
+  if kind == "fc":
+    scores = run_fc_experiment.train_and_score(args, job_dir, os.path.join(exp_dir, f"{job_name(job)}_performance.png"))
+  elif kind == "cnn":
+    scores = run_cnn_experiment.train_and_score(args, job_dir, job_dir)
+  else:
+    raise ValueError(f"{kind} is not supported.")
+  return dict(job._asdict(), **scores, wall_time=time.perf_counter() - start)
+
+def run_sweep(name:str, kind:str, jobs:list, base_args, num_workers:int=None, threads_per_worker:int=1)->pd.DataFrame:
+  """
+  Train a grid of networks in parallel over a process pool.
+  :param name: Experiment name, the directory is timestamped like the serial experiments
+  :param kind: "fc" or "cnn"
+  :param jobs: List of SweepJob, see make_grid
+  :param base_args: Training options shared by all jobs
+  :param num_workers: Number of worker processes. Defaults to the number of cores divided by threads_per_worker
+  :param threads_per_worker: torch intra-op threads of every worker
+  :return: The results of all finished jobs. Also written to results.csv as the jobs finish
+  Produces a directory in experiments with the following structure:
+  experiments
+  |__ exp_name
+      |__ config.json
+      |__ split_0_seed_1111_heads_5_lr_0.001
+      |   |__ model.pt
+      |   |__ config.json
+      |__ results.csv
+  """
+  exp_name = name + "_" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+  base_exp_path = os.path.join(ROOT_DIR, "experiments", exp_name)
+  os.makedirs(base_exp_path)
+  with open(os.path.join(base_exp_path, "config.json"), "w") as f:
+    json.dump(dict(kind=kind, jobs=[job._asdict() for job in jobs], args=vars(base_args),
+                   threads_per_worker=threads_per_worker), f)
+
+  if num_workers is None:
+    num_workers = max(1, (os.cpu_count() or 1) // threads_per_worker)
+  results_path = os.path.join(base_exp_path, "results.csv")
+  rows = []
+  # spawn, so that workers do not inherit the thread pools (or a cuda context) of this process
+  with ProcessPoolExecutor(max_workers=min(num_workers, len(jobs)), mp_context=multiprocessing.get_context("spawn"),
+                           initializer=_init_worker, initargs=(threads_per_worker,)) as executor:
+    futures = {executor.submit(run_job, kind, base_args, job, base_exp_path): job for job in jobs}
+    for future in as_completed(futures):
+      job = futures[future]
+      try:
+        row = future.result()
+      except Exception:
+        print(f"{job_name(job)} failed:\n{traceback.format_exc()}")
+        continue
+      rows.append(row)
+      pd.DataFrame([row]).to_csv(results_path, mode="a", index=False, header=not os.path.exists(results_path))
+      print(f"Finished {job_name(job)} ({len(rows)}/{len(jobs)}) in {row['wall_time']:.1f}s")
+  return pd.DataFrame(rows)
+
+if __name__ == "__main__":
+  import argparse
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--name", type=str, default="sweep")
+  parser.add_argument("--kind", type=str, default="fc", help="one of [fc, cnn]")
+  parser.add_argument("--split_indexes", type=int, nargs="+", default=[0, 1, 2, 3, 4, 5])
+  parser.add_argument("--seeds", type=int, nargs="+", default=[1111])
+  parser.add_argument("--num_heads", type=int, nargs="+", default=[5])
+  parser.add_argument("--lrs", type=float, nargs="+", default=[1e-3])
+  parser.add_argument("--num_workers", type=int, default=None, help="defaults to cores / threads_per_worker")
+  parser.add_argument("--threads_per_worker", type=int, default=1)
+  parser.add_argument("--device_type", type=str, default="cpu")
+  parser.add_argument("--n_epochs", type=int, default=None, help="defaults to the serial experiment setting")
+  parser.add_argument("--task", type=str, default="pixel", help="cnn task; one of [pixel, patch]")
+  parser.add_argument("--packed", action="store_true", help="cnn: read the datasets from the packed format")
+  parser.add_argument("--procedural", action="store_true", help="cnn: generate the datasets on the fly")
+  parser.add_argument("--shared_cache", action="store_true", help="build every dataset once in shared memory for all jobs")
+  parser.add_argument("--disk_cache", action="store_true", help="fc: memoize the generated datasets on disk")
+  args = parser.parse_args()
+
+  if args.kind == "cnn":
+    exp_config = run_cnn_experiment.ExpConfig(name=args.name, split_indexes=args.split_indexes, task=args.task,
+                                              packed=args.packed, procedural=args.procedural, seed=args.seeds[0],
+                                              device=args.device_type)
+    base_args = run_cnn_experiment.make_train_args(exp_config, args.split_indexes[0])
+  else:
+    base_args = parse_options([])
+    base_args.device_type = args.device_type
+  base_args.shared_cache = args.shared_cache
+  if args.kind == "fc":
+    base_args.disk_cache = args.disk_cache
+  if args.n_epochs is not None:
+    base_args.n_epochs = args.n_epochs
+  jobs = make_grid(args.split_indexes, args.seeds, args.num_heads, args.lrs)
+  df = run_sweep(args.name, args.kind, jobs, base_args, args.num_workers, args.threads_per_worker)
+  if len(df) > 0:
+    print(df.sort_values(["split_idx", "seed", "num_heads", "lr"]).to_string(index=False))
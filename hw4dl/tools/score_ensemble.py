@@ -4,7 +4,8 @@ import torch.nn as nn
 from hw4dl.loaders.toy_loader import PolyData
 import numpy as np 
 from hw4dl.tools.manage_models import load_model, get_most_recent_model
-from hw4dl.train import make_polyf, make_sigma_positive
+from hw4dl.train import make_polyf, reduce_ensemble
+from hw4dl.eval_engine import EvalEngine
 from torch.utils.data import DataLoader
 from hw4dl.loaders.toy_loader import construct_intervals
 import torch
@@ -39,15 +40,11 @@ def score_network_performance(model:nn.Module,
   var = toy_loader.varf(samples)
   # ax.plot(samples, toy_loader.polyf(samples), label="True Function")
 
-  torch_input = torch.unsqueeze(torch.tensor(samples, dtype=torch.float32), 1).to(device)
+  torch_input = torch.unsqueeze(torch.tensor(samples, dtype=torch.float32), 1)
   model.to(device)
-  model.eval()
   model.scramble_batches = False
-  outputs = model(torch_input)
-  values = torch.stack(outputs).squeeze(-1)
-  means = values[:,:,0].mean(dim=0)
-  sigma = make_sigma_positive(values[:,:,1]).mean(dim=0)
-  epistemic_sigma = torch.std(values[:,:,0], dim=0)
+  values = EvalEngine(model, device).predict(torch_input).squeeze(-1)
+  means, sigma, epistemic_sigma = reduce_ensemble(values)
   epistemic_sigma = epistemic_sigma.detach().cpu().numpy()
 
   classified_data_region = epistemic_sigma < epi_threshold
@@ -83,7 +80,6 @@ def score_cnn_performance(model:nn.Module,
                              epi_threshold,
                              device,
                              )->plt.Axes:
-  model.eval()
   testx, testy = np.meshgrid(np.arange(15), np.arange(15))
   coords = []
   all_inputs = []
@@ -93,13 +89,9 @@ def score_cnn_performance(model:nn.Module,
     all_inputs.append(torch.tensor(inputs))
     coords.append((x, y))
   coords = np.array(coords)
-  inputs = torch.stack(all_inputs).unsqueeze(1).type(torch.float32).to(device)
-  outputs = model(inputs)
-  values = torch.stack(outputs).squeeze(-1)
-  means = values[:, :, 0].mean(dim=0)
-  sigma = torch.sqrt(
-    torch.mean(make_sigma_positive(values[:, :, 1]) + torch.square(values[:, :, 0]), dim=0) - torch.square(means))
-  epistemic_sigma = torch.std(values[:, :, 0], dim=0)
+  inputs = torch.stack(all_inputs).unsqueeze(1).type(torch.float32)
+  values = EvalEngine(model, device).predict(inputs).squeeze(-1)
+  means, sigma, epistemic_sigma = reduce_ensemble(values, mixture=True)
   epistemic_sigma = epistemic_sigma.detach().cpu().numpy()
   classified_data_region = epistemic_sigma < epi_threshold
 
@@ -132,6 +124,6 @@ if __name__ == "__main__":
   most_recent_model = get_most_recent_model()
   model, config = load_model(most_recent_model)
   polyf, varf, gaps = make_polyf(config["polyf_type"])
-  train_dataset = PolyData(polyf, varf, gaps, size=config["train_size"], seed=1111)
+  train_dataset = PolyData(polyf, varf, gaps, size=config["train_size"], seed=1111, disk_key=config["polyf_type"])
 
   score_network_performance(model, train_dataset, epi_threshold=0.01)
\ No newline at end of file
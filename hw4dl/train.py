@@ -1,4 +1,4 @@
-from hw4dl.loaders.toy_loader import PolyData
+from hw4dl.loaders.toy_loader import PolyData, TensorBatches
 from tqdm import tqdm
 from torch.utils.data import DataLoader
 import torch
@@ -7,9 +7,10 @@ import torch.optim as optim
 from hw4dl.models.separated_network import ToyNet
 from hw4dl.models.shared_backbone import VariableBackbone
 import numpy as np
-import datetime, json
+import datetime, json, math
 import pdb
 from hw4dl.tools.manage_models import save_model
+from hw4dl.eval_engine import EvalEngine
 from torch.distributions.normal import Normal
 layer_width = 30
 TOY_LAYER_SHAPES = [1] + [layer_width] * 5 + [2]
@@ -32,6 +33,21 @@ def make_polyf(typex):
         raise ValueError(f"{typex} is not supported.")
 def make_sigma_positive(sigma):
   return torch.log(1 + torch.exp(sigma)) + 1e-6
+
+def reduce_ensemble(values, mixture:bool=False):
+  """
+  Reduce stacked head outputs to the ensemble prediction in one pass
+  Values: num_heads x B x 2 x ... as returned by model(inputs, as_tensor=True)
+  mixture: if True the aleatoric sigma is taken from the mixture of the heads, otherwise it is the mean head sigma
+  Returns: mean, aleatoric sigma and epistemic std, each B x ...
+  """
+  epistemic_sigma, means = torch.std_mean(values[:, :, 0], dim=0)
+  sigma = make_sigma_positive(values[:, :, 1])
+  if mixture:
+    sigma = torch.sqrt(torch.mean(sigma + torch.square(values[:, :, 0]), dim=0) - torch.square(means))
+  else:
+    sigma = sigma.mean(dim=0)
+  return means, sigma, epistemic_sigma
 def nll_loss(outputs, labels):
   """
   Negative log likelihood loss
@@ -46,38 +62,51 @@ def nll_loss(outputs, labels):
   # return nn.MSELoss()(mu, labels)
   return loss.mean()
 
+def ensemble_nll_loss(outputs, labels):
+  """
+  Negative log likelihood loss of every head at once, in closed form. Equal to the sum of nll_loss over the heads
+  Outputs: H x B x 2 x ...
+  Labels: B x 1 x ... shared by all heads, or H x B x 1 x ... with one set of labels per head
+  """
+  mu, sigma = torch.split(outputs, 1, dim=2)
+  sigma = make_sigma_positive(sigma)
+  loss = torch.log(sigma) + 0.5 * torch.square((labels - mu) / sigma) + 0.5 * math.log(2 * math.pi)
+  return loss.flatten(1).mean(dim=1).sum()
+
 # def reduce_ensemble_loss(losses):
 #   aleatoric = 
 #   epistemic = 
 
 
-def eval(model, model_type, scramble_batches, loader, criterion, device):
-    model.eval()
-    total_loss = 0.0
-    for inputs, labels in tqdm(loader):
-        batch_loss = 0.0
+def eval(model, model_type, scramble_batches, dataset, criterion, device, batch_size=4096):
+    """
+    Evaluate the model on a dataset under inference mode
+    :return: Mean loss per sample, summed over heads for shared models
+    """
+    def step(model, inputs, labels):
         inputs, labels = torch.unsqueeze(inputs, 1).to(device), torch.unsqueeze(labels, 1).to(device)
-        outputs = model(inputs)
         if model_type == "shared":
-            for head_i, output in enumerate(outputs):
-                if scramble_batches:
-                  batch_loss += criterion(output, labels[:,:,head_i]) * output.shape[0]
-                else:
-                  batch_loss += criterion(output, labels) * output.shape[0]
-        else:
-            batch_loss = criterion(outputs, labels)
-        total_loss += batch_loss.item()
-    return total_loss / len(loader)
+            outputs = model(inputs, as_tensor=True)
+            if scramble_batches:
+              labels = labels.permute(2, 0, 1)
+            return ensemble_nll_loss(outputs, labels)
+        return criterion(model(inputs), labels)
+
+    batches = TensorBatches(dataset, batch_size, shuffle=False, device=device)
+    result = EvalEngine(model, device, batch_size).evaluate(batches, step)
+    print(f"Eval: {result.num_samples} samples, {result.samples_per_sec:.0f} samples/sec, peak memory {result.peak_memory_mb:.1f} MB")
+    return result.loss
 
 def train(args, device, save_path=None):
     polyf, varf, gaps = make_polyf(args.polyf_type)
-    train_dataset = PolyData(polyf, varf, gaps, size=args.train_size, seed=1111, scramble=args.scramble_batches, num_heads=args.num_heads)
-    val_dataset = PolyData(polyf, varf, gaps, size=args.val_size, seed=2222, scramble=args.scramble_batches, num_heads=args.num_heads)
-    test_dataset = PolyData(polyf, varf, gaps, size=args.test_size, seed=3333, scramble=args.scramble_batches, num_heads=args.num_heads)
+    # datasets of concurrent jobs with the same polyf_type and seed are built once and shared
+    shared_key = args.polyf_type if args.shared_cache else None
+    disk_key = args.polyf_type if args.disk_cache else None
+    train_dataset = PolyData(polyf, varf, gaps, size=args.train_size, seed=1111, scramble=args.scramble_batches, num_heads=args.num_heads, shared_key=shared_key, disk_key=disk_key)
+    val_dataset = PolyData(polyf, varf, gaps, size=args.val_size, seed=2222, scramble=args.scramble_batches, num_heads=args.num_heads, shared_key=shared_key, disk_key=disk_key)
+    test_dataset = PolyData(polyf, varf, gaps, size=args.test_size, seed=3333, scramble=args.scramble_batches, num_heads=args.num_heads, shared_key=shared_key, disk_key=disk_key)
 
-    train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=True)
-    test_loader = DataLoader(test_dataset, batch_size=args.batch_size, shuffle=True)
+    train_loader = TensorBatches(train_dataset, batch_size=args.batch_size, shuffle=True, device=device)
 
     if args.model_type == "single":
         model = ToyNet()
@@ -92,29 +121,27 @@ def train(args, device, save_path=None):
     # Training loop
     for i in range(args.n_epochs):
         model.train()
-        total_train_loss = 0.0
+        total_train_loss = torch.zeros((), device=device)
         for inputs, labels in tqdm(train_loader):
-            batch_loss = 0.0
             inputs, labels = torch.unsqueeze(inputs, 1).to(device), torch.unsqueeze(labels, 1).to(device)
             optimizer.zero_grad()
-            outputs = model(inputs)
             if args.model_type == "shared":
-                for head_i, output in enumerate(outputs):
-                    if args.scramble_batches:
-                      batch_loss += criterion(output, labels[:,:,head_i])
-                    else:
-                      batch_loss += criterion(output, labels)
+                outputs = model(inputs, as_tensor=True)
+                if args.scramble_batches:
+                  labels = labels.permute(2, 0, 1)
+                batch_loss = ensemble_nll_loss(outputs, labels)
             else:
+                outputs = model(inputs)
                 batch_loss = criterion(outputs, labels)
             batch_loss.backward()
             optimizer.step()
-            total_train_loss += batch_loss.item()
+            total_train_loss += batch_loss.detach()
 
-        train_loss = total_train_loss / len(train_loader)
-        val_loss = eval(model, args.model_type, args.scramble_batches, val_loader, criterion, device)
+        train_loss = total_train_loss.item() / len(train_loader)
+        val_loss = eval(model, args.model_type, args.scramble_batches, val_dataset, criterion, device, args.eval_batch_size)
         print(f"Epoch {i}, train loss: {train_loss}, val loss: {val_loss}")
 
-    test_loss = eval(model, args.model_type, args.scramble_batches, test_loader, criterion, device)
+    test_loss = eval(model, args.model_type, args.scramble_batches, test_dataset, criterion, device, args.eval_batch_size)
     print(f"Test loss: {test_loss}")
 
     print(f"Saving model and config")
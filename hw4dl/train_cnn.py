@@ -2,7 +2,8 @@ import sys
 # sys.path.append("/data/vision/phillipi/perception/hw4dl_final_project")
 # sys.path.append("/data/vision/phillipi/perception/hw4dl_final_project/hw4dl")
 # sys.path.append("/data/vision/phillipi/perception/hw4dl_final_project/hw4dl/datasets")
-from hw4dl.loaders.map2loc_loader import Map2Loc
+from hw4dl.loaders.map2loc_loader import Map2Loc, make_map2loc_loader
+from hw4dl.loaders.procedural_map2loc import ProceduralMap2Loc, make_procedural_loader
 from tqdm import tqdm
 from torch.utils.data import DataLoader
 import torch
@@ -14,6 +15,8 @@ import numpy as np
 import datetime, json
 import pdb
 from hw4dl.tools.manage_models import save_model
+from hw4dl.train import ensemble_nll_loss
+from hw4dl.eval_engine import EvalEngine
 from torch.distributions.normal import Normal
 
 TOY_LAYER_SHAPES = {
@@ -22,6 +25,8 @@ TOY_LAYER_SHAPES = {
 }
 PIXEL_DATASET_PATH = 'datasets/map2loc_pixel'
 PATCH_DATASET_PATH = 'datasets/map2loc_patch'
+# sizes of the pregenerated datasets after the train/val split, used for the procedural datasets
+PROCEDURAL_SIZES = dict(train=8000, val=2000, test=5000)
 
 def make_sigma_positive(sigma):
   return torch.log(1 + torch.exp(sigma)) + 1e-6
@@ -39,26 +44,24 @@ def nll_loss(outputs, labels):
 
   return loss.mean()
 
-def eval(model, loader, criterion, device):
+def eval(model, dataset, criterion, device, batch_size=4096):
     """
-    Evaluates the input model on the given test set.
+    Evaluates the input model on the given test set under inference mode.
     :param model: A model of type VariableCNNBackbone
-    :param loader: A dataloader of type Map2Loc.
+    :param dataset: A dataset of type Map2Loc or ProceduralMap2Loc.
     :param criterion: A loss object to calculate model loss
     :param device: "cuda" or "cpu"
+    :param batch_size: Evaluation batch size
     :return: Test loss calculated with the input criterion function.
     """
-    model.eval()
-    total_loss = 0.0
-    for inputs, labels in tqdm(loader):
-        batch_loss = 0.0
+    def step(model, inputs, labels):
         inputs, labels = inputs.type(torch.float32).to(device), labels.type(torch.float32).to(device)
-        outputs = model(inputs)
-        for head_i, output in enumerate(outputs):
-            batch_loss += criterion(output, labels)
+        outputs = model(inputs, as_tensor=True)
+        return criterion(outputs, labels.unsqueeze(1))
 
-        total_loss += batch_loss.item()
-    return total_loss / len(loader)
+    result = EvalEngine(model, device, batch_size).evaluate(dataset, step)
+    print(f"Eval: {result.num_samples} samples, {result.samples_per_sec:.0f} samples/sec, peak memory {result.peak_memory_mb:.1f} MB")
+    return result.loss
 
 def train(args, device, save_path=None):
     """
@@ -68,50 +71,57 @@ def train(args, device, save_path=None):
     :param save_path: Path to save checkpoints and model training results.
     :return: None
     """
-    if args.task == "pixel":
-        train_dataset = Map2Loc(root_dir=PIXEL_DATASET_PATH, csv_file='description.csv')
-        test_dataset = Map2Loc(root_dir=PIXEL_DATASET_PATH + "_test", csv_file='description.csv')
+    if args.procedural:
+        # fresh training samples every epoch, fixed validation and test samples
+        train_dataset = ProceduralMap2Loc(args.task, PROCEDURAL_SIZES["train"], args.batch_size, seed=args.seed)
+        val_dataset = ProceduralMap2Loc(args.task, PROCEDURAL_SIZES["val"], args.eval_batch_size, seed=args.seed + 1)
+        test_dataset = ProceduralMap2Loc(args.task, PROCEDURAL_SIZES["test"], args.eval_batch_size, seed=args.seed + 2,
+                                         use_gaps=False)
+        train_loader = make_procedural_loader(train_dataset, num_workers=args.num_workers)
     else:
-        train_dataset = Map2Loc(root_dir=PATCH_DATASET_PATH, csv_file='description.csv')
-        test_dataset = Map2Loc(root_dir=PATCH_DATASET_PATH + "_test", csv_file='description.csv')
+        if args.task == "pixel":
+            train_dataset = Map2Loc(root_dir=PIXEL_DATASET_PATH, csv_file='description.csv', packed=args.packed, shared=args.shared_cache)
+            test_dataset = Map2Loc(root_dir=PIXEL_DATASET_PATH + "_test", csv_file='description.csv', packed=args.packed, shared=args.shared_cache)
+        else:
+            train_dataset = Map2Loc(root_dir=PATCH_DATASET_PATH, csv_file='description.csv', packed=args.packed, shared=args.shared_cache)
+            test_dataset = Map2Loc(root_dir=PATCH_DATASET_PATH + "_test", csv_file='description.csv', packed=args.packed, shared=args.shared_cache)
 
-    train_dataset, val_dataset = torch.utils.data.random_split(train_dataset, [int(len(train_dataset) * 0.8),
-                                                                               int(len(train_dataset) * 0.2)])
+        train_dataset, val_dataset = torch.utils.data.random_split(train_dataset, [int(len(train_dataset) * 0.8),
+                                                                                   int(len(train_dataset) * 0.2)])
 
-    train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=True)
-    test_loader = DataLoader(test_dataset, batch_size=args.batch_size, shuffle=True)
+        train_loader = make_map2loc_loader(train_dataset, batch_size=args.batch_size, shuffle=True)
 
     model = VariableCNNBackbone(TOY_LAYER_SHAPES[args.task], args.split_idx, args.num_heads, input_size=(15, 15), task=args.task)
     model.to(device)
 
-    criterion = nll_loss
+    criterion = ensemble_nll_loss
     optimizer = optim.Adam(model.parameters(), lr=args.lr)
 
-    val_loss = eval(model, val_loader, criterion, device)
+    val_loss = eval(model, val_dataset, criterion, device, args.eval_batch_size)
     print("Initial val loss, ", val_loss)
     # Training loop
     for i in range(args.n_epochs):
         model.train()
-        total_train_loss = 0.0
+        if args.procedural:
+            train_dataset.set_epoch(i)
+        total_train_loss = torch.zeros((), device=device)
         for inputs, labels in tqdm(train_loader):
-            batch_loss = 0.0
             inputs = inputs.type(torch.float32).to(device)
             labels = labels.type(torch.float32).to(device)
             optimizer.zero_grad()
-            outputs = model(inputs)
-            for head_i, output in enumerate(outputs):
-                batch_loss = criterion(output, labels)
+            outputs = model(inputs, as_tensor=True)
+            # labels are B x ..., the loss expects B x 1 x ... to line up with the mean channel
+            batch_loss = criterion(outputs, labels.unsqueeze(1))
 
             batch_loss.backward()
             optimizer.step()
-            total_train_loss += batch_loss.item()
+            total_train_loss += batch_loss.detach()
 
-        train_loss = total_train_loss / len(train_loader)
-        val_loss = eval(model, val_loader, criterion, device)
+        train_loss = total_train_loss.item() / len(train_loader)
+        val_loss = eval(model, val_dataset, criterion, device, args.eval_batch_size)
         print(f"Epoch {i}, train loss: {train_loss}, val loss: {val_loss}")
 
-    test_loss = eval(model, test_loader, criterion, device)
+    test_loss = eval(model, test_dataset, criterion, device, args.eval_batch_size)
     print(f"Test loss: {test_loss}")
 
     print(f"Saving model and config")
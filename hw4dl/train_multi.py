@@ -0,0 +1,173 @@
+import copy
+import os
+import time
+from tqdm import tqdm
+import torch
+import torch.optim as optim
+from torch.func import functional_call, vmap
+from hw4dl import ROOT_DIR
+from hw4dl.loaders.toy_loader import PolyData, TensorBatches
+from hw4dl.models.shared_backbone import VariableBackbone
+from hw4dl.tools.manage_models import save_model
+from hw4dl.train import TOY_LAYER_SHAPES, make_polyf, ensemble_nll_loss
+
+
+class ModelCopies:
+  def __init__(self, models:list):
+    """
+    Runs N VariableBackbone copies with identical architecture as one vmapped model.
+
+    The copies stay ordinary modules that own their parameters: every call stacks them along a new leading
+    dimension, so gradients flow back to each copy and any optimizer (with per-copy param groups) updates them
+    like it would update the copies one by one.
+
+    :param models: list of VariableBackbone, all in the same execution mode
+    """
+    self.models = models
+    # parameterless template the stacked parameters are substituted into
+    self.template = copy.deepcopy(models[0]).to("meta")
+
+  def __len__(self):
+    return len(self.models)
+
+  def train(self):
+    for model in self.models:
+      model.train()
+
+  def eval(self):
+    for model in self.models:
+      model.eval()
+
+  def _call(self, params, x):
+    return functional_call(self.template, params, (x,), {"as_tensor": True})
+
+  def __call__(self, x):
+    """
+    @param x: input batch shared by all copies, in the layout VariableBackbone expects
+    @return: tensor of shape (num_copies, num_heads, batch_size, output_shape)
+    """
+    named = [dict(model.named_parameters()) for model in self.models]
+    params = {name: torch.stack([p[name] for p in named]) for name in named[0]}
+    return vmap(self._call, in_dims=(0, None))(params, x)
+
+
+def copies_loss(outputs, labels):
+  """
+  ensemble_nll_loss of every copy
+  Outputs: N x H x B x 2 as returned by ModelCopies
+  Labels: B x 1 shared by all copies, or H x B x 1 in scramble mode
+  Returns: N losses
+  """
+  return vmap(ensemble_nll_loss, in_dims=(0, None))(outputs, labels)
+
+
+def eval_copies(copies:ModelCopies, scramble_batches, dataset, device, batch_size=4096):
+  """
+  Evaluate all copies on a dataset under inference mode
+  :return: Tensor of N mean losses per sample
+  """
+  copies.eval()
+  total_loss = torch.zeros(len(copies), device=device, dtype=torch.float64)
+  with torch.inference_mode():
+    for inputs, labels in TensorBatches(dataset, batch_size, shuffle=False, device=device):
+      inputs, labels = torch.unsqueeze(inputs, 1), torch.unsqueeze(labels, 1)
+      if scramble_batches:
+        labels = labels.permute(2, 0, 1)
+      total_loss += copies_loss(copies(inputs), labels).double() * len(inputs)
+  return total_loss / len(dataset)
+
+
+def make_copy_args(args, seeds, lrs):
+  """
+  Training options of every copy: args with the seed and lr of the copy filled in. A single seed or lr is shared
+  by all copies.
+  """
+  num_copies = max(len(seeds), len(lrs))
+  assert len(seeds) in (1, num_copies) and len(lrs) in (1, num_copies), "seeds and lrs must have matching lengths"
+  copy_args = []
+  for i in range(num_copies):
+    args_i = copy.copy(args)
+    args_i.seed = seeds[i] if len(seeds) > 1 else seeds[0]
+    args_i.lr = lrs[i] if len(lrs) > 1 else lrs[0]
+    copy_args.append(args_i)
+  return copy_args
+
+
+def train_copies(args, device, seeds, lrs, save_path=None):
+  """
+  Train independent VariableBackbone copies with different seeds and/or learning rates in one process. All copies
+  see the same batches and are updated by one vmapped forward/backward pass per step.
+  :param args: A Namespace object, as returned by main.parse_options. Only model_type shared is supported
+  :param device: "cuda" or "cpu"
+  :param seeds: initialisation seed of every copy
+  :param lrs: learning rate of every copy
+  :param save_path: Directory to save the checkpoints to. Every copy gets its own seed_{seed}_lr_{lr} subdirectory
+   with the files save_model writes for a single model
+  :return: list of the trained models
+  """
+  assert args.model_type == "shared", "only VariableBackbone models can be trained as copies"
+  copy_args = make_copy_args(args, seeds, lrs)
+  polyf, varf, gaps = make_polyf(args.polyf_type)
+  shared_key = args.polyf_type if args.shared_cache else None
+  disk_key = args.polyf_type if args.disk_cache else None
+  train_dataset = PolyData(polyf, varf, gaps, size=args.train_size, seed=1111, scramble=args.scramble_batches, num_heads=args.num_heads, shared_key=shared_key, disk_key=disk_key)
+  val_dataset = PolyData(polyf, varf, gaps, size=args.val_size, seed=2222, scramble=args.scramble_batches, num_heads=args.num_heads, shared_key=shared_key, disk_key=disk_key)
+  test_dataset = PolyData(polyf, varf, gaps, size=args.test_size, seed=3333, scramble=args.scramble_batches, num_heads=args.num_heads, shared_key=shared_key, disk_key=disk_key)
+
+  train_loader = TensorBatches(train_dataset, batch_size=args.batch_size, shuffle=True, device=device)
+
+  models = []
+  for args_i in copy_args:
+    torch.manual_seed(args_i.seed)
+    model = VariableBackbone(TOY_LAYER_SHAPES, args.split_idx, args.num_heads, args.scramble_batches)
+    models.append(model.to(device).stack_heads())
+  copies = ModelCopies(models)
+
+  optimizer = optim.Adam([dict(params=model.parameters(), lr=args_i.lr) for model, args_i in zip(models, copy_args)])
+
+  # Training loop
+  for i in range(args.n_epochs):
+    copies.train()
+    total_train_loss = torch.zeros(len(copies), device=device)
+    for inputs, labels in tqdm(train_loader):
+      inputs, labels = torch.unsqueeze(inputs, 1), torch.unsqueeze(labels, 1)
+      if args.scramble_batches:
+        labels = labels.permute(2, 0, 1)
+      optimizer.zero_grad()
+      batch_loss = copies_loss(copies(inputs), labels)
+      # the copies share no parameters, so the gradient of the sum is the gradient of every copy's own loss
+      batch_loss.sum().backward()
+      optimizer.step()
+      total_train_loss += batch_loss.detach()
+
+    train_loss = (total_train_loss / len(train_loader)).tolist()
+    val_loss = eval_copies(copies, args.scramble_batches, val_dataset, device, args.eval_batch_size).tolist()
+    print(f"Epoch {i}, train loss: {train_loss}, val loss: {val_loss}")
+
+  test_loss = eval_copies(copies, args.scramble_batches, test_dataset, device, args.eval_batch_size).tolist()
+  print(f"Test loss: {test_loss}")
+
+  print(f"Saving models and configs")
+  base_dir = save_path if save_path is not None else os.path.join(ROOT_DIR, "weights")
+  for model, args_i, test_loss_i in zip(models, copy_args, test_loss):
+    copy_dir = os.path.join(base_dir, f"seed_{args_i.seed}_lr_{args_i.lr:g}")
+    os.makedirs(copy_dir, exist_ok=True)
+    # saved in the per-head layout, like train.train
+    save_model(model.unstack_heads(), dict(test_loss=test_loss_i), args_i, save_dir=copy_dir)
+
+  print("Done :)")
+  return models
+
+
+if __name__ == '__main__':
+  from hw4dl.main import make_parser
+  parser = make_parser()
+  parser.add_argument('--seeds', type=int, nargs="+", default=[1111], help="initialisation seed of every copy")
+  parser.add_argument('--lrs', type=float, nargs="+", default=None, help="learning rate of every copy; defaults to --lr")
+  args = parser.parse_args()
+  seeds, lrs = args.seeds, args.lrs if args.lrs is not None else [args.lr]
+  del args.seeds, args.lrs
+  device = torch.device("cuda" if args.device_type == "cuda" and torch.cuda.is_available() else "cpu")
+  start = time.perf_counter()
+  train_copies(args, device, seeds, lrs)
+  print(f"Trained {max(len(seeds), len(lrs))} copies in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,61 @@
+import os
+import glob
+import shutil
+import subprocess
+from pathlib import Path
+
+from scheduler import input_hash
+
+# directory of a design holding one directory of accelergy outputs per arch and components hash
+TABLES_DIR = 'accelergy'
+TABLE_FILES = ['ERT.yaml', 'ART.yaml']
+
+# tables of every design looked up by this process, None for designs accelergy failed on
+_tables = {}
+
+
+def arch_paths(timeloop_dir, design):
+    return [str(timeloop_dir / 'arch' / f'{design}.yaml'), *sorted(glob.glob(str(timeloop_dir / 'arch/components/*.yaml')))]
+
+
+def design_tables(timeloop_dir, design):
+    """
+    Energy and area reference tables of a design, generated by accelergy the first time they are needed and
+    reused by every mapper run on the same arch and components. Given to timeloop, they replace the accelergy
+    run it would otherwise do for every layer.
+    Parameters
+    ----------
+    timeloop_dir : Path
+        directory of the design with the arch directory
+    Returns the paths of the ERT and ART files, None if accelergy is not available
+    """
+    timeloop_dir = Path(timeloop_dir)
+    paths = arch_paths(timeloop_dir, design)
+    out_dir = timeloop_dir / TABLES_DIR / input_hash(paths)[:16]
+    if out_dir not in _tables:
+        _tables[out_dir] = _generate_tables(paths, out_dir, design)
+    return _tables[out_dir]
+
+
+def _generate_tables(paths, out_dir, design):
+    tables = [str(out_dir / file) for file in TABLE_FILES]
+    if all(os.path.exists(table) for table in tables):
+        return tables
+
+    # generate under a private name and rename, so a partial run is never reused
+    tmp_dir = out_dir.with_name(f'{out_dir.name}.tmp-{os.getpid()}')
+    os.makedirs(tmp_dir, exist_ok=True)
+    try:
+        with open(tmp_dir / 'accelergy.out', 'w') as out:
+            subprocess.run(['accelergy', *paths, '-o', str(tmp_dir)], stdout=out, stderr=subprocess.STDOUT, check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f'accelergy tables of {design} not generated ({e}), every mapper run invokes accelergy')
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return None
+    if not all(os.path.exists(tmp_dir / file) for file in TABLE_FILES):
+        print(f'accelergy did not write {TABLE_FILES} for {design}, every mapper run invokes accelergy')
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return None
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+    return tables
@@ -4,93 +4,67 @@ import os
 import seaborn as sns
 import pandas as pd
 import matplotlib.pyplot as plt
-import re
+from workload_store import WorkloadStore, result_dir, RESULTS_DIR, ESTIMATES_DIR
+from timeloop_stats import load_results
+from design_generator import DESIGNS_DIR, SPEC_FILE
+from warm_start import arch_pes
+
+
+def design_pes(base_dir, design):
+    """
+    Number of PEs of a design, from the parameters of a generated design or from the arch of a hand written one
+    """
+    design_dir = os.path.join(base_dir, DESIGNS_DIR, design)
+    if os.path.exists(os.path.join(design_dir, SPEC_FILE)):
+        with open(os.path.join(design_dir, SPEC_FILE), 'r') as f:
+            return int(yaml.safe_load(f)['params']['pes'])
+    with open(os.path.join(design_dir, 'arch', f'{design}.yaml'), 'r') as f:
+        return arch_pes(yaml.safe_load(f)['architecture'])
 
 
 def aggregate(args, params):
     designs = []
-    for design in os.listdir(os.path.join(args.base_dir, 'timeloop_results')):
+    for design in os.listdir(os.path.join(args.base_dir, DESIGNS_DIR)):
         if args.design in design:
             designs.append(design)
-    total_energy, total_cycles, total_energy_per, total_ifmap_spad, total_en = {}, {}, {}, {}, {}
-    for design in designs:
-        pes = re.findall(r'\d+', design)[0]
-        timeloop_dir = os.path.join('timeloop_results', design)
-        sub_dir = args.model_type
+    # Totals are keyed by design, variants of a design with the same PE count are kept apart
+    total_energy, total_cycles, total_energy_per, total_ifmap_spad, total_en, pes = {}, {}, {}, {}, {}, {}
 
-        param_dir = get_param_name(args.model_type, params)
-        layer_dir = os.path.join(args.base_dir, args.top_dir, sub_dir)
-        if param_dir:
-            layer_dir = os.path.join(layer_dir, param_dir)
-        layer_files = os.listdir(layer_dir)
+    # Resolve the layers of the config to stored problems, shared by all designs
+    sub_dir = args.model_type
+    param_dir = get_param_name(args.model_type, params)
+    store = WorkloadStore(args.base_dir)
+    try:
+        manifest = store.manifest(sub_dir, param_dir)
+    except FileNotFoundError:
+        manifest = store.index(sub_dir, param_dir, os.path.join(args.base_dir, args.top_dir, sub_dir, param_dir))
+    problems = store.counts(manifest)
 
-        # Gather layers recorded in Timeloop
-        layer_info = {}
-        for file in os.listdir(os.path.join(args.base_dir, timeloop_dir, sub_dir, param_dir)):
-            with open(os.path.join(layer_dir, file+'.yaml'), 'r') as fid:
-                layer_dict = yaml.safe_load(fid)
-                idx = int(file.replace('layer', ''))
-                layer_info[idx] = {
-                    'layer_dict': layer_dict,
-                    'num': 1
-                }
-
-        # Get duplicated layer info
-        for idx, file in enumerate(layer_files):
-            with open(os.path.join(layer_dir, file), 'r') as fid:
-                layer_dict = yaml.safe_load(fid)
-                for layer_id, info in layer_info.items():
-                    if info['layer_dict'] == layer_dict:
-                        layer_info[layer_id]['num'] += 1
+    for design in designs:
+        pes[design] = design_pes(args.base_dir, design)
+        timeloop_dir = os.path.join(DESIGNS_DIR, design)
 
         total_energy_design, total_cycles_design, total_energy_per_design, total_ifmap_spad_design, total_en_design = 0, 0, 0, 0, 0
-        for layer_id in layer_info.keys():
-            with open(os.path.join(args.base_dir, timeloop_dir, sub_dir, param_dir, f'layer{layer_id}', f'timeloop-mapper.stats.txt'), 'r') as fid:
-                # Read last 30 lines
-                whole_file = fid.read()
-                lines = whole_file.split('\n')[-30:]
-                for line in lines:
-                    if line.startswith('Energy'):
-                        energy = line.split(': ')[1].split(' ')[0]
-                        total_energy_design += eval(energy)*layer_info[layer_id]['num']
-                        layer_info[layer_id]['energy'] = eval(energy)
-                    elif line.startswith('    Total'):
-                        energy_per = line.split('= ')[1].split(' ')[0]
-                        total_energy_per_design += eval(energy_per)*layer_info[layer_id]['num']
-                        layer_info[layer_id]['energy_per'] = eval(energy_per)
-                    elif line.startswith('    ifmap_spad'):
-                        ifmap_spad = line.split('= ')[1].split(' ')[0]
-                        total_ifmap_spad_design += eval(ifmap_spad)*layer_info[layer_id]['num']
-                        layer_info[layer_id]['ifmap_spad'] = ifmap_spad
-                    elif line.startswith('Cycles'):
-                        cycle = line.split(': ')[1]
-                        total_cycles_design += eval(cycle)*layer_info[layer_id]['num']
-                        layer_info[layer_id]['cycle'] = eval(cycle)
-                    elif line.startswith('GFLOPs'):
-                        gflops = line.split(': ')[1]
-                        layer_info[layer_id]['gflops'] = eval(gflops)
-                    elif line.startswith('Utilization'):
-                        ut = line.split(': ')[1]
-                        layer_info[layer_id]['utilization'] = eval(ut)
-
-                en = whole_file.split('\n')[160:175]
-                for line in en:
-                    if line.startswith('        Energy (total)'):
-                        energy_en = line.split(': ')[1].split(' ')[0]
-                        total_en_design += eval(energy_en)*layer_info[layer_id]['num']
+        for key, num in problems.items():
+            stats = load_results(result_dir(args.base_dir, timeloop_dir, key, args.results))
+            total_energy_design += stats.get('energy', 0)*num
+            total_energy_per_design += stats.get('energy_per', 0)*num
+            total_ifmap_spad_design += stats.get('ifmap_spad', 0)*num
+            total_cycles_design += stats.get('cycle', 0)*num
+            total_en_design += stats['energy_en']*num
 
         print('%f uJ Energy' % total_energy_design)
         print('%f pJ Energy Per' % total_energy_per_design)
         print('%d Cycles' % total_cycles_design)
         print("%f IFMAP" % total_ifmap_spad_design)
         print('%f Energy En' % total_en_design)
-        total_energy[pes] = total_energy_design
-        total_cycles[pes] = total_cycles_design
-        total_energy_per[pes] = total_energy_per_design
-        total_ifmap_spad[pes] = total_ifmap_spad_design
-        total_en[pes] = total_en_design
+        total_energy[design] = total_energy_design
+        total_cycles[design] = total_cycles_design
+        total_energy_per[design] = total_energy_per_design
+        total_ifmap_spad[design] = total_ifmap_spad_design
+        total_en[design] = total_en_design
 
-    return total_energy, total_cycles, total_energy_per, total_ifmap_spad, total_en
+    return total_energy, total_cycles, total_energy_per, total_ifmap_spad, total_en, pes
 
 
 def plot(args, config_dir, performance_csv):
@@ -105,7 +79,8 @@ def plot(args, config_dir, performance_csv):
         'energy per': [],
         'ifmap spad': [],
         'energy en': [],
-        'pes': []
+        'pes': [],
+        'design': []
     }
     for config in os.listdir(config_dir):
         if 'serial' in config:
@@ -116,7 +91,7 @@ def plot(args, config_dir, performance_csv):
             continue
         with open(f"{config_dir}/{config}", 'r') as f:
             config_file = yaml.safe_load(f)
-        total_energy, total_cycles, total_energy_per, total_ifmap_spad, total_en = aggregate(args, config_file)
+        total_energy, total_cycles, total_energy_per, total_ifmap_spad, total_en, pes = aggregate(args, config_file)
         for key in total_energy.keys():
             #print(perform_results)
             results['backbone size'].append(config_file['split_idx'])
@@ -126,13 +101,16 @@ def plot(args, config_dir, performance_csv):
             results['process'].append(process)
             results['energy per'].append(total_energy_per[key])
             results['ifmap spad'].append(total_ifmap_spad[key])
-            results['pes'].append(key)
+            results['pes'].append(pes[key])
+            results['design'].append(key)
             results['energy en'].append(total_en[key])
 
     # Plot
     df = pd.DataFrame.from_dict(results)
     df['pes'] = df['pes'].astype('int')
     print(df)
+    # Heatmap rows are PE counts, or designs once several designs share a PE count
+    rows = 'pes' if df.groupby('pes')['design'].nunique().max() == 1 else 'design'
     # Energy vs. backbone size
     energy_backbone = sns.lmplot(
         data=df[df['pes']==168], x='backbone size', y='energy', hue='process', order=3, hue_order=['Serial', 'Parallel']
@@ -198,11 +176,11 @@ def plot(args, config_dir, performance_csv):
     df_serial = df[df['process'] == 'Serial']
     print(df_serial)
     backbone_pes_energy = sns.heatmap(
-        data=df_serial.pivot(index='pes', columns='backbone size', values='energy'),
+        data=df_serial.pivot(index=rows, columns='backbone size', values='energy'),
         annot=True, fmt='.1f'
     )
     plt.xlabel('Backbone size (number of layers)')
-    plt.ylabel('Number of PEs')
+    plt.ylabel('Number of PEs' if rows == 'pes' else 'Design')
     if 'VariableCNNBackbone' in config_dir:
         plt.title('Serial Variable CNN Backbone Size vs. Number of PEs vs. Energy')
     elif 'VariableBackbone' in config_dir:
@@ -213,11 +191,11 @@ def plot(args, config_dir, performance_csv):
     df_serial = df[df['process'] == 'Serial']
     print(df_serial)
     backbone_pes_energy = sns.heatmap(
-        data=df_serial.pivot(index='pes', columns='backbone size', values='energy en'),
+        data=df_serial.pivot(index=rows, columns='backbone size', values='energy en'),
         annot=True, fmt='.1f'
     )
     plt.xlabel('Backbone size (number of layers)')
-    plt.ylabel('Number of PEs')
+    plt.ylabel('Number of PEs' if rows == 'pes' else 'Design')
     if 'VariableCNNBackbone' in config_dir:
         plt.title('Serial Variable CNN Backbone Size vs. Number of PEs vs. Energy')
     elif 'VariableBackbone' in config_dir:
@@ -228,11 +206,11 @@ def plot(args, config_dir, performance_csv):
     df_serial = df[df['process'] == 'Serial']
     print(df_serial)
     backbone_pes_energy = sns.heatmap(
-        data=df_serial.pivot(index='pes', columns='backbone size', values='energy per'),
+        data=df_serial.pivot(index=rows, columns='backbone size', values='energy per'),
         annot=True, fmt='.1f', annot_kws={'size': 7}
     )
     plt.xlabel('Backbone size (number of layers)')
-    plt.ylabel('Number of PEs')
+    plt.ylabel('Number of PEs' if rows == 'pes' else 'Design')
     if 'VariableCNNBackbone' in config_dir:
         plt.title('Serial Variable CNN Backbone Size vs. Number of PEs vs. Energy')
     elif 'VariableBackbone' in config_dir:
@@ -243,11 +221,11 @@ def plot(args, config_dir, performance_csv):
     df_serial = df[df['process'] == 'Serial']
     print(df_serial)
     backbone_pes_energy = sns.heatmap(
-        data=df_serial.pivot(index='pes', columns='backbone size', values='ifmap spad'),
+        data=df_serial.pivot(index=rows, columns='backbone size', values='ifmap spad'),
         annot=True, fmt='.1f', annot_kws={'size': 7}
     )
     plt.xlabel('Backbone size (number of layers)')
-    plt.ylabel('Number of PEs')
+    plt.ylabel('Number of PEs' if rows == 'pes' else 'Design')
     if 'VariableCNNBackbone' in config_dir:
         plt.title('Serial Variable CNN Backbone Size vs. Number of PEs vs. ifmap spad pJ/Compute')
     elif 'VariableBackbone' in config_dir:
@@ -258,11 +236,11 @@ def plot(args, config_dir, performance_csv):
     df_parallel = df[df['process'] == 'Parallel']
     print(df_parallel)
     backbone_pes_energy = sns.heatmap(
-        data=df_parallel.pivot(index='pes', columns='backbone size', values='energy'),
+        data=df_parallel.pivot(index=rows, columns='backbone size', values='energy'),
         annot=True, fmt='.1f'
     )
     plt.xlabel('Backbone size (number of layers)')
-    plt.ylabel('Number of PEs')
+    plt.ylabel('Number of PEs' if rows == 'pes' else 'Design')
     if 'VariableCNNBackbone' in config_dir:
         plt.title('Parallel Variable CNN Backbone Size vs. Number of PEs vs. Energy')
     elif 'VariableBackbone' in config_dir:
@@ -273,11 +251,11 @@ def plot(args, config_dir, performance_csv):
     df_parallel = df[df['process'] == 'Parallel']
     print(df_parallel)
     backbone_pes_energy = sns.heatmap(
-        data=df_parallel.pivot(index='pes', columns='backbone size', values='energy per'),
+        data=df_parallel.pivot(index=rows, columns='backbone size', values='energy per'),
         annot=True, fmt='.1f', annot_kws={'size': 7}
     )
     plt.xlabel('Backbone size (number of layers)')
-    plt.ylabel('Number of PEs')
+    plt.ylabel('Number of PEs' if rows == 'pes' else 'Design')
     if 'VariableCNNBackbone' in config_dir:
         plt.title('Parallel Variable CNN Backbone Size vs. Number of PEs vs. Energy')
     elif 'VariableBackbone' in config_dir:
@@ -288,11 +266,11 @@ def plot(args, config_dir, performance_csv):
     df_parallel = df[df['process'] == 'Parallel']
     print(df_parallel)
     backbone_pes_energy = sns.heatmap(
-        data=df_parallel.pivot(index='pes', columns='backbone size', values='ifmap spad'),
+        data=df_parallel.pivot(index=rows, columns='backbone size', values='ifmap spad'),
         annot=True, fmt='.1f', annot_kws={'size': 7}
     )
     plt.xlabel('Backbone size (number of layers)')
-    plt.ylabel('Number of PEs')
+    plt.ylabel('Number of PEs' if rows == 'pes' else 'Design')
     if 'VariableCNNBackbone' in config_dir:
         plt.title('Parallel Variable CNN Backbone Size vs. Number of PEs vs. ifmap spad pJ/Compute')
     elif 'VariableBackbone' in config_dir:
@@ -302,11 +280,11 @@ def plot(args, config_dir, performance_csv):
     plt.clf()
     df_serial = df[df['process'] == 'Serial']
     backbone_pes_cycles = sns.heatmap(
-        data=df_serial.pivot(index='pes', columns='backbone size', values='cycles'),
+        data=df_serial.pivot(index=rows, columns='backbone size', values='cycles'),
         annot=True, fmt='.0f'
     )
     plt.xlabel('Backbone size (number of layers)')
-    plt.ylabel('Number of PEs')
+    plt.ylabel('Number of PEs' if rows == 'pes' else 'Design')
     if 'VariableCNNBackbone' in config_dir:
         plt.title('Serial Variable CNN Backbone Size vs. Number of PEs vs. Number of Cycles')
     elif 'VariableBackbone' in config_dir:
@@ -316,11 +294,11 @@ def plot(args, config_dir, performance_csv):
     plt.clf()
     df_parallel = df[df['process'] == 'Parallel']
     backbone_pes_cycles = sns.heatmap(
-        data=df_parallel.pivot(index='pes', columns='backbone size', values='cycles'),
+        data=df_parallel.pivot(index=rows, columns='backbone size', values='cycles'),
         annot=True, fmt='.0f'
     )
     plt.xlabel('Backbone size (number of layers)')
-    plt.ylabel('Number of PEs')
+    plt.ylabel('Number of PEs' if rows == 'pes' else 'Design')
     if 'VariableCNNBackbone' in config_dir:
         plt.title('Parallel Variable CNN Backbone Size vs. Number of PEs vs. Number of Cycles')
     elif 'VariableBackbone' in config_dir:
@@ -350,6 +328,7 @@ def parse_options():
     parser.add_argument('--performance_csv', type=str, default="performance_results", help="CSV file of performance")
     parser.add_argument('--design', type=str, default="eyeriss_like", help="Architecture design")
     parser.add_argument('--model_type', type=str, default="VariableBackbone", help="Name of model")
+    parser.add_argument('--results', type=str, default=RESULTS_DIR, choices=[RESULTS_DIR, ESTIMATES_DIR], help="Aggregate the mapper results or the analytic estimates of profiler.py --backend=analytic")
     return parser.parse_args()
 
 
@@ -9,9 +9,38 @@ from yaml.loader import SafeLoader
 import re
 import argparse
 import torch
+import collections
+import contextlib
+import glob
+import hashlib
+import io
+import json
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+
+def build_net(make_net, device, static):
+    """
+    Build a network for conversion. The static converter only needs the module structure, so the network is
+    built on the meta device without allocating or initializing any weights.
+    """
+    if static:
+        with torch.device('meta'):
+            return make_net()
+    return make_net().to(device)
+
+
+def check_static_conversion(net, input_shape):
+    """
+    Cross-check the static shape inference against the traced forward pass for a network built on a real device
+    """
+    static = pytorch2timeloop.converter_pytorch.extract_layer_data(net, input_shape, True, [], static=True)
+    traced = pytorch2timeloop.converter_pytorch.extract_layer_data(net, input_shape, True, [], static=False)
+    assert static == traced, "static and traced layer data differ:\n%s\n%s" % (static, traced)
 
 
-def convert_VariableBackbone(net_params, device, top_dir, model_name, mode=None, params=None):
+def convert_VariableBackbone(net_params, device, top_dir, model_name, mode=None, params=None, static=True):
     """
     Function to convert the VariableBackbone model to timeloop problem descriptions
     Parameters
@@ -25,6 +54,8 @@ def convert_VariableBackbone(net_params, device, top_dir, model_name, mode=None,
         path to directory with all layer shape directories
     mode : str
         choose 'serial' or 'parallel'
+    static : bool
+        infer the layer shapes from the configuration instead of tracing a forward pass
     """
 
     assert mode in ['serial', 'parallel'], "mode must be one of 'serial' or 'parallel'"
@@ -38,7 +69,7 @@ def convert_VariableBackbone(net_params, device, top_dir, model_name, mode=None,
         raise ValueError("If only one head, don't use the mode argument.")
 
     # make network
-    net = VariableBackbone(layer_shapes, split_idx, num_heads).to(device)
+    net = build_net(lambda: VariableBackbone(layer_shapes, split_idx, num_heads), device, static)
 
     # pytorch2timeloop
     sub_dir = 'VariableBackbone'
@@ -46,7 +77,7 @@ def convert_VariableBackbone(net_params, device, top_dir, model_name, mode=None,
     batch_size = 1
     convert_fc = True
     exception_module_names = []
-    pytorch2timeloop.convert_model(net, input_shape, batch_size, sub_dir, top_dir, convert_fc, exception_module_names, params)
+    pytorch2timeloop.convert_model(net, input_shape, batch_size, sub_dir, top_dir, convert_fc, exception_module_names, params, static)
 
     if mode == 'parallel':
         workloads_per_head = (len(layer_shapes) - 1) - split_idx
@@ -89,7 +120,7 @@ def convert_VariableBackbone(net_params, device, top_dir, model_name, mode=None,
         return
 
 
-def convert_VariableCNNBackbone(net_params, device, top_dir, model_name, mode=None, params=None):
+def convert_VariableCNNBackbone(net_params, device, top_dir, model_name, mode=None, params=None, static=True):
     """
     Function to convert the VariableBackbone model to timeloop problem descriptions
     Parameters
@@ -103,6 +134,8 @@ def convert_VariableCNNBackbone(net_params, device, top_dir, model_name, mode=No
         path to directory with all layer shape directories
     mode : str
         choose 'serial' or 'parallel'
+    static : bool
+        infer the layer shapes from the configuration instead of tracing a forward pass
     """
 
     assert mode in ['serial', 'parallel'], "mode must be one of 'serial' or 'parallel'"
@@ -117,7 +150,7 @@ def convert_VariableCNNBackbone(net_params, device, top_dir, model_name, mode=No
 
     # make network
     print(layer_shapes)
-    net = VariableCNNBackbone(layer_shapes, split_idx, num_heads, input_size=(10,10), task='pixel').to(device)
+    net = build_net(lambda: VariableCNNBackbone(layer_shapes, split_idx, num_heads, input_size=(10,10), task='pixel'), device, static)
     print(net)
 
     # pytorch2timeloop
@@ -127,7 +160,7 @@ def convert_VariableCNNBackbone(net_params, device, top_dir, model_name, mode=No
     convert_fc = True
     exception_module_names = []
 
-    pytorch2timeloop.convert_model(net, input_shape, batch_size, sub_dir, top_dir, convert_fc, exception_module_names, params)
+    pytorch2timeloop.convert_model(net, input_shape, batch_size, sub_dir, top_dir, convert_fc, exception_module_names, params, static)
 
     if mode == 'parallel':
         workloads_per_head = len([i for i in layer_shapes if i != -1]) - split_idx
@@ -170,7 +203,7 @@ def convert_VariableCNNBackbone(net_params, device, top_dir, model_name, mode=No
         return
 
 
-def convert_ToyNet(net_params, device, top_dir, params=None):
+def convert_ToyNet(net_params, device, top_dir, params=None, static=True):
     """
     Function to convert the ToyNet model to timeloop problem descriptions
     Parameters
@@ -182,6 +215,8 @@ def convert_ToyNet(net_params, device, top_dir, params=None):
         device to put the model on
     top_dir : str
         path to directory with all layer shape directories
+    static : bool
+        infer the layer shapes from the configuration instead of tracing a forward pass
     """
 
     # extract parameters
@@ -189,7 +224,7 @@ def convert_ToyNet(net_params, device, top_dir, params=None):
     layer_shapes = net_params['layer_shapes']
 
     # make network
-    net = ToyNet(num_layers, layer_shapes).to(device)
+    net = build_net(lambda: ToyNet(num_layers, layer_shapes), device, static)
 
     # pytorch2timeloop
     sub_dir = 'ToyNet'
@@ -197,7 +232,7 @@ def convert_ToyNet(net_params, device, top_dir, params=None):
     batch_size = 1
     convert_fc = True
     exception_module_names = []
-    pytorch2timeloop.convert_model(net, input_shape, batch_size, sub_dir, top_dir, convert_fc, exception_module_names, params)
+    pytorch2timeloop.convert_model(net, input_shape, batch_size, sub_dir, top_dir, convert_fc, exception_module_names, params, static)
 
 
 def get_param_name(model_name, params):
@@ -211,12 +246,137 @@ def get_param_name(model_name, params):
     return name
 
 
+MODEL_TYPES = ['ToyNet', 'VariableBackbone', 'VariableCNNBackbone']
+# stamps of the configs the layer directories were converted from, kept out of the layer directories that
+# the profiler lists
+HASH_DIR = '.hashes'
+
+
+def config_hash(params, model_type, static):
+    """
+    Hash of everything that determines the converted problem files of a config
+    """
+    key = json.dumps(dict(params=params, model_type=model_type, static=static), sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def infer_model_type(config_path, default):
+    """
+    Model type of a config from its location: configs/<model_type>/*.yaml or configs/ToyNet.yaml
+    """
+    for name in [os.path.basename(os.path.dirname(os.path.abspath(config_path))),
+                 os.path.splitext(os.path.basename(config_path))[0]]:
+        if name in MODEL_TYPES:
+            return name
+    return default
+
+
+def find_configs(pattern):
+    """
+    Config files of a directory (searched recursively), a glob pattern or a single file
+    """
+    if os.path.isdir(pattern):
+        return sorted(glob.glob(os.path.join(pattern, '**', '*.yaml'), recursive=True))
+    return sorted(glob.glob(pattern))
+
+
+def convert_config(config_path, model_type, top_dir, device, static=True, check_static=False):
+    """
+    Convert one config file to timeloop problem descriptions in top_dir/<model_type>/<param name>
+    """
+    with open(config_path, 'r') as f:
+        params = yaml.safe_load(f)
+
+    if check_static:
+        if model_type == 'ToyNet':
+            check_static_conversion(ToyNet(params['num_layers'], params['layer_shapes']), (1, 1, 1))
+        elif model_type == 'VariableBackbone':
+            check_static_conversion(VariableBackbone(params['layer_shapes'], params['split_idx'], params['num_heads']), (1, 1, 1))
+        elif model_type == 'VariableCNNBackbone':
+            check_static_conversion(VariableCNNBackbone(params['layer_shapes'], params['split_idx'], params['num_heads'], input_size=(10,10), task='pixel'), (1, 10, 10))
+        print("static shapes match the traced forward pass")
+
+    if model_type == 'ToyNet':
+        convert_ToyNet(params, device, top_dir, params=params, static=static)
+    elif model_type == 'VariableBackbone':
+        convert_VariableBackbone(params, device, top_dir, model_type, mode=params['mode'], params=params, static=static)
+    elif model_type == 'VariableCNNBackbone':
+        convert_VariableCNNBackbone(params, device, top_dir, model_type, mode=params['mode'], params=params, static=static)
+    else:
+        raise ValueError(f"{model_type} is not supported.")
+
+
+def convert_config_if_stale(config_path, model_type, top_dir, static=True, check_static=False, force=False):
+    """
+    Convert a config unless its output directory was produced from an identical config, with the converter
+    output captured.
+    Returns a summary dict with the config, model type, status (converted, up-to-date or failed), number of problem
+    files, time and converter output.
+    """
+    start = time.perf_counter()
+    summary = dict(config=config_path, model_type=model_type, status='converted', layers=0, seconds=0.0, log='')
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log):
+            with open(config_path, 'r') as f:
+                params = yaml.safe_load(f)
+            param_name = get_param_name(model_type, params)
+            out_dir = os.path.join(top_dir, model_type, param_name)
+            digest = config_hash(params, model_type, static)
+            hash_path = os.path.join(top_dir, model_type, HASH_DIR, param_name)
+            if not force and os.path.exists(hash_path) and os.path.isdir(out_dir):
+                with open(hash_path, 'r') as f:
+                    if f.read().strip() == digest:
+                        summary['status'] = 'up-to-date'
+            if summary['status'] == 'converted':
+                # drop problem files of an older version of the config
+                shutil.rmtree(out_dir, ignore_errors=True)
+                if os.path.exists(hash_path):
+                    os.remove(hash_path)
+                convert_config(config_path, model_type, top_dir, 'cpu', static, check_static)
+                os.makedirs(os.path.dirname(hash_path), exist_ok=True)
+                with open(hash_path, 'w') as f:
+                    f.write(digest)
+            summary['layers'] = len(glob.glob(os.path.join(out_dir, '*.yaml')))
+    except Exception as e:
+        summary['status'] = 'failed: %s' % e
+    summary['log'] = log.getvalue()
+    summary['seconds'] = time.perf_counter() - start
+    return summary
+
+
+def convert_configs(config_paths, default_model_type, top_dir, static=True, check_static=False, force=False, workers=1):
+    """
+    Convert many configs in one process, or over a pool of worker processes
+    Returns the per-config summaries, in the order of config_paths
+    """
+    jobs = [(path, infer_model_type(path, default_model_type), top_dir, static, check_static, force) for path in config_paths]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(convert_config_if_stale, *zip(*jobs)))
+    return [convert_config_if_stale(*job) for job in jobs]
+
+
+def print_summaries(summaries):
+    width = max(len(s['config']) for s in summaries)
+    for s in summaries:
+        print(f"{s['config']:<{width}}  {s['model_type']:<20} {s['status']:<12} {s['layers']:>3} layers  {s['seconds']:.2f}s")
+    counts = collections.Counter(s['status'].split(':')[0] for s in summaries)
+    print(", ".join(f"{n} {status}" for status, n in counts.items()))
+
+
 def parse_options():
     parser = argparse.ArgumentParser()
     parser.add_argument('--params', type=str, help='Name of params yaml')
+    parser.add_argument('--configs', type=str, default=None, help="Config directory or glob to convert in one process, eg. configs/VariableBackbone")
+    parser.add_argument('--workers', type=int, default=1, help="Worker processes for --configs")
+    parser.add_argument('--force', action='store_true', help="Convert --configs even if the output is up to date")
+    parser.add_argument('--verbose', action='store_true', help="Print the converter output of every config of --configs")
     parser.add_argument('--mode', type=str, default="serial", help="Process heads: serial, parallel")
     parser.add_argument('--model_type', type=str, default="VariableBackbone", help="Name of model")
     parser.add_argument('--top_dir', type=str, default="layer_shapes", help="Directory with layer shapes")
+    parser.add_argument('--traced', action='store_true', help="trace a forward pass for the layer shapes instead of inferring them")
+    parser.add_argument('--check_static', action='store_true', help="cross-check the static shapes against a traced forward pass first")
     return parser.parse_args()
 
 
@@ -227,12 +387,16 @@ if __name__ == "__main__":
     args.top_dir = os.path.join(ROOT_DIR, "workspace/final-project/layer_shapes")
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     print(device)
-    with open(f"configs/{args.params}.yaml", 'r') as f:
-        params = yaml.safe_load(f)
-
-    if args.model_type == 'ToyNet':
-        convert_ToyNet(params, device, args.top_dir, params=params)
-    elif args.model_type == 'VariableBackbone':
-        convert_VariableBackbone(params, device, args.top_dir, args.model_type, mode=params['mode'], params=params)
-    elif args.model_type == 'VariableCNNBackbone':
-        convert_VariableCNNBackbone(params, device, args.top_dir, args.model_type, mode=params['mode'], params=params)
+    static = not args.traced
+    if args.configs is not None:
+        config_paths = find_configs(args.configs)
+        if not config_paths:
+            raise FileNotFoundError(f"no config files match {args.configs}")
+        summaries = convert_configs(config_paths, args.model_type, args.top_dir, static,
+                                    args.check_static, args.force, args.workers)
+        if args.verbose:
+            for s in summaries:
+                print(s['log'], end='')
+        print_summaries(summaries)
+    else:
+        convert_config(f"configs/{args.params}.yaml", args.model_type, args.top_dir, device, static, args.check_static)
@@ -0,0 +1,199 @@
+import os
+import glob
+import itertools
+import argparse
+from pathlib import Path
+from ruamel.yaml import YAML
+from ruamel.yaml.compat import StringIO
+from estimator import parse_instances
+
+# directory of the base designs, and of the designs the profiler runs on
+BASE_DESIGNS_DIR = 'example_designs'
+DESIGNS_DIR = 'timeloop_results'
+# parameters of a generated design, written to its directory
+SPEC_FILE = 'design.yaml'
+# directories of a design copied from its base design as they are
+COPIED_DIRS = ['arch/components', 'constraints', 'mapper']
+
+
+def yaml_rt():
+    # round trip, so the generated arch keeps the comments and layout of its base
+    yaml = YAML()
+    yaml.indent(mapping=2, sequence=4, offset=2)
+    yaml.preserve_quotes = True
+    return yaml
+
+
+def load_sweep(path):
+    """
+    Base design and parameter ranges of a sweep file, eg.
+        base: eyeriss_like
+        params:
+          pes: [42, 84, 168]
+          meshX: [14]
+          word_bits: [8, 16]
+          shared_glb.memory_depth: [8192, 16384]
+    """
+    with open(path, 'r') as f:
+        sweep = YAML(typ='safe').load(f)
+    params = {key: values if isinstance(values, list) else [values] for key, values in (sweep.get('params') or {}).items()}
+    return sweep['base'], params
+
+
+def sweep_points(params):
+    """
+    Every combination of the parameter values of a sweep, in order
+    """
+    keys = list(params)
+    return [dict(zip(keys, values)) for values in itertools.product(*(params[key] for key in keys))]
+
+
+def design_name(base, point, pes):
+    """
+    Name of a generated design, the base name and the PE count first like the hand written eyeriss_like_168pe, then
+    the other parameters, eg. eyeriss_like_168pe_word_bits8_shared_glb-memory_depth8192
+    """
+    name = f'{base}_{pes}pe'
+    for key, value in point.items():
+        if key != 'pes':
+            name += f"_{key.replace('.', '-')}{value}"
+    return name
+
+
+def pe_array(node, parent=None):
+    """
+    Innermost subtree node with several instances, the PE array, and the node holding it
+    """
+    found = None
+    for child in node.get('subtree', []) or []:
+        if parse_instances(child['name'])[1] > 1:
+            found = (child, node)
+        found = pe_array(child, node) or found
+    return found
+
+
+def components(node):
+    for local in node.get('local', []) or []:
+        yield local
+    for child in node.get('subtree', []) or []:
+        yield from components(child)
+
+
+def apply_point(arch, point):
+    """
+    Edit the arch tree of the base design to a sweep point
+        pes : number of PEs, the instances of the PE array
+        meshX : width of the PE mesh, the meshX of every component of the PE array and of the level holding it.
+            Components of that level with one instance per column (eg. eyeriss's DummyBuffer) follow it
+        word_bits : word-bits and datawidth of every component
+        <component>.<attribute> : an attribute of a component, eg. shared_glb.memory_depth or ifmap_spad.memory_depth
+    Returns the number of PEs of the design
+    """
+    pe, parent = pe_array(arch['architecture'])
+    pe_name, pes = parse_instances(pe['name'])
+    pes = point.get('pes', pes)
+    pe['name'] = f'{pe_name}[0..{pes - 1}]'
+
+    if 'meshX' in point:
+        mesh_x = point['meshX']
+        old = next((local['attributes']['meshX'] for local in components(pe) if 'meshX' in (local.get('attributes') or {})), None)
+        if pes % mesh_x:
+            raise ValueError(f'{pes} PEs do not fill a mesh {mesh_x} wide')
+        for local in list(components(pe)) + list(parent.get('local', []) or []):
+            attributes = local.get('attributes') or {}
+            if 'meshX' in attributes:
+                attributes['meshX'] = mesh_x
+        for local in parent.get('local', []) or []:
+            name, count = parse_instances(local['name'])
+            if count > 1 and count == old:
+                local['name'] = f'{name}[0..{mesh_x - 1}]'
+
+    if 'word_bits' in point:
+        for local in components(arch['architecture']):
+            attributes = local.get('attributes') or {}
+            for key in ['word-bits', 'datawidth']:
+                if key in attributes:
+                    attributes[key] = point['word_bits']
+
+    for key, value in point.items():
+        if '.' not in key:
+            continue
+        component, attribute = key.split('.', 1)
+        targets = [local for local in components(arch['architecture']) if parse_instances(local['name'])[0] == component]
+        if not targets:
+            raise KeyError(f'no component {component} in the arch')
+        for local in targets:
+            local.setdefault('attributes', {})[attribute] = value
+    return pes
+
+
+def write_if_changed(path, text):
+    # unchanged inputs keep their input hash and mtime, so their results are reused
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            if f.read() == text:
+                return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def materialize(base, point, base_dir='.'):
+    """
+    Write the design tree of a sweep point to DESIGNS_DIR/<name>: the arch of the base design edited to the point,
+    and its components, constraints and mapper. Trees are written once and rewritten only where their inputs
+    change, result directories in them are kept. A hand written tree of the same name is left as it is
+    Returns the name of the design
+    """
+    base_dir = Path(base_dir)
+    base_tree = base_dir / BASE_DESIGNS_DIR / base
+    yaml = yaml_rt()
+    with open(base_tree / 'arch' / f'{base}.yaml', 'r') as f:
+        arch = yaml.load(f)
+    pes = apply_point(arch, point)
+    name = design_name(base, point, pes)
+    tree = base_dir / DESIGNS_DIR / name
+
+    if (tree / 'arch' / f'{name}.yaml').exists() and not (tree / SPEC_FILE).exists():
+        print(f'{name} is not generated, using it as it is')
+        return name
+
+    for sub_dir in COPIED_DIRS:
+        for path in sorted(glob.glob(str(base_tree / sub_dir / '*.yaml'))):
+            with open(path, 'r') as f:
+                write_if_changed(str(tree / sub_dir / os.path.basename(path)), f.read())
+    stream = StringIO()
+    yaml.dump(arch, stream)
+    write_if_changed(str(tree / 'arch' / f'{name}.yaml'), stream.getvalue())
+    stream = StringIO()
+    yaml.dump({'base': base, 'params': dict(point, pes=pes)}, stream)
+    write_if_changed(str(tree / SPEC_FILE), stream.getvalue())
+    return name
+
+
+def generate(sweep_paths, base_dir='.'):
+    """
+    Materialize the designs of sweep files
+    Returns their names, in order
+    """
+    names = []
+    for path in sweep_paths:
+        base, params = load_sweep(path)
+        for point in sweep_points(params):
+            name = materialize(base, point, base_dir)
+            if name not in names:
+                names.append(name)
+    return names
+
+
+def parse_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sweeps', type=str, nargs='+', help='Sweep files, eg. design_sweeps/eyeriss_like_pe.yaml')
+    parser.add_argument('--base_dir', type=str, default='.', help='Base directory')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_options()
+    for name in generate(args.sweeps, args.base_dir):
+        print(name)
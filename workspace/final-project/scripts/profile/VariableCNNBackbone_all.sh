@@ -0,0 +1,3 @@
+#!/usr/bin/env bash
+
+python3 -m profiler --configs=configs/VariableCNNBackbone --model_type=VariableCNNBackbone --sweep design_sweeps/eyeriss_like_pe.yaml
@@ -0,0 +1,59 @@
+"""
+The static shape inference of the converter must give the same layer data and problem files as tracing a forward
+pass, for every model and mode the configs use.
+"""
+import os
+import sys
+import glob
+
+import pytest
+import yaml
+
+FINAL_PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, FINAL_PROJECT_DIR)
+sys.path.insert(0, os.path.join(FINAL_PROJECT_DIR, 'pytorch2timeloop-converter-main'))
+
+import pytorch2timeloop
+from convert import convert_config, infer_model_type
+from hw4dl.models.shared_backbone import VariableBackbone
+from hw4dl.models.separated_network import ToyNet
+from hw4dl.models.shared_cnn import VariableCNNBackbone
+
+CONFIGS = sorted(glob.glob(os.path.join(FINAL_PROJECT_DIR, 'configs', '**', '*.yaml'), recursive=True))
+# pixel heads predict a location, patch heads a 2x3x3 patch
+PIXEL_SHAPES = [16, -1, 32, -1, 64, 128, 'fc512', 'fc2']
+PATCH_SHAPES = [16, -1, 32, -1, 64, 128, 'fc512', 'fc18']
+
+
+def extract(net, input_shape, static):
+    return pytorch2timeloop.converter_pytorch.extract_layer_data(net, input_shape, True, [], static=static)
+
+
+@pytest.mark.parametrize('name, make_net, input_shape', [
+    ('ToyNet', lambda: ToyNet(3, [1, 20, 30, 40]), (1, 1, 1)),
+    ('VariableBackbone', lambda: VariableBackbone([1, 30, 30, 30, 30, 30, 2], 2, 5), (1, 1, 1)),
+    ('VariableCNNBackbone pixel', lambda: VariableCNNBackbone(PIXEL_SHAPES, 1, 5, input_size=(10, 10), task='pixel'), (1, 10, 10)),
+    ('VariableCNNBackbone patch', lambda: VariableCNNBackbone(PATCH_SHAPES, 1, 5, input_size=(10, 10), task='patch'), (1, 10, 10)),
+])
+def test_layer_data(name, make_net, input_shape):
+    net = make_net()
+    assert extract(net, input_shape, static=True) == extract(net, input_shape, static=False)
+
+
+def load_problems(top_dir):
+    problems = {}
+    for path in glob.glob(os.path.join(top_dir, '**', '*.yaml'), recursive=True):
+        with open(path, 'r') as f:
+            problems[os.path.relpath(path, top_dir)] = yaml.safe_load(f)
+    return problems
+
+
+@pytest.mark.parametrize('config_path', CONFIGS, ids=lambda path: os.path.relpath(path, FINAL_PROJECT_DIR))
+def test_problem_files(config_path, tmp_path):
+    # serial and parallel configs alike, parallel mode rewrites the head layers after the conversion
+    model_type = infer_model_type(config_path, 'VariableBackbone')
+    convert_config(config_path, model_type, str(tmp_path / 'static'), 'cpu', static=True)
+    convert_config(config_path, model_type, str(tmp_path / 'traced'), 'cpu', static=False)
+    static = load_problems(tmp_path / 'static')
+    assert static
+    assert static == load_problems(tmp_path / 'traced')
@@ -0,0 +1,78 @@
+import os
+import json
+
+STATS_FILE = 'timeloop-mapper.stats.txt'
+# structured results of a mapper run, next to the stats file it was parsed from
+RESULTS_FILE = 'results.json'
+
+
+def parse_stats_text(text):
+    """
+    Structured results of the text of a timeloop-mapper.stats.txt file
+    Returns a dict with
+        energy : total energy in uJ
+        cycle : number of cycles
+        utilization, gflops, computes
+        energy_per : total energy per compute (MACC in older timeloop versions) in pJ
+        pj_per_compute : energy per compute in pJ of every level and of the MACs
+        level_energy : total energy in pJ of every level, summed over its data spaces
+        energy_en : summed energy of the lines of the stats file that aggregate.py reports as "energy en"
+    """
+    stats = {'pj_per_compute': {}, 'level_energy': {}, 'energy_en': 0}
+    lines = text.split('\n')
+
+    level = None
+    for line in lines:
+        if line.startswith('=== ') and line.endswith(' ==='):
+            level = line[4:-4]
+        elif line.startswith('Summary Stats'):
+            level = None
+        elif level and line.strip().startswith('Energy (total)'):
+            stats['level_energy'][level] = stats['level_energy'].get(level, 0) + float(line.split(': ')[1].split(' ')[0])
+
+    # the summary is in the last 30 lines
+    per_compute = False
+    for line in lines[-30:]:
+        if line.startswith('Energy'):
+            stats['energy'] = float(line.split(': ')[1].split(' ')[0])
+        elif line.startswith('Cycles'):
+            stats['cycle'] = int(line.split(': ')[1])
+        elif line.startswith('GFLOPs'):
+            stats['gflops'] = float(line.split(': ')[1])
+        elif line.startswith('Utilization'):
+            stats['utilization'] = float(line.split(': ')[1])
+        elif line.startswith('Computes') or line.startswith('MACCs'):
+            stats['computes'] = int(line.split('= ')[1])
+        elif line.startswith('pJ/Compute') or line.startswith('pJ/MACC'):
+            per_compute = True
+        elif per_compute and line.startswith('    ') and '=' in line:
+            name, value = line.rsplit('= ', 1)
+            stats['pj_per_compute'][name.strip()] = float(value.split(' ')[0])
+    if 'Total' in stats['pj_per_compute']:
+        stats['energy_per'] = stats['pj_per_compute']['Total']
+    if 'ifmap_spad' in stats['pj_per_compute']:
+        stats['ifmap_spad'] = stats['pj_per_compute']['ifmap_spad']
+
+    for line in lines[160:175]:
+        if line.startswith('        Energy (total)'):
+            stats['energy_en'] += float(line.split(': ')[1].split(' ')[0])
+    return stats
+
+
+def write_results(result_dir, stats):
+    with open(os.path.join(result_dir, RESULTS_FILE), 'w') as f:
+        json.dump(stats, f, indent=2)
+
+
+def load_results(result_dir):
+    """
+    Structured results of a result directory, parsed from its stats file if they were not stored with the run
+    """
+    path = os.path.join(result_dir, RESULTS_FILE)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    with open(os.path.join(result_dir, STATS_FILE), 'r') as f:
+        stats = parse_stats_text(f.read())
+    write_results(result_dir, stats)
+    return stats
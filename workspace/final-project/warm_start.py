@@ -0,0 +1,294 @@
+import os
+import re
+import json
+import hashlib
+import shutil
+import subprocess
+import yaml
+from pathlib import Path
+from estimator import flatten_arch
+from scheduler import BUDGET_MAPPER_FILE, HASH_FILE, WARM_FILE, scale_mapper, stored_hash
+from timeloop_stats import STATS_FILE, parse_stats_text
+
+# best mapping of a mapper run, next to its stats
+MAPPING_FILE = 'timeloop-mapper.map.txt'
+MODEL_STATS_FILE = 'timeloop-model.stats.txt'
+MODEL_MAPPING_FILE = 'timeloop-model.map.txt'
+# outputs of a mapper run describing its mapping, replaced by the ones of timeloop-model when a projected mapping is kept
+MODEL_OUTPUTS = {
+    MODEL_STATS_FILE: STATS_FILE,
+    MODEL_MAPPING_FILE: MAPPING_FILE,
+    'timeloop-model.map+stats.xml': 'timeloop-mapper.map+stats.xml',
+    'timeloop-model.log': 'timeloop-mapper.log',
+}
+# directory of a result directory where the mappings of neighbouring designs are projected and evaluated
+WARM_DIR = 'warm_start'
+# mapper config of a warm started job, written to its result directory
+WARM_MAPPER_FILE = 'warm_mapper.yaml'
+# fraction of its search budget a warm started job gets
+WARM_BUDGET_SCALE = 0.25
+# number of neighbouring designs, closest in PE count first, whose mappings are evaluated
+NEIGHBOURS = 3
+
+# "shared_glb [ Inputs:2497 Outputs:5280 ]" and "|       for M in [0:12) (Spatial-X)" lines of a map.txt
+LEVEL_RE = re.compile(r'^(\S+) \[(.*)\]')
+LOOP_RE = re.compile(r'for (\w+) in \[0:(\d+)\)(?: \(Spatial-([XY])\))?')
+
+
+def parse_map_txt(text):
+    """
+    Loop nest of a timeloop map.txt file
+    Returns the storage levels, outermost first, with the tensors they keep and their temporal and spatial loops,
+    outermost first, as (dim, bound) and (dim, bound, axis)
+    """
+    levels = []
+    for line in text.split('\n'):
+        level = LEVEL_RE.match(line)
+        if level:
+            keep = [tensor.split(':')[0] for tensor in level.group(2).split()]
+            levels.append({'target': level.group(1), 'keep': keep, 'temporal': [], 'spatial': []})
+            continue
+        loop = LOOP_RE.search(line)
+        if loop and levels:
+            if loop.group(3):
+                levels[-1]['spatial'].append((loop.group(1), int(loop.group(2)), loop.group(3)))
+            else:
+                levels[-1]['temporal'].append((loop.group(1), int(loop.group(2))))
+    return levels
+
+
+def fanouts(arch):
+    """
+    X and Y fanout from every level of an arch tree to the next level inside it
+    """
+    components = flatten_arch(arch)
+    result = {}
+    for outer, inner in zip(components, components[1:]):
+        outer_x = outer['attributes'].get('meshX', 1)
+        inner_x = inner['attributes'].get('meshX', 1)
+        x = max(1, inner_x // outer_x)
+        y = max(1, (inner['instances'] // inner_x) // max(1, outer['instances'] // outer_x))
+        result[outer['name']] = (x, y)
+    return result
+
+
+def arch_pes(arch):
+    return max([c['instances'] for c in flatten_arch(arch) if 'mac' in c['class'].lower()] or [1])
+
+
+def project(levels, arch, problem):
+    """
+    Mapping of a loop nest found on another design, in the mapping format of timeloop-model, for an arch tree.
+    Spatial loops are kept as far as they fit the fanouts of the arch, the rest of their bound becomes a temporal
+    loop of the same level
+    Returns None if the levels of the loop nest are not the storage levels of the arch
+    """
+    names = [c['name'] for c in flatten_arch(arch)]
+    if any(level['target'] not in names for level in levels):
+        return None
+    dims = problem['shape']['dimensions']
+    tensors = [space['name'] for space in problem['shape']['data-spaces']]
+    fanout = fanouts(arch)
+
+    mapping = []
+    for level in levels:
+        temporal = dict.fromkeys(dims, 1)
+        order = [dim for dim, _ in level['temporal']]
+        for dim, bound in level['temporal']:
+            temporal[dim] *= bound
+        spatial = {'X': {}, 'Y': {}}
+        for dim, bound, axis in level['spatial']:
+            limit = fanout.get(level['target'], (1, 1))[axis == 'Y']
+            for used in spatial[axis].values():
+                limit //= used
+            fit = max(d for d in range(1, bound + 1) if bound % d == 0 and d <= max(1, limit))
+            spatial[axis][dim] = spatial[axis].get(dim, 1) * fit
+            if bound // fit > 1:
+                temporal[dim] *= bound // fit
+                order.append(dim)
+
+        # permutations go from the innermost loop out
+        permutation = list(dict.fromkeys(reversed(order))) + [dim for dim in dims if dim not in order]
+        mapping.append({'target': level['target'], 'type': 'temporal',
+                        'factors': ' '.join(f'{dim}={temporal[dim]}' for dim in dims),
+                        'permutation': ''.join(permutation)})
+        if spatial['X'] or spatial['Y']:
+            factors = dict.fromkeys(dims, 1)
+            factors.update(spatial['X'])
+            factors.update(spatial['Y'])
+            x_dims = list(spatial['X'])
+            mapping.append({'target': level['target'], 'type': 'spatial',
+                            'factors': ' '.join(f'{dim}={factors[dim]}' for dim in dims),
+                            'permutation': ''.join(x_dims + [dim for dim in dims if dim not in x_dims]),
+                            'split': len(x_dims)})
+        mapping.append({'target': level['target'], 'type': 'bypass',
+                        'keep': level['keep'], 'bypass': [t for t in tensors if t not in level['keep']]})
+    return mapping
+
+
+def warm_hash(input_hash, budget_scale, seed):
+    """
+    Hash a warm started run is stored under. It differs from the hash of the whole search of the same inputs, so
+    runs without warm start do not take its results for the results of a whole search
+    """
+    return hashlib.sha1(f'{input_hash} warm {budget_scale} {seed}'.encode()).hexdigest()
+
+
+def warm_results(cwd, input_hash, budget_scale=WARM_BUDGET_SCALE):
+    """
+    Whether a result directory holds the results of a successful warm started run on the given inputs with the given
+    fraction of the search budget
+    """
+    try:
+        with open(os.path.join(cwd, WARM_FILE), 'r') as f:
+            record = json.load(f)
+    except FileNotFoundError:
+        return False
+    return (record['input_hash'] == input_hash and record['budget_scale'] == budget_scale
+            and stored_hash(cwd) == warm_hash(input_hash, budget_scale, record['seed']))
+
+
+def edp(stats):
+    return stats['energy'] * stats['cycle']
+
+
+def neighbours(job):
+    """
+    Result directories of the problem of a mapper job on other designs with a mapping, closest in PE count first
+    """
+    cwd = Path(job.cwd)
+    with open(job.cmd[1], 'r') as f:
+        pes = arch_pes(yaml.safe_load(f)['architecture'])
+    found = []
+    for other in cwd.parents[2].glob(f'*/{cwd.parent.name}/{cwd.name}'):
+        if other == cwd or not (other / MAPPING_FILE).exists() or not (other / HASH_FILE).exists():
+            continue
+        design = other.parents[1]
+        try:
+            with open(design / 'arch' / f'{design.name}.yaml', 'r') as f:
+                other_pes = arch_pes(yaml.safe_load(f)['architecture'])
+        except FileNotFoundError:
+            continue
+        found.append((abs(other_pes - pes), str(other)))
+    return [Path(other) for _, other in sorted(found)]
+
+
+def evaluate(job, mapping, out_dir):
+    """
+    Run timeloop-model on the problem and design of a mapper job with a given mapping
+    Returns the structured results, None if the mapping is not valid on the design
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    mapping_path = os.path.join(out_dir, 'mapping.yaml')
+    with open(mapping_path, 'w') as f:
+        yaml.safe_dump({'mapping': mapping}, f)
+    # the arch, components and tables of the job, without the mapper and the constraints
+    inputs = [path for path in job.cmd[1:-1]
+              if os.path.basename(os.path.dirname(path)) != 'constraints'
+              and os.path.basename(path) not in [BUDGET_MAPPER_FILE, WARM_MAPPER_FILE]]
+    with open(os.path.join(out_dir, 'timeloop-model.out'), 'w') as out:
+        try:
+            returncode = subprocess.run(['timeloop-model', *inputs, mapping_path, job.cmd[-1]], cwd=out_dir,
+                                        stdout=out, stderr=subprocess.STDOUT).returncode
+        except OSError:
+            return None
+    stats_path = os.path.join(out_dir, MODEL_STATS_FILE)
+    if returncode != 0 or not os.path.exists(stats_path):
+        return None
+    with open(stats_path, 'r') as f:
+        stats = parse_stats_text(f.read())
+    return stats if 'energy' in stats and 'cycle' in stats else None
+
+
+class WarmStart(object):
+    """
+    Warm starts the mapper jobs of a problem from the best mappings found on neighbouring designs.
+
+    Before a job starts, the mappings of the problem on the closest designs are projected on its design and
+    evaluated with timeloop-model. The best of them bounds the cost of the job, which then searches with a
+    fraction of its budget and keeps the projected mapping if it finds none better. Its results are stored under
+    warm_hash and recorded in WARM_FILE, so only runs with warm start reuse them. The first job of a problem
+    without results on any design searches with its whole budget, the jobs of the problem on other designs wait
+    for it.
+    """
+
+    def __init__(self, jobs, budget_scale=WARM_BUDGET_SCALE):
+        self.budget_scale = budget_scale
+        self.bounds = {}
+        self.records = {}
+        self.done = set()
+        self.seeds = {}
+        for job in jobs:
+            key = Path(job.cwd).name
+            if key not in self.seeds:
+                self.seeds[key] = None if neighbours(job) else job.cwd
+
+    def ready(self, job):
+        seed = self.seeds.get(Path(job.cwd).name)
+        return seed is None or seed == job.cwd or seed in self.done
+
+    def prepare(self, job):
+        """
+        Evaluate the projected mappings of the neighbouring designs of a job
+        Returns the job, with a shorter search if one of the mappings is valid on its design
+        """
+        with open(job.cmd[-1], 'r') as f:
+            problem = yaml.safe_load(f)['problem']
+        with open(job.cmd[1], 'r') as f:
+            arch = yaml.safe_load(f)['architecture']
+        best = None
+        for other in neighbours(job)[:NEIGHBOURS]:
+            with open(other / MAPPING_FILE, 'r') as f:
+                mapping = project(parse_map_txt(f.read()), arch, problem)
+            if mapping is None:
+                continue
+            out_dir = os.path.join(job.cwd, WARM_DIR, other.parents[1].name)
+            stats = evaluate(job, mapping, out_dir)
+            if stats and (best is None or edp(stats) < edp(best[0])):
+                best = (stats, out_dir)
+        if best is None:
+            return job
+        seed = os.path.basename(best[1])
+        self.bounds[job.cwd] = best
+        self.records[job.cwd] = {'input_hash': job.input_hash, 'seed': seed, 'budget_scale': self.budget_scale,
+                                 'warm_hash': warm_hash(job.input_hash, self.budget_scale, seed)}
+        print(f"{job.name}: mapping of {seed} at {best[0]['energy']} uJ, {best[0]['cycle']} cycles")
+
+        index = next(i for i, path in enumerate(job.cmd) if os.path.basename(path) == BUDGET_MAPPER_FILE)
+        warm_mapper = os.path.join(job.cwd, WARM_MAPPER_FILE)
+        scale_mapper(job.cmd[index], self.budget_scale, warm_mapper)
+        return job._replace(cmd=job.cmd[:index] + [warm_mapper] + job.cmd[index + 1:],
+                            input_hash=self.records[job.cwd]['warm_hash'])
+
+    def finish(self, job, returncode, stopped=None):
+        """
+        Put the projected mapping of a neighbouring design in place of the mapper's results if the mapper found no
+        mapping or a worse one
+        Returns the exit status of the job, 0 if it ends up with the projected mapping
+        """
+        self.done.add(job.cwd)
+        if job.cwd not in self.bounds:
+            return returncode
+        stats, out_dir = self.bounds[job.cwd]
+        record = self.records[job.cwd]
+        stats_path = os.path.join(job.cwd, STATS_FILE)
+        if (returncode == 0 or stopped) and os.path.exists(stats_path):
+            with open(stats_path, 'r') as f:
+                found = parse_stats_text(f.read())
+            if 'energy' in found and 'cycle' in found and edp(found) <= edp(stats):
+                self._write_record(job, dict(record, kept='mapper'))
+                return returncode
+        # the outputs left by the mapper describe its own mapping
+        for model_file, mapper_file in MODEL_OUTPUTS.items():
+            if os.path.exists(os.path.join(out_dir, model_file)):
+                shutil.copyfile(os.path.join(out_dir, model_file), os.path.join(job.cwd, mapper_file))
+            elif os.path.exists(os.path.join(job.cwd, mapper_file)):
+                os.remove(os.path.join(job.cwd, mapper_file))
+        self._write_record(job, dict(record, kept='projected'))
+        print(f"{job.name}: keeping the mapping of {record['seed']}")
+        return 0
+
+    @staticmethod
+    def _write_record(job, record):
+        with open(os.path.join(job.cwd, WARM_FILE), 'w') as f:
+            json.dump(record, f, indent=2)
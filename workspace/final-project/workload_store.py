@@ -0,0 +1,98 @@
+import os
+import re
+import json
+import hashlib
+import yaml
+from pathlib import Path
+
+# directory of the store, relative to the base directory
+STORE_DIR = 'workloads'
+# directory of the results of a design holding one result directory per stored problem
+RESULTS_DIR = 'workloads'
+# directory of the analytic estimates of a design, kept apart from the mapper results
+ESTIMATES_DIR = 'estimates'
+
+
+def problem_hash(problem):
+    """
+    Canonical hash of a timeloop problem description, independent of key order and formatting
+    """
+    return hashlib.sha1(json.dumps(problem, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def layer_number(file):
+    return int(re.findall(r'\d+', file)[0])
+
+
+class WorkloadStore(object):
+    """
+    Content addressed store of the layer problems of all configs.
+
+    Every distinct problem is stored once as problems/<hash>.yaml. Every config gets a manifest,
+    manifests/<model>/<param_dir>.yaml, listing the problem hash of each of its layers, so identical layers of
+    different configs (eg. the heads of a network at different split indexes) resolve to the same problem and
+    are profiled once per design.
+    """
+
+    def __init__(self, base_dir, store_dir=STORE_DIR):
+        self.root = Path(base_dir) / store_dir
+
+    def problem_path(self, key):
+        return self.root / 'problems' / f'{key}.yaml'
+
+    def manifest_path(self, model, param_dir):
+        return self.root / 'manifests' / model / f'{param_dir}.yaml'
+
+    def add(self, problem):
+        """
+        Store a problem description
+        Returns the hash it is stored under
+        """
+        key = problem_hash(problem)
+        path = self.problem_path(key)
+        if not path.exists():
+            os.makedirs(path.parent, exist_ok=True)
+            # write under a private name and rename, so concurrent writers never expose a partial file
+            tmp = path.with_suffix(f'.tmp-{os.getpid()}')
+            with open(tmp, 'w') as f:
+                yaml.safe_dump(problem, f)
+            os.replace(tmp, path)
+        return key
+
+    def index(self, model, param_dir, layer_dir):
+        """
+        Store the layer problems of a converted config and write its manifest
+        Returns the manifest, a list of {'layer': number, 'problem': hash} ordered by layer number
+        """
+        manifest = []
+        for file in sorted(os.listdir(layer_dir), key=layer_number):
+            with open(os.path.join(layer_dir, file), 'r') as fid:
+                problem = yaml.safe_load(fid)
+            manifest.append({'layer': layer_number(file), 'problem': self.add(problem)})
+        path = self.manifest_path(model, param_dir)
+        os.makedirs(path.parent, exist_ok=True)
+        with open(path, 'w') as f:
+            yaml.safe_dump({'model': model, 'param_dir': param_dir, 'layers': manifest}, f)
+        return manifest
+
+    def manifest(self, model, param_dir):
+        with open(self.manifest_path(model, param_dir), 'r') as f:
+            return yaml.safe_load(f)['layers']
+
+    @staticmethod
+    def counts(manifest):
+        """
+        Number of layers of a manifest using every problem, in order of first use
+        """
+        counts = {}
+        for layer in manifest:
+            counts[layer['problem']] = counts.get(layer['problem'], 0) + 1
+        return counts
+
+
+def result_dir(base_dir, timeloop_dir, key, results_dir=RESULTS_DIR):
+    """
+    Directory of the timeloop results of a stored problem, timeloop_dir being the results directory of the design.
+    results_dir is ESTIMATES_DIR for the analytic estimates
+    """
+    return Path(base_dir) / timeloop_dir / results_dir / key